@@ -1,14 +1,41 @@
-from fastapi import FastAPI, HTTPException, Header, Request, UploadFile, Form
+from fastapi import FastAPI, HTTPException, Header, Query, Request, UploadFile, Form
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+import asyncio
 import os
+import re
 import sqlite3
-from typing import Any, Dict, List, Optional
-from datetime import datetime, date
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Callable, ContextManager, Dict, Iterator, List, Optional
+from datetime import datetime, date, timedelta
 from pydantic import BaseModel
+import anyio
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.routing import Match
 import hashlib
 import json
+from urllib.parse import unquote, urlsplit
+
+# Быстрый JSON-кодировщик (необязательная зависимость)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Дополнительные кодировки сжатия ответов (gzip есть всегда)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # Импортируем PDF генератор
 try:
@@ -24,7 +51,7 @@ except Exception as e:
 
 CURRENT_DIR = os.path.dirname(__file__)
 PROJECT_ROOT = os.path.abspath(os.path.join(CURRENT_DIR, ".."))
-DB_PATH = os.path.join(PROJECT_ROOT, "bot.db")
+DB_PATH = os.getenv("DB_PATH") or os.path.join(PROJECT_ROOT, "bot.db")
 UPLOAD_DIR = os.path.join(PROJECT_ROOT, "uploads")
 
 app = FastAPI(title="UgraBuilders API", version="0.1.0")
@@ -40,12 +67,257 @@ origins: List[str] = [
 if origins_env:
     origins.append(origins_env)
 
+# Условные GET: коллекция -> таблицы, от которых зависит ответ. ETag строится из
+# ревизий этих таблиц (_collection_etag), совпавший If-None-Match получает 304
+# без запроса к базе. Ответы, зависящие от текущей даты (дебиторка, метрики),
+# сюда не входят.
+ETAG_ROUTES: Dict[str, tuple[str, ...]] = {
+    "/api/objects": ("objects",),
+    "/api/users": ("users",),
+    "/api/users/archived": ("users",),
+    "/api/tasks": ("tasks",),
+    "/api/purchases": ("purchases",),
+    "/api/salaries": ("salaries",),
+    "/api/absences": ("absences",),
+    "/api/items": ("items",),
+    "/api/suppliers": ("suppliers",),
+    "/api/customers": ("customers",),
+    "/api/invoices": ("invoices",),
+    "/api/budgets": ("budgets",),
+    "/api/cash": ("cash_transactions",),
+    "/api/payments": ("payments",),
+    "/api/expenses/other": ("other_expenses",),
+    "/api/warehouse/consumption": ("warehouse_consumption",),
+    "/api/purchase-requests": ("purchase_requests",),
+    "/api/documents": ("documents",),
+    "/api/tools": ("tools",),
+    "/api/tool-assignments": ("tool_assignments", "tools", "users"),
+    "/api/materials": ("purchases",),
+    "/api/materials/history": ("purchases",),
+    "/api/materials/costs": ("purchases",),
+    "/api/finance/journal": ("invoices", "purchases", "salaries", "absences", "cash_transactions", "payments", "other_expenses"),
+    "/api/finance/pnl": ("invoices", "purchases", "salaries", "other_expenses"),
+    "/api/finance/cashflow": ("cash_transactions", "payments"),
+}
+
+
+class _ConditionalGetMiddleware:
+    """ETag / If-None-Match для коллекций из ETAG_ROUTES (чистый ASGI, стримы не буферизуются)."""
+
+    def __init__(self, app: Callable) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        tables = ETAG_ROUTES.get(scope["path"]) if scope["type"] == "http" and scope["method"] in ("GET", "HEAD") else None
+        if not tables:
+            await self.app(scope, receive, send)
+            return
+        # Ревизию берём до выполнения запроса: запись, пришедшая позже, сменит ETag
+        etag = _collection_etag(tables)
+        headers = [(b"etag", etag.encode()), (b"cache-control", b"no-cache"), (b"vary", b"Accept")]
+        for name, value in scope["headers"]:
+            if name == b"if-none-match":
+                candidates = {v.strip() for v in value.decode("latin-1").split(",")}
+                if etag in candidates or "*" in candidates:
+                    await send({"type": "http.response.start", "status": 304, "headers": headers})
+                    await send({"type": "http.response.body", "body": b""})
+                    return
+
+        async def send_with_etag(message: Dict[str, Any]) -> None:
+            if message["type"] == "http.response.start" and message["status"] == 200:
+                message["headers"] = list(message.get("headers", [])) + headers
+            await send(message)
+
+        await self.app(scope, receive, send_with_etag)
+
+
+# ===== Сжатие ответов =====
+
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+# Куски больше порога сжимаются в пуле потоков, чтобы не держать event loop
+COMPRESS_THREAD_SIZE = int(os.getenv("COMPRESS_THREAD_SIZE", str(256 * 1024)))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "4"))
+ZSTD_LEVEL = int(os.getenv("ZSTD_LEVEL", "3"))
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/", "application/javascript", "image/svg+xml")
+# Поток событий живёт часами: держать на каждое соединение состояние компрессора незачем
+UNCOMPRESSED_TYPES = ("text/event-stream",)
+
+
+def _gzip_encoder() -> Callable[[bytes, bool], bytes]:
+    c = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return lambda data, final: c.compress(data) + c.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+def _brotli_encoder() -> Callable[[bytes, bool], bytes]:
+    c = brotli.Compressor(quality=BROTLI_QUALITY)
+    return lambda data, final: c.process(data) + (c.finish() if final else c.flush())
+
+
+def _zstd_encoder() -> Callable[[bytes, bool], bytes]:
+    c = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    return lambda data, final: c.compress(data) + c.flush(
+        zstandard.COMPRESSOBJ_FLUSH_FINISH if final else zstandard.COMPRESSOBJ_FLUSH_BLOCK
+    )
+
+
+# Порядок — предпочтение сервера при равных q
+ENCODERS: Dict[str, Callable[[], Callable[[bytes, bool], bytes]]] = {}
+if zstandard is not None:
+    ENCODERS["zstd"] = _zstd_encoder
+if brotli is not None:
+    ENCODERS["br"] = _brotli_encoder
+ENCODERS["gzip"] = _gzip_encoder
+
+
+def _negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    prefs: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        prefs[name] = q
+    best, best_q = None, 0.0
+    for name in ENCODERS:
+        q = prefs.get(name, prefs.get("*", 0.0))
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+
+_COMPRESSION_STATS: Dict[str, Dict[str, Any]] = {}
+_COMPRESSION_LOCK = threading.Lock()
+
+
+def _record_compression(route: str, encoding: Optional[str], size_in: int, size_out: int, cpu: float) -> None:
+    with _COMPRESSION_LOCK:
+        st = _COMPRESSION_STATS.setdefault(
+            route, {"responses": 0, "compressed": 0, "bytes_in": 0, "bytes_out": 0, "cpu_s": 0.0, "encodings": {}}
+        )
+        st["responses"] += 1
+        if encoding:
+            st["compressed"] += 1
+            st["bytes_in"] += size_in
+            st["bytes_out"] += size_out
+            st["cpu_s"] += cpu
+            st["encodings"][encoding] = st["encodings"].get(encoding, 0) + 1
+
+
+def _compression_stats() -> Dict[str, Any]:
+    with _COMPRESSION_LOCK:
+        return {
+            route: {
+                "responses": st["responses"],
+                "compressed": st["compressed"],
+                "bytes_in": st["bytes_in"],
+                "bytes_out": st["bytes_out"],
+                "ratio": round(st["bytes_in"] / st["bytes_out"], 2) if st["bytes_out"] else None,
+                "cpu_ms_total": round(st["cpu_s"] * 1000, 3),
+                "cpu_ms_avg": round(st["cpu_s"] * 1000 / st["compressed"], 3) if st["compressed"] else 0.0,
+                "encodings": dict(st["encodings"]),
+            }
+            for route, st in _COMPRESSION_STATS.items()
+        }
+
+
+class _CompressionMiddleware:
+    """gzip / br / zstd по Accept-Encoding (чистый ASGI).
+
+    Ответ целиком меньше COMPRESS_MIN_SIZE уходит как есть; потоковые ответы
+    сжимаются по кускам со сбросом после каждого, так что клиент получает
+    данные сразу. Степень сжатия и CPU копятся по маршрутам (/api/health/compression).
+    """
+
+    def __init__(self, app: Callable) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = _negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start: Optional[Dict[str, Any]] = None
+        encode: Optional[Callable[[bytes, bool], bytes]] = None
+        passthrough = False
+        size_in = size_out = 0
+        cpu = 0.0
+
+        def compress(data: bytes, final: bool) -> tuple[bytes, float]:
+            started = time.thread_time()
+            out = encode(data, final)
+            return out, time.thread_time() - started
+
+        async def send_compressed(message: Dict[str, Any]) -> None:
+            nonlocal start, encode, passthrough, size_in, size_out, cpu
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+            body = message.get("body", b"")
+            more = message.get("more_body", False)
+            if encode is None:
+                headers = MutableHeaders(raw=start["headers"])
+                content_type = headers.get("content-type", "")
+                if (
+                    start["status"] in (204, 304)
+                    or "content-encoding" in headers
+                    or not content_type.startswith(COMPRESSIBLE_TYPES)
+                    or content_type.startswith(UNCOMPRESSED_TYPES)
+                    or (not more and len(body) < COMPRESS_MIN_SIZE)
+                ):
+                    passthrough = True
+                    await send(start)
+                    await send(message)
+                    return
+                encode = ENCODERS[encoding]()
+                headers["Content-Encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                del headers["Content-Length"]
+            if len(body) >= COMPRESS_THREAD_SIZE:
+                chunk, spent = await anyio.to_thread.run_sync(compress, body, not more)
+            else:
+                chunk, spent = compress(body, not more)
+            size_in += len(body)
+            size_out += len(chunk)
+            cpu += spent
+            if start is not None:
+                if not more:
+                    MutableHeaders(raw=start["headers"])["Content-Length"] = str(len(chunk))
+                await send(start)
+                start = None
+            await send({"type": "http.response.body", "body": chunk, "more_body": more})
+
+        await self.app(scope, receive, send_compressed)
+        route = scope.get("route")
+        _record_compression(getattr(route, "path", scope["path"]), encoding if encode else None, size_in, size_out, cpu)
+
+
+# Порядок: CORS -> сжатие -> условные GET -> приложение
+# (добавляются до CORS, чтобы CORS-заголовки получали и ответы 304)
+app.add_middleware(_ConditionalGetMiddleware)
+app.add_middleware(_CompressionMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=list({o for o in origins if o}),
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Revision", "ETag"],
 )
 
 # Статика для загруженных файлов счетов
@@ -54,19 +326,311 @@ app.mount("/files", StaticFiles(directory=UPLOAD_DIR), name="files")
 app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
 
 
+# ===== Пул соединений SQLite =====
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "16"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_CACHE_KB = int(os.getenv("DB_CACHE_KB", "32768"))
+
+
 def _connect() -> sqlite3.Connection:
-    con = sqlite3.connect(DB_PATH)
+    """Открывает новое соединение и один раз применяет прагмы."""
+    con = sqlite3.connect(DB_PATH, timeout=DB_POOL_TIMEOUT, check_same_thread=False)
     con.row_factory = sqlite3.Row
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    con.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+    con.execute("PRAGMA temp_store=MEMORY")
     return con
 
 
+def _on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class _ConnectionPool:
+    """Переиспользуемые соединения SQLite, не больше max_size одновременно.
+
+    Соединение открывается один раз и возвращается в пул после запроса, поэтому
+    обработчики не платят за открытие файла и разбор схемы. На время запроса
+    соединение привязано к потоку: вложенные ``with _db()`` получают то же
+    соединение, а фиксация/откат выполняются на внешнем уровне.
+    """
+
+    def __init__(self, max_size: int, timeout: float) -> None:
+        self.max_size = max_size
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._idle: List[sqlite3.Connection] = []
+        self._all: List[sqlite3.Connection] = []
+        self._in_use = 0
+        self._checkouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _take(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        con = _connect()
+        with self._lock:
+            self._all.append(con)
+        return con
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        depth = getattr(self._local, "depth", 0)
+        if depth:
+            self._local.depth = depth + 1
+            try:
+                yield self._local.con
+            finally:
+                self._local.depth = depth
+            return
+
+        self._acquire()
+        con: Optional[sqlite3.Connection] = None
+        committed = False
+        self._local.deferred = []
+        try:
+            con = self._take()
+            self._local.con = con
+            self._local.depth = 1
+            try:
+                yield con
+            except BaseException:
+                con.rollback()
+                raise
+            else:
+                con.commit()
+                committed = True
+        finally:
+            deferred, self._local.deferred = self._local.deferred, None
+            self._local.depth = 0
+            self._local.con = None
+            self._release(con)
+            for fn in deferred:
+                fn(committed)
+
+    @contextmanager
+    def detached(self) -> Iterator[sqlite3.Connection]:
+        """Соединение без привязки к потоку — для генераторов стриминга,
+        которые возобновляются в разных потоках. Только чтение: в конце rollback.
+        """
+        self._acquire()
+        con: Optional[sqlite3.Connection] = None
+        try:
+            con = self._take()
+            yield con
+        finally:
+            if con is not None:
+                con.rollback()
+            self._release(con)
+
+    def _acquire(self) -> None:
+        started = time.perf_counter()
+        # В потоке event loop ждать слот нельзя: встал бы весь сервер, включая
+        # стримы, которые слоты и освобождают. async-обработчики ходят в базу
+        # через run_in_threadpool, здесь — только защита от пропущенных мест.
+        timeout = 0 if _on_event_loop() else self.timeout
+        if not self._slots.acquire(timeout=timeout):
+            raise HTTPException(status_code=503, detail="Database pool exhausted")
+        waited = time.perf_counter() - started
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+
+    def _release(self, con: Optional[sqlite3.Connection]) -> None:
+        with self._lock:
+            if con is not None:
+                self._idle.append(con)
+            self._in_use -= 1
+        self._slots.release()
+
+    def defer(self, fn: Callable[[bool], None]) -> None:
+        """Вызвать fn(committed) после завершения внешнего ``with _db()``.
+
+        Вне запроса к пулу fn вызывается сразу с committed=True.
+        """
+        deferred = getattr(self._local, "deferred", None)
+        if deferred is None:
+            fn(True)
+        else:
+            deferred.append(fn)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "max_size": self.max_size,
+                "size": len(self._all),
+                "in_use": self._in_use,
+                "checkouts": self._checkouts,
+                "wait_ms_total": round(self._wait_total * 1000, 3),
+                "wait_ms_avg": round(self._wait_total * 1000 / self._checkouts, 3) if self._checkouts else 0.0,
+                "wait_ms_max": round(self._wait_max * 1000, 3),
+            }
+
+    def close_all(self) -> None:
+        with self._lock:
+            conns, self._all, self._idle = self._all, [], []
+        for con in conns:
+            try:
+                con.close()
+            except Exception:
+                pass
+
+
+_POOL = _ConnectionPool(DB_POOL_SIZE, DB_POOL_TIMEOUT)
+
+
+def _db() -> ContextManager[sqlite3.Connection]:
+    """Соединение из пула: commit при успехе, rollback при исключении."""
+    return _POOL.connection()
+
+
+@app.on_event("shutdown")
+def _close_pool() -> None:
+    _POOL.close_all()
+
+
+# ===== Хуки записи =====
+
+# Подписчики на изменения строк: table -> [hook(cur, table, row_id, op)].
+# Обработчики вызывают _after_write() после INSERT/UPDATE/DELETE в той же транзакции,
+# так что производные таблицы обновляются атомарно с исходной записью.
+_WRITE_HOOKS: Dict[str, List[Callable[[sqlite3.Cursor, str, int, str], None]]] = {}
+
+
+def _on_write(*tables: str) -> Callable:
+    def register(fn: Callable[[sqlite3.Cursor, str, int, str], None]) -> Callable:
+        for table in tables:
+            _WRITE_HOOKS.setdefault(table, []).append(fn)
+        return fn
+    return register
+
+
+def _after_write(cur: sqlite3.Cursor, table: str, row_id: Optional[int], op: str) -> None:
+    """op: insert | update | delete.
+
+    Хуки получают отдельный курсор того же соединения: rowcount/lastrowid
+    курсора обработчика остаются нетронутыми.
+    """
+    if row_id is None:
+        return
+    hooks = _WRITE_HOOKS.get(table)
+    if not hooks:
+        return
+    hook_cur = cur.connection.cursor()
+    for hook in hooks:
+        hook(hook_cur, table, int(row_id), op)
+
+
 def _rows_to_dicts(rows: List[sqlite3.Row]) -> List[Dict[str, Any]]:
     return [dict(r) for r in rows]
 
 
+class FastJSONResponse(JSONResponse):
+    """JSONResponse на orjson; без orjson — обычный json."""
+
+    def render(self, content: Any) -> bytes:
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content)
+
+
+class RowsResponse(FastJSONResponse):
+    """Массив объектов прямо из курсора, без sqlite3.Row и промежуточного списка dict.
+
+    Принимает курсор после execute (строки читаются кортежами) или готовые
+    кортежи с ``columns``. Имена колонок берутся один раз из description,
+    ``exclude`` убирает служебные колонки. Вывод совпадает с
+    ``JSONResponse(_rows_to_dicts(...))``.
+    """
+
+    def __init__(
+        self,
+        rows: sqlite3.Cursor | List[tuple],
+        columns: Optional[List[str]] = None,
+        *,
+        exclude: tuple[str, ...] = (),
+        status_code: int = 200,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        if isinstance(rows, sqlite3.Cursor):
+            columns = [d[0] for d in rows.description]
+            rows.row_factory = None
+            rows = rows.fetchall()
+        self._columns = columns or []
+        self._exclude = exclude
+        super().__init__(rows, status_code=status_code, headers=headers)
+
+    def render(self, content: Any) -> bytes:
+        cols = self._columns
+        if self._exclude:
+            keep = [i for i, c in enumerate(cols) if c not in self._exclude]
+            cols = [cols[i] for i in keep]
+            content = ([row[i] for i in keep] for row in content)
+        return super().render([dict(zip(cols, row)) for row in content])
+
+
+# ===== Потоковая выдача (NDJSON) =====
+
+STREAM_BATCH = int(os.getenv("STREAM_BATCH", "500"))
+NDJSON = "application/x-ndjson"
+
+
+def _json_bytes(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _wants_stream(request: Request) -> bool:
+    return request.query_params.get("stream") in ("1", "true") or NDJSON in request.headers.get("accept", "")
+
+
+def _stream_rows(
+    sql: str,
+    params: tuple | List[Any] = (),
+    *,
+    exclude: tuple[str, ...] = (),
+    headers: Optional[Dict[str, str]] = None,
+) -> StreamingResponse:
+    """Отдаёт результат запроса построчно в NDJSON, читая курсор пачками fetchmany.
+
+    Запрос выполняется уже при отправке ответа на отдельном соединении пула,
+    так что в памяти одновременно не больше STREAM_BATCH строк.
+    """
+    def generate() -> Iterator[bytes]:
+        with _POOL.detached() as con:
+            cur = con.cursor()
+            cur.row_factory = None
+            cur.execute(sql, params)
+            cols = [d[0] for d in cur.description]
+            keep = [i for i, c in enumerate(cols) if c not in exclude]
+            names = [cols[i] for i in keep]
+            while True:
+                batch = cur.fetchmany(STREAM_BATCH)
+                if not batch:
+                    break
+                yield b"".join(_json_bytes(dict(zip(names, [row[i] for i in keep]))) + b"\n" for row in batch)
+
+    return StreamingResponse(generate(), media_type=NDJSON, headers=headers)
+
+
 def _init_schema() -> None:
     """Создаём недостающие таблицы, если их нет."""
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         # Номенклатура
         cur.execute(
@@ -377,6 +941,10 @@ def _init_schema() -> None:
             add_cols.append("ALTER TABLE purchases ADD COLUMN payment_status TEXT")
         if 'due_date' not in cols:
             add_cols.append("ALTER TABLE purchases ADD COLUMN due_date TEXT")
+        # Нормализованный ключ материала (_material_key), заполняется хуком записи
+        for col in ("item_key", "unit_norm", "type_norm"):
+            if col not in cols:
+                add_cols.append(f"ALTER TABLE purchases ADD COLUMN {col} TEXT")
         for stmt in add_cols:
             try:
                 cur.execute(stmt)
@@ -627,9 +1195,292 @@ def _init_schema() -> None:
             except Exception:
                 pass
         
+        # Сводный финансовый журнал (поддерживается хуками записи)
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS finance_ledger (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                source TEXT NOT NULL,
+                source_id INTEGER NOT NULL,
+                date TEXT NOT NULL DEFAULT '',
+                doc_date TEXT,
+                kind TEXT,
+                category TEXT,
+                amount REAL,
+                object_id INTEGER,
+                user_id INTEGER,
+                counterparty TEXT,
+                description TEXT,
+                status TEXT,
+                UNIQUE (source, source_id)
+            )
+            """
+        )
+
+        # Журнал изменений для ?since=<revision>: глобальный счётчик ревизий
+        # и последняя ревизия каждой строки (deleted=1 — надгробие)
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sync_revision (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                value INTEGER NOT NULL
+            )
+            """
+        )
+        cur.execute("INSERT OR IGNORE INTO sync_revision(id, value) VALUES (1, 0)")
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS row_changes (
+                table_name TEXT NOT NULL,
+                row_id INTEGER NOT NULL,
+                revision INTEGER NOT NULL,
+                deleted INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (table_name, row_id)
+            ) WITHOUT ROWID
+            """
+        )
+
+        # Складские остатки по нормализованному ключу (item, unit, type) и
+        # движения, из которых они сложены (по одному на закупку/списание)
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS stock_balances (
+                item_key TEXT NOT NULL,
+                unit_norm TEXT NOT NULL,
+                type_norm TEXT NOT NULL,
+                item TEXT,
+                unit TEXT,
+                type TEXT,
+                in_qty REAL NOT NULL DEFAULT 0,
+                out_qty REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (item_key, unit_norm, type_norm)
+            ) WITHOUT ROWID
+            """
+        )
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS stock_moves (
+                purchase_id INTEGER PRIMARY KEY,
+                item_key TEXT NOT NULL,
+                unit_norm TEXT NOT NULL,
+                type_norm TEXT NOT NULL,
+                qty REAL NOT NULL,
+                date TEXT
+            )
+            """
+        )
+        # Снимки остатков на конец месяца для ?as_of=
+        cur.execute("CREATE TABLE IF NOT EXISTS stock_snapshot_days (day TEXT PRIMARY KEY)")
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS stock_snapshots (
+                day TEXT NOT NULL,
+                item_key TEXT NOT NULL,
+                unit_norm TEXT NOT NULL,
+                type_norm TEXT NOT NULL,
+                in_qty REAL NOT NULL DEFAULT 0,
+                out_qty REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, item_key, unit_norm, type_norm)
+            ) WITHOUT ROWID
+            """
+        )
+        # Дневные факты по сотрудникам (см. _refresh_daily_fact), прежний ключ
+        # каждой строки-источника и очередь ключей, изменённых вне API
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS daily_user_facts (
+                user_id INTEGER NOT NULL,
+                day TEXT NOT NULL,
+                tasks_total INTEGER NOT NULL DEFAULT 0,
+                tasks_completed INTEGER NOT NULL DEFAULT 0,
+                tasks_in_progress INTEGER NOT NULL DEFAULT 0,
+                labor_cost REAL NOT NULL DEFAULT 0,
+                advances REAL NOT NULL DEFAULT 0,
+                withholdings REAL NOT NULL DEFAULT 0,
+                bonuses REAL NOT NULL DEFAULT 0,
+                materials_cost REAL NOT NULL DEFAULT 0,
+                tracked INTEGER NOT NULL DEFAULT 0,
+                worked_hours REAL,
+                check_in_time TEXT,
+                check_out_time TEXT,
+                PRIMARY KEY (user_id, day)
+            ) WITHOUT ROWID
+            """
+        )
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS daily_fact_sources (
+                table_name TEXT NOT NULL,
+                row_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                day TEXT NOT NULL,
+                PRIMARY KEY (table_name, row_id)
+            ) WITHOUT ROWID
+            """
+        )
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS daily_facts_dirty (
+                user_id INTEGER NOT NULL,
+                day TEXT NOT NULL,
+                PRIMARY KEY (user_id, day)
+            ) WITHOUT ROWID
+            """
+        )
+        # time_tracking заполняется мимо API (прямой записью в базу): хуки его
+        # не видят, поэтому изменённые ключи отмечают триггеры
+        for event, refs in (("INSERT", ("NEW",)), ("UPDATE", ("OLD", "NEW")), ("DELETE", ("OLD",))):
+            marks = " ".join(
+                f"INSERT OR IGNORE INTO daily_facts_dirty(user_id, day) "
+                f"SELECT {r}.user_id, DATE({r}.date) WHERE {r}.user_id IS NOT NULL AND DATE({r}.date) IS NOT NULL;"
+                for r in refs
+            )
+            cur.execute(
+                f"CREATE TRIGGER IF NOT EXISTS trg_time_tracking_facts_{event.lower()} "
+                f"AFTER {event} ON time_tracking BEGIN {marks} END"
+            )
+        # Себестоимость: слои прихода (цена за единицу и неизрасходованный
+        # остаток) и стоимость каждого списания на объект
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS cost_layers (
+                purchase_id INTEGER PRIMARY KEY,
+                item_key TEXT NOT NULL,
+                unit_norm TEXT NOT NULL,
+                type_norm TEXT NOT NULL,
+                date TEXT,
+                qty REAL NOT NULL,
+                unit_cost REAL NOT NULL DEFAULT 0,
+                remaining REAL NOT NULL
+            )
+            """
+        )
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS cost_allocations (
+                purchase_id INTEGER PRIMARY KEY,
+                item_key TEXT NOT NULL,
+                unit_norm TEXT NOT NULL,
+                type_norm TEXT NOT NULL,
+                object_id INTEGER,
+                user_id INTEGER,
+                date TEXT,
+                qty REAL NOT NULL,
+                cost REAL NOT NULL DEFAULT 0
+            )
+            """
+        )
+
         con.commit()
 
 
+# ===== Индексы =====
+
+# Версия набора индексов: увеличиваем при любом изменении MANAGED_INDEXES,
+# тогда _apply_indexes() удалит устаревшие ix_* и создаст актуальные.
+INDEX_SET_VERSION = 10
+
+MANAGED_INDEXES: List[tuple[str, str]] = [
+    # Задачи: выборки по исполнителю и рабочему дню, просрочка
+    ("ix_tasks_assignee_day", "tasks(assignee_id, DATE(COALESCE(work_date, created_at)))"),
+    ("ix_tasks_object", "tasks(object_id)"),
+    ("ix_tasks_status", "tasks(status)"),
+    ("ix_tasks_open_deadline", "tasks(completed_at, deadline)"),
+    # Закупки/склад
+    ("ix_purchases_status", "purchases(status)"),
+    ("ix_purchases_material_key", "purchases(item_key, unit_norm, type_norm, status)"),
+    ("ix_stock_moves_date", "stock_moves(date)"),
+    ("ix_stock_moves_key", "stock_moves(item_key, unit_norm, type_norm, date)"),
+    ("ix_purchases_supplier", "purchases(supplier_id)"),
+    # Себестоимость: слои по ключу материала (открытые — отдельным частичным индексом)
+    ("ix_cost_layers_key", "cost_layers(item_key, unit_norm, type_norm, date)"),
+    ("ix_cost_layers_open", "cost_layers(item_key, unit_norm, type_norm, date) WHERE remaining > 0"),
+    ("ix_cost_allocations_key", "cost_allocations(item_key, unit_norm, type_norm)"),
+    ("ix_cost_allocations_object", "cost_allocations(object_id, date, cost)"),
+    ("ix_cost_allocations_date_object", "cost_allocations(date, object_id)"),
+    # Оплаты по источнику
+    ("ix_payments_source", "payments(source_type, source_id, amount)"),
+    # Списания материалов
+    ("ix_wc_user_day", "warehouse_consumption(user_id, DATE(consumption_date))"),
+    ("ix_wc_object", "warehouse_consumption(object_id, consumption_date)"),
+    # Инструменты
+    ("ix_tool_assignments_user_tool", "tool_assignments(user_id, tool_id)"),
+    ("ix_tool_assignments_tool", "tool_assignments(tool_id)"),
+    # Документы
+    ("ix_documents_invoice", "documents(invoice_id)"),
+    ("ix_documents_object", "documents(object_id)"),
+    # Зарплаты и учёт времени
+    ("ix_salaries_user_day", "salaries(user_id, DATE(date))"),
+    ("ix_time_tracking_user_date", "time_tracking(user_id, date)"),
+    ("ix_timesheets_open", "timesheets(end_time, user_id)"),
+    # Касса, заявки, прочие расходы, пользователи
+    ("ix_cash_user_day", "cash_transactions(user_id, DATE(COALESCE(date, created_at)))"),
+    ("ix_purchase_requests_user_day", "purchase_requests(requested_by, DATE(created_at))"),
+    ("ix_other_expenses_day", "other_expenses(DATE(date), object_id)"),
+    ("ix_other_expenses_supplier", "other_expenses(supplier_id)"),
+    ("ix_users_archived", "users(archived_at)"),
+    # Финансовые отчёты: диапазон дат + объект
+    ("ix_invoices_date_object", "invoices(date, object_id)"),
+    ("ix_purchases_date_object", "purchases(date, object_id)"),
+    ("ix_salaries_date_object", "salaries(date, object_id)"),
+    ("ix_other_expenses_date_object", "other_expenses(date, object_id)"),
+    ("ix_cash_date_object", "cash_transactions(date, object_id)"),
+    ("ix_payments_date_object", "payments(date, object_id)"),
+    # Финансовый журнал: keyset по (date, id) и фильтры
+    ("ix_finance_ledger_date", "finance_ledger(date, id)"),
+    ("ix_finance_ledger_object", "finance_ledger(object_id, date, id)"),
+    ("ix_finance_ledger_user", "finance_ledger(user_id, date, id)"),
+    # Дневные факты: отчёты по всем сотрудникам за период
+    ("ix_daily_user_facts_day", "daily_user_facts(day)"),
+    # Журнал изменений: ?since=<revision> по таблице
+    ("ix_row_changes_revision", "row_changes(table_name, revision)"),
+    # Порядок списков, отсортированных не по id (keyset after_id)
+    ("ix_cash_order", "cash_transactions(COALESCE(date, created_at, ''), id)"),
+    ("ix_payments_order", "payments(COALESCE(date, created_at, ''), id)"),
+    ("ix_other_expenses_order", "other_expenses(COALESCE(date, created_at, ''), id)"),
+    ("ix_wc_order", "warehouse_consumption(consumption_date, id)"),
+    ("ix_purchase_requests_order", "purchase_requests(COALESCE(created_at, ''), id)"),
+    ("ix_documents_order", "documents(COALESCE(created_at, ''), id)"),
+]
+
+
+def _schema_version(cur: sqlite3.Cursor, name: str) -> int:
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS schema_migrations (name TEXT PRIMARY KEY, version INTEGER NOT NULL, applied_at TEXT)"
+    )
+    cur.execute("SELECT version FROM schema_migrations WHERE name = ?", (name,))
+    row = cur.fetchone()
+    return int(row[0]) if row else 0
+
+
+def _set_schema_version(cur: sqlite3.Cursor, name: str, version: int) -> None:
+    cur.execute(
+        """INSERT INTO schema_migrations(name, version, applied_at) VALUES(?, ?, datetime('now'))
+           ON CONFLICT(name) DO UPDATE SET version = excluded.version, applied_at = excluded.applied_at""",
+        (name, version),
+    )
+
+
+def _apply_indexes() -> None:
+    """Приводит набор индексов ix_* к MANAGED_INDEXES, если сменилась версия."""
+    with _db() as con:
+        cur = con.cursor()
+        if _schema_version(cur, "indexes") >= INDEX_SET_VERSION:
+            return
+        wanted = {name for name, _ in MANAGED_INDEXES}
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'ix!_%' ESCAPE '!'")
+        for (name,) in cur.fetchall():
+            if name not in wanted:
+                cur.execute(f"DROP INDEX IF EXISTS {name}")
+        for name, target in MANAGED_INDEXES:
+            try:
+                cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+            except sqlite3.OperationalError as e:
+                # В старых базах может не быть таблицы/колонки — пропускаем
+                print(f"⚠️ Индекс {name} не создан: {e}")
+        _set_schema_version(cur, "indexes", INDEX_SET_VERSION)
+
+
 # Хешируем пароль с использованием SHA-256
 def hash_password(password: str) -> str:
     return hashlib.sha256(password.encode()).hexdigest()
@@ -641,7 +1492,7 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
 # Создаем пользователя с хешированным паролем при инициализации
 def _init_users() -> None:
     """Создаём пользователя, если его нет."""
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         # Создаем таблицу для хранения пользователей с хешированными паролями
         cur.execute(
@@ -671,6 +1522,7 @@ def _init_users() -> None:
 # Вызываем инициализацию пользователей при запуске
 _init_schema()
 _init_users()
+_apply_indexes()
 
 # Токены для реальных пользователей
 REAL_TOKENS = {}
@@ -688,7 +1540,7 @@ def auth_login(payload: Dict[str, Any]) -> JSONResponse:
         return JSONResponse({"token": DEMO_TOKEN, "user": DEMO_USER, "must_change_password": False})
     
     # Реальная аутентификация с хешированием пароля
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute("SELECT id, password_hash, full_name, role, force_password_change FROM auth_users WHERE username = ?", (username,))
         user_record = cur.fetchone()
@@ -739,422 +1591,1496 @@ def health() -> Dict[str, Any]:
     return {"status": "ok", "db_exists": os.path.exists(DB_PATH)}
 
 
-@app.get("/api/users/{user_id}/daily/{date}")
-def get_daily_stats(user_id: int, date: str) -> JSONResponse:
-    """Получить дневную статистику пользователя"""
-    with _connect() as con:
-        cur = con.cursor()
-        
-        print(f"📊 Получение дневной статистики для пользователя {user_id} за {date}")
-        
-        # Получаем данные пользователя
-        cur.execute("SELECT * FROM users WHERE id=?", (user_id,))
-        user_row = cur.fetchone()
-        if not user_row:
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        user_data = dict(user_row)
-        
-        # Получаем задачи за день (по полю work_date, если есть)
-        cur.execute("""
-            SELECT id, title, description, status, assignee_id, object_id, deadline, created_at, completed_at,
-                   pay_amount, pay_type, pay_rate, actual_minutes
-            FROM tasks 
-            WHERE assignee_id = ? AND DATE(COALESCE(work_date, created_at)) = ?
-        """, (user_id, date))
-        tasks = _rows_to_dicts(cur.fetchall())
-        
-        # Получаем зарплату за период (ищем по дате)
-        month_start = date[:7] + '-01'  # YYYY-MM-01
-        month_end = date[:7] + '-31'    # YYYY-MM-31
-        cur.execute("""
-            SELECT * FROM salaries 
-            WHERE user_id = ? AND DATE(date) BETWEEN ? AND ?
-        """, (user_id, month_start, month_end))
-        salary_rows = cur.fetchall()
-        salary_data = _rows_to_dicts(salary_rows)
-        
-        # Получаем заявки на закупки за день
-        cur.execute("""
-            SELECT * FROM purchase_requests
-            WHERE requested_by = ? AND DATE(created_at) = ?
-        """, (user_id, date))
-        purchase_requests = _rows_to_dicts(cur.fetchall())
-        
-        # Получаем списания материалов за день (если пользователь работал на объектах)
-        cur.execute("""
-            SELECT wc.*, o.name as object_name
-            FROM warehouse_consumption wc
-            LEFT JOIN objects o ON wc.object_id = o.id
-            WHERE wc.user_id = ? AND DATE(wc.consumption_date) = ?
-        """, (user_id, date))
-        material_consumption = _rows_to_dicts(cur.fetchall())
-        
-        # Получаем прочие расходы за день
-        cur.execute("""
-            SELECT oe.*, o.name as object_name
-            FROM other_expenses oe
-            LEFT JOIN objects o ON oe.object_id = o.id
-            WHERE DATE(oe.date) = ? AND object_id IN (
-                SELECT DISTINCT object_id FROM tasks WHERE assignee_id = ? AND DATE(COALESCE(work_date, created_at)) = ?
-            )
-        """, (date, user_id, date))
-        other_expenses = _rows_to_dicts(cur.fetchall())
-        
-        # Получаем объекты, на которых пользователь работал именно в этот день
-        cur.execute("""
-            SELECT DISTINCT o.* FROM objects o
-            INNER JOIN tasks t ON o.id = t.object_id
-            WHERE t.assignee_id = ? AND DATE(COALESCE(t.work_date, t.created_at)) = ?
-        """, (user_id, date))
-        user_objects = _rows_to_dicts(cur.fetchall())
-        
-        # Получаем учет времени за день
-        cur.execute("""
-            SELECT * FROM time_tracking
-            WHERE user_id = ? AND date = ?
-        """, (user_id, date))
-        time_tracking_data = _rows_to_dicts(cur.fetchall())
-        
-        # Получаем инструменты, которые были у пользователя в этот день (кто выдал)
-        cur.execute("""
-            SELECT ta.*, t.name as tool_name, t.type as tool_type, t.serial_number,
-                   u.full_name as assigned_by_name, u.username as assigned_by_username
-            FROM tool_assignments ta
-            INNER JOIN tools t ON ta.tool_id = t.id
-            LEFT JOIN users u ON ta.assigned_by = u.id
-            WHERE ta.user_id = ? 
-              AND DATE(ta.assigned_date) <= ? 
-              AND (ta.returned_date IS NULL OR DATE(ta.returned_date) > ?)
-        """, (user_id, date, date))
-        active_tools = _rows_to_dicts(cur.fetchall())
-
-        # Касса за день для пользователя (авансы/удержания/бонусы и т.п.)
-        cur.execute("""
-            SELECT * FROM cash_transactions
-            WHERE user_id = ? AND DATE(COALESCE(date, created_at)) = ?
-        """, (user_id, date))
-        cash_rows = _rows_to_dicts(cur.fetchall())
-
-        def _sum_if(rows, pred):
-            total = 0.0
-            for r in rows:
-                try:
-                    if pred(r):
-                        total += float(r.get("amount") or 0)
-                except Exception:
-                    pass
-            return total
+@app.get("/api/health/db")
+def health_db() -> Dict[str, Any]:
+    """Метрики пула соединений: размер, занятость, ожидание слота."""
+    return {"pool": _POOL.stats()}
 
-        def _lower(val):
-            return str(val or "").lower()
 
-        advances_sum = _sum_if(
-            cash_rows,
-            lambda r: _lower(r.get("type")) in ("advance", "аванс")
-                     or "аванс" in _lower(r.get("category"))
-                     or "advance" in _lower(r.get("category")),
-        )
-        withholdings_sum = _sum_if(
-            cash_rows,
-            lambda r: _lower(r.get("type")) in ("withhold", "удержание", "penalty")
-                     or "удерж" in _lower(r.get("category"))
-                     or "штраф" in _lower(r.get("category")),
-        )
-        bonuses_sum = _sum_if(
-            cash_rows,
-            lambda r: _lower(r.get("type")) == "bonus" or "бонус" in _lower(r.get("category")),
-        )
+@app.get("/api/health/compression")
+def health_compression() -> Dict[str, Any]:
+    """Сжатие ответов по маршрутам: доля сжатых, коэффициент, CPU на сжатие."""
+    return {"encodings": list(ENCODERS), "min_size": COMPRESS_MIN_SIZE, "routes": _compression_stats()}
 
-        # Себестоимость труда за день (сдельно/почасово/фикс)
-        labor_cost = 0.0
-        for t in tasks:
-            pa = t.get("pay_amount")
-            if pa is not None:
-                try:
-                    labor_cost += float(pa or 0)
-                    continue
-                except Exception:
-                    pass
-            pay_type = t.get("pay_type")
-            rate = t.get("pay_rate")
-            minutes = t.get("actual_minutes")
-            try:
-                if pay_type == "hourly" and rate is not None and minutes is not None:
-                    labor_cost += float(rate) * (float(minutes) / 60.0)
-            except Exception:
-                pass
 
-        # Себестоимость материалов (фактические списания)
-        materials_cost = 0.0
-        for m in material_consumption:
-            try:
-                materials_cost += float(m.get("total_amount") or 0)
-            except Exception:
-                pass
+# ===== Дневная статистика пользователя =====
 
-        # Прочие расходы по объектам дня
-        other_cost = 0.0
-        for e in other_expenses:
-            try:
-                other_cost += float(e.get("amount") or 0)
-            except Exception:
-                pass
+PLANNED_HOURS = 8  # Стандартный рабочий день
+WORK_DAYS_PER_MONTH = 22
+DAILY_FACTS_VERSION = 1
 
-        total_cost = labor_cost + advances_sum + withholdings_sum + materials_cost + other_cost
-        
-        # Вычисляем базовую статистику
-        completed_tasks = [t for t in tasks if t.get('status') == 'completed']
-        in_progress_tasks = [t for t in tasks if t.get('status') == 'in_progress']
-        
-        # Базовая дневная зарплата (если есть месячная зарплата)
-        daily_earnings = 0
-        if salary_data:
-            monthly_salary = salary_data[0].get('amount', 0)
-            daily_earnings = monthly_salary / 22  # Рабочие дни в месяце
-        
-        # Вычисляем примерное время работы
-        planned_hours = 8  # Стандартный рабочий день
-        worked_hours = len(completed_tasks) * 1.5 + len(in_progress_tasks) * 0.5  # Примерный расчет
-        
-        # Получаем время из time_tracking или вычисляем примерно
-        actual_hours = 0
-        check_in_time = None
-        check_out_time = None
-        
-        if time_tracking_data:
-            time_data = time_tracking_data[0]
-            actual_hours = time_data.get('total_hours', 0)
-            check_in_time = time_data.get('check_in_time')
-            check_out_time = time_data.get('check_out_time')
-        else:
-            # Примерно вычисляем время по задачам
-            actual_hours = len(completed_tasks) * 1.5 + len(in_progress_tasks) * 0.5
-
-        # Формируем ответ
-        stats = {
-            "user": user_data,
-            "date": date,
-            "work_stats": {
-                "planned_hours": planned_hours,
-                "worked_hours": actual_hours,
-                "check_in_time": check_in_time,
-                "check_out_time": check_out_time,
-                "tasks_total": len(tasks),
-                "tasks_completed": len(completed_tasks),
-                "tasks_in_progress": len(in_progress_tasks),
-                "efficiency": round((len(completed_tasks) / len(tasks) * 100), 1) if tasks else 0,
-                "daily_earnings": round(daily_earnings, 2),
-                "idle_time": max(0, planned_hours - actual_hours),
-                "smoke_breaks": 2,  # Мок данные, можно добавить таблицу для отслеживания
-                "overtime": max(0, actual_hours - planned_hours)
-            },
-            "tasks": tasks,
-            "materials": {
-                "requests": purchase_requests,
-                "consumption": material_consumption
-            },
-            "tools": active_tools,
-            "time_tracking": time_tracking_data,
-            "finances": {
-                "salary": salary_data,
-                "expenses": other_expenses,
-                "daily_earnings": round(daily_earnings, 2)
-            },
-            "costs": {
-                "labor": round(labor_cost, 2),
-                "advances": round(advances_sum, 2),
-                "withholdings": round(withholdings_sum, 2),
-                "bonuses": round(bonuses_sum, 2),
-                "materials": round(materials_cost, 2),
-                "other_expenses": round(other_cost, 2),
-                "total": round(total_cost, 2)
-            },
-            "household": {
-                "accommodation_type": user_data.get('accommodation_type'),
-                "accommodation_address": user_data.get('accommodation_address'),
-                "room_number": user_data.get('room_number'),
-                "meals_included": user_data.get('meals_included'),
-                "transport_provided": user_data.get('transport_provided'),
-                "transport_type": user_data.get('transport_type'),
-                "utilities_included": user_data.get('utilities_included')
-            },
-            "personal": {
-                "clothing_size": user_data.get('clothing_size'),
-                "shoe_size": user_data.get('shoe_size'),
-                "position": user_data.get('position'),
-                "department": user_data.get('department'),
-                "status": user_data.get('status'),
-                "age": user_data.get('age'),
-                "gender": user_data.get('gender'),
-                "bad_habits": user_data.get('bad_habits')
-            },
-            "objects": user_objects
-        }
-        
-        print(f"✅ Статистика получена: {len(tasks)} задач, {len(material_consumption)} материалов, {len(user_objects)} объектов")
-        return JSONResponse(stats)
 
+def _lower(val: Any) -> str:
+    return str(val or "").lower()
 
-@app.get("/api/objects")
-def get_objects() -> JSONResponse:
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute("SELECT * FROM objects ORDER BY id DESC")
-        return JSONResponse(_rows_to_dicts(cur.fetchall()))
 
+def _sum_amounts(rows: List[Dict[str, Any]], pred: Callable[[Dict[str, Any]], bool], field: str = "amount") -> float:
+    total = 0.0
+    for r in rows:
+        try:
+            if pred(r):
+                total += float(r.get(field) or 0)
+        except (TypeError, ValueError):
+            pass
+    return total
+
+
+def _is_advance(r: Dict[str, Any]) -> bool:
+    return (_lower(r.get("type")) in ("advance", "аванс")
+            or "аванс" in _lower(r.get("category"))
+            or "advance" in _lower(r.get("category")))
+
+
+def _is_withholding(r: Dict[str, Any]) -> bool:
+    return (_lower(r.get("type")) in ("withhold", "удержание", "penalty")
+            or "удерж" in _lower(r.get("category"))
+            or "штраф" in _lower(r.get("category")))
+
+
+def _is_bonus(r: Dict[str, Any]) -> bool:
+    return _lower(r.get("type")) == "bonus" or "бонус" in _lower(r.get("category"))
+
+
+# --- Факты дня: daily_user_facts по ключу (user_id, day) ---
+#
+# Задачи, касса и ручные списания пишутся через API: хук пересчитывает строку
+# факта при каждой записи, а daily_fact_sources помнит прежний ключ строки
+# источника (как stock_moves для остатков). У time_tracking нет записи через
+# API, поэтому его изменения триггеры складывают в daily_facts_dirty, а
+# читатели досчитывают эти ключи перед чтением.
+
+# Ключ (user_id, day) строки источника — так же, как в выборках дневной статистики
+_FACT_KEY_SQL: Dict[str, str] = {
+    "tasks": "SELECT assignee_id, DATE(COALESCE(work_date, created_at)) FROM tasks WHERE id = ?",
+    "cash_transactions": "SELECT user_id, DATE(COALESCE(date, created_at)) FROM cash_transactions WHERE id = ?",
+    "warehouse_consumption": "SELECT user_id, DATE(consumption_date) FROM warehouse_consumption WHERE id = ?",
+}
+
+# То же для всех строк — первичное заполнение daily_fact_sources
+_FACT_REBUILD_SQL: Dict[str, str] = {
+    "tasks": "SELECT id, assignee_id AS user_id, DATE(COALESCE(work_date, created_at)) AS day FROM tasks",
+    "cash_transactions": "SELECT id, user_id, DATE(COALESCE(date, created_at)) AS day FROM cash_transactions",
+    "warehouse_consumption": "SELECT id, user_id, DATE(consumption_date) AS day FROM warehouse_consumption",
+}
+
+# Пересчёт одного ключа — индексные выборки по (user_id, day)
+_FACT_SQL: Dict[str, str] = {
+    "tasks": """
+        SELECT COUNT(*) AS total,
+               COALESCE(SUM(status = 'completed'), 0) AS completed,
+               COALESCE(SUM(status = 'in_progress'), 0) AS in_progress,
+               COALESCE(SUM(CASE
+                   WHEN pay_amount IS NOT NULL THEN pay_amount
+                   WHEN pay_type = 'hourly' AND pay_rate IS NOT NULL AND actual_minutes IS NOT NULL
+                       THEN pay_rate * (actual_minutes / 60.0)
+                   ELSE 0
+               END), 0) AS labor
+        FROM tasks
+        WHERE assignee_id = ? AND DATE(COALESCE(work_date, created_at)) = ?
+    """,
+    "cash": "SELECT type, category, amount FROM cash_transactions WHERE user_id = ? AND DATE(COALESCE(date, created_at)) = ?",
+    "consumption": """
+        SELECT COUNT(*) AS rows, COALESCE(SUM(total_amount), 0) AS total
+        FROM warehouse_consumption
+        WHERE user_id = ? AND DATE(consumption_date) = ?
+    """,
+    "time_tracking": """
+        SELECT total_hours, check_in_time, check_out_time FROM time_tracking
+        WHERE user_id = ? AND date = ?
+        ORDER BY id
+        LIMIT 1
+    """,
+}
+
+
+def _refresh_daily_fact(cur: sqlite3.Cursor, user_id: int, day: str) -> None:
+    """Пересчитывает строку daily_user_facts; ключ без данных удаляется."""
+    key = (user_id, day)
+    cur.execute(_FACT_SQL["tasks"], key)
+    tasks = cur.fetchone()
+    cur.execute(_FACT_SQL["cash"], key)
+    cash_rows = _rows_to_dicts(cur.fetchall())
+    cur.execute(_FACT_SQL["consumption"], key)
+    consumption = cur.fetchone()
+    cur.execute(_FACT_SQL["time_tracking"], key)
+    tracked = cur.fetchone()
+    if not (tasks["total"] or cash_rows or consumption["rows"] or tracked):
+        cur.execute("DELETE FROM daily_user_facts WHERE user_id = ? AND day = ?", key)
+        return
+    cur.execute(
+        """
+        INSERT INTO daily_user_facts(
+            user_id, day, tasks_total, tasks_completed, tasks_in_progress, labor_cost,
+            advances, withholdings, bonuses, materials_cost,
+            tracked, worked_hours, check_in_time, check_out_time
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id, day) DO UPDATE SET
+            tasks_total = excluded.tasks_total, tasks_completed = excluded.tasks_completed,
+            tasks_in_progress = excluded.tasks_in_progress, labor_cost = excluded.labor_cost,
+            advances = excluded.advances, withholdings = excluded.withholdings, bonuses = excluded.bonuses,
+            materials_cost = excluded.materials_cost, tracked = excluded.tracked,
+            worked_hours = excluded.worked_hours, check_in_time = excluded.check_in_time,
+            check_out_time = excluded.check_out_time
+        """,
+        (
+            user_id, day, tasks["total"], tasks["completed"], tasks["in_progress"], float(tasks["labor"]),
+            _sum_amounts(cash_rows, _is_advance),
+            _sum_amounts(cash_rows, _is_withholding),
+            _sum_amounts(cash_rows, _is_bonus),
+            float(consumption["total"]),
+            1 if tracked else 0,
+            tracked["total_hours"] if tracked else None,
+            tracked["check_in_time"] if tracked else None,
+            tracked["check_out_time"] if tracked else None,
+        ),
+    )
 
-@app.get("/api/users")
-def get_users(include_archived: bool = False) -> JSONResponse:
-    with _connect() as con:
-        cur = con.cursor()
-        if include_archived:
-            cur.execute("SELECT * FROM users ORDER BY id DESC")
-        else:
-            cur.execute("SELECT * FROM users WHERE archived_at IS NULL ORDER BY id DESC")
-        return JSONResponse(_rows_to_dicts(cur.fetchall()))
 
-@app.get("/api/users/archived")
-def get_archived_users() -> JSONResponse:
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute("SELECT * FROM users WHERE archived_at IS NOT NULL ORDER BY archived_at DESC, id DESC")
-        return JSONResponse(_rows_to_dicts(cur.fetchall()))
+@_on_write(*_FACT_KEY_SQL)
+def _daily_facts_sync(cur: sqlite3.Cursor, table: str, row_id: int, op: str) -> None:
+    """Пересчёт фактов прежнего и нового дня строки — в той же транзакции."""
+    cur.execute("SELECT user_id, day FROM daily_fact_sources WHERE table_name = ? AND row_id = ?", (table, row_id))
+    keys = {tuple(r) for r in cur.fetchall()}
+    cur.execute("DELETE FROM daily_fact_sources WHERE table_name = ? AND row_id = ?", (table, row_id))
+    if op != "delete":
+        cur.execute(_FACT_KEY_SQL[table], (row_id,))
+        row = cur.fetchone()
+        if row and row[0] is not None and row[1]:
+            cur.execute(
+                "INSERT INTO daily_fact_sources(table_name, row_id, user_id, day) VALUES (?, ?, ?, ?)",
+                (table, row_id, row[0], row[1]),
+            )
+            keys.add((row[0], row[1]))
+    for user_id, day in keys:
+        _refresh_daily_fact(cur, user_id, day)
 
-@app.post("/api/users/{user_id}/restore")
-def restore_user(user_id: int) -> JSONResponse:
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute("UPDATE users SET archived_at = NULL, status = 'active' WHERE id = ?", (user_id,))
-        if cur.rowcount == 0:
-            raise HTTPException(status_code=404, detail="User not found")
-        con.commit()
-        cur.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-        return JSONResponse(dict(cur.fetchone()))
 
+def _flush_daily_facts(cur: sqlite3.Cursor) -> int:
+    """Досчитывает ключи из daily_facts_dirty (изменения time_tracking вне API)."""
+    cur.execute(
+        """
+        -- full-scan: очередь ключей, изменённых триггерами
+        SELECT user_id, day FROM daily_facts_dirty
+        """
+    )
+    keys = [tuple(r) for r in cur.fetchall()]
+    for user_id, day in keys:
+        _refresh_daily_fact(cur, user_id, day)
+        cur.execute("DELETE FROM daily_facts_dirty WHERE user_id = ? AND day = ?", (user_id, day))
+    return len(keys)
 
-@app.get("/api/tasks")
-def get_tasks() -> JSONResponse:
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute("SELECT * FROM tasks ORDER BY id DESC")
-        return JSONResponse(_rows_to_dicts(cur.fetchall()))
 
+def _ensure_daily_facts(con: sqlite3.Connection) -> None:
+    """Перед чтением фактов: если есть необработанные ключи — пересчитать их под блокировкой записи."""
+    cur = con.cursor()
+    cur.execute("SELECT 1 FROM daily_facts_dirty LIMIT 1")
+    if cur.fetchone():
+        with _write_tx():
+            _flush_daily_facts(cur)
 
-@app.get("/api/purchases")
-def get_purchases() -> JSONResponse:
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute("SELECT * FROM purchases ORDER BY id DESC")
-        return JSONResponse(_rows_to_dicts(cur.fetchall()))
 
+def _daily_facts_rebuild(cur: sqlite3.Cursor) -> None:
+    cur.execute("DELETE FROM daily_fact_sources")
+    cur.execute("DELETE FROM daily_user_facts")
+    cur.execute("DELETE FROM daily_facts_dirty")
+    for table, select in _FACT_REBUILD_SQL.items():
+        cur.execute(
+            f"""
+            -- full-scan: первичное заполнение
+            INSERT INTO daily_fact_sources(table_name, row_id, user_id, day)
+            SELECT ?, id, user_id, day FROM ({select})
+            WHERE user_id IS NOT NULL AND day IS NOT NULL
+            """,
+            (table,),
+        )
+    cur.execute(
+        """
+        -- full-scan: первичное заполнение
+        INSERT OR IGNORE INTO daily_facts_dirty(user_id, day)
+        SELECT user_id, day FROM daily_fact_sources
+        UNION
+        SELECT user_id, DATE(date) FROM time_tracking WHERE user_id IS NOT NULL AND DATE(date) IS NOT NULL
+        """
+    )
+    _flush_daily_facts(cur)
 
-@app.get("/api/salaries")
-def get_salaries() -> JSONResponse:
-    with _connect() as con:
+
+def _init_daily_facts() -> None:
+    with _db() as con:
         cur = con.cursor()
-        cur.execute("SELECT * FROM salaries ORDER BY id DESC")
-        return JSONResponse(_rows_to_dicts(cur.fetchall()))
+        if _schema_version(cur, "daily_user_facts") >= DAILY_FACTS_VERSION:
+            return
+        _daily_facts_rebuild(cur)
+        _set_schema_version(cur, "daily_user_facts", DAILY_FACTS_VERSION)
+
+
+def _daily_blocks(
+    fact: Optional[sqlite3.Row],
+    daily_earnings: float,
+    issued_materials_cost: float,
+    other_cost: float,
+) -> tuple[Dict[str, Any], Dict[str, float]]:
+    """Блоки work_stats и costs из строки daily_user_facts (None — день без данных).
+
+    issued_materials_cost — выдачи со склада по объектам дня, other_cost — прочие
+    расходы по тем же объектам: они зависят от объектов, а не от пользователя.
+    Выдачи показываются справочно в materials_issued и в total не входят.
+    """
+    total = fact["tasks_total"] if fact else 0
+    completed = fact["tasks_completed"] if fact else 0
+    in_progress = fact["tasks_in_progress"] if fact else 0
+    check_in_time = check_out_time = None
+    if fact and fact["tracked"]:
+        # Время — из первой записи time_tracking за день
+        actual_hours = fact["worked_hours"] or 0
+        check_in_time = fact["check_in_time"]
+        check_out_time = fact["check_out_time"]
+    else:
+        # Примерно вычисляем время по задачам
+        actual_hours = completed * 1.5 + in_progress * 0.5
+    work_stats = {
+        "planned_hours": PLANNED_HOURS,
+        "worked_hours": actual_hours,
+        "check_in_time": check_in_time,
+        "check_out_time": check_out_time,
+        "tasks_total": total,
+        "tasks_completed": completed,
+        "tasks_in_progress": in_progress,
+        "efficiency": round((completed / total * 100), 1) if total else 0,
+        "daily_earnings": round(daily_earnings, 2),
+        "idle_time": max(0, PLANNED_HOURS - actual_hours),
+        "smoke_breaks": 2,  # Мок данные, можно добавить таблицу для отслеживания
+        "overtime": max(0, actual_hours - PLANNED_HOURS),
+    }
+    labor = fact["labor_cost"] if fact else 0.0
+    advances = fact["advances"] if fact else 0.0
+    withholdings = fact["withholdings"] if fact else 0.0
+    bonuses = fact["bonuses"] if fact else 0.0
+    materials = fact["materials_cost"] if fact else 0.0
+    total_cost = labor + advances + withholdings + materials + other_cost
+    costs = {
+        "labor": round(labor, 2),
+        "advances": round(advances, 2),
+        "withholdings": round(withholdings, 2),
+        "bonuses": round(bonuses, 2),
+        "materials": round(materials, 2),
+        "materials_issued": round(issued_materials_cost, 2),
+        "other_expenses": round(other_cost, 2),
+        "total": round(total_cost, 2),
+    }
+    return work_stats, costs
+
+
+def _daily_earnings(salary_row: Optional[Dict[str, Any]]) -> float:
+    """Базовая дневная зарплата из первой месячной записи salaries."""
+    if not salary_row:
+        return 0
+    return (salary_row.get("amount") or 0) / WORK_DAYS_PER_MONTH
+
+
+# Набор запросов дневной статистики. Тексты постоянные (множество объектов
+# передаётся JSON-массивом в json_each), поэтому подготовленные выражения
+# переиспользуются из кэша соединения, а все выборки идут по индексам.
+_DAILY_SQL: Dict[str, str] = {
+    "user": "SELECT * FROM users WHERE id = ?",
+    "fact": "SELECT * FROM daily_user_facts WHERE user_id = ? AND day = ?",
+    "tasks": """
+        SELECT id, title, description, status, assignee_id, object_id, deadline, created_at, completed_at,
+               pay_amount, pay_type, pay_rate, actual_minutes
+        FROM tasks
+        WHERE assignee_id = ? AND DATE(COALESCE(work_date, created_at)) = ?
+    """,
+    "salaries": "SELECT * FROM salaries WHERE user_id = ? AND DATE(date) BETWEEN ? AND ?",
+    "requests": "SELECT * FROM purchase_requests WHERE requested_by = ? AND DATE(created_at) = ?",
+    "consumption": """
+        SELECT wc.*, o.name AS object_name
+        FROM warehouse_consumption wc
+        LEFT JOIN objects o ON wc.object_id = o.id
+        WHERE wc.user_id = ? AND DATE(wc.consumption_date) = ?
+    """,
+    "time_tracking": "SELECT * FROM time_tracking WHERE user_id = ? AND date = ?",
+    "tools": """
+        SELECT ta.*, t.name AS tool_name, t.type AS tool_type, t.serial_number,
+               u.full_name AS assigned_by_name, u.username AS assigned_by_username
+        FROM tool_assignments ta
+        INNER JOIN tools t ON ta.tool_id = t.id
+        LEFT JOIN users u ON ta.assigned_by = u.id
+        WHERE ta.user_id = ?
+          AND DATE(ta.assigned_date) <= ?
+          AND (ta.returned_date IS NULL OR DATE(ta.returned_date) > ?)
+    """,
+    # Ниже — по объектам из уже выбранных задач дня
+    "objects": "SELECT * FROM objects WHERE id IN (SELECT value FROM json_each(?))",
+    "other_expenses": """
+        SELECT oe.*, o.name AS object_name
+        FROM other_expenses oe
+        LEFT JOIN objects o ON oe.object_id = o.id
+        WHERE DATE(oe.date) = ? AND oe.object_id IN (SELECT value FROM json_each(?))
+    """,
+    "issued_cost": """
+        SELECT COALESCE(SUM(cost), 0) FROM cost_allocations
+        WHERE date = ? AND object_id IN (SELECT value FROM json_each(?))
+    """,
+}
 
 
-@app.get("/api/absences")
-def get_absences() -> JSONResponse:
-    with _connect() as con:
+@app.get("/api/users/{user_id}/daily/{date}")
+def get_daily_stats(user_id: int, date: str) -> JSONResponse:
+    """Получить дневную статистику пользователя.
+
+    Все выборки — из _DAILY_SQL в одном чтении с одного соединения. Труд, касса,
+    списания и учёт времени берутся готовыми из daily_user_facts. Объекты дня
+    берутся из уже выбранных задач: объекты, прочие расходы и выданные материалы
+    запрашиваются по этому множеству, без повторного подзапроса к tasks.
+    """
+    with _db() as con:
+        _ensure_daily_facts(con)
         cur = con.cursor()
-        cur.execute("SELECT * FROM absences ORDER BY id DESC")
-        return JSONResponse(_rows_to_dicts(cur.fetchall()))
 
+        def fetch(name: str, *params: Any) -> List[Dict[str, Any]]:
+            cur.execute(_DAILY_SQL[name], params)
+            return _rows_to_dicts(cur.fetchall())
 
-@app.get("/api/timesheets")
-def get_timesheets() -> JSONResponse:
-    with _connect() as con:
+        cur.execute(_DAILY_SQL["user"], (user_id,))
+        user_row = cur.fetchone()
+        if not user_row:
+            raise HTTPException(status_code=404, detail="User not found")
+        user_data = dict(user_row)
+
+        cur.execute(_DAILY_SQL["fact"], (user_id, date))
+        fact = cur.fetchone()
+        tasks = fetch("tasks", user_id, date)
+        # Зарплата за месяц дня
+        salary_data = fetch("salaries", user_id, date[:7] + "-01", date[:7] + "-31")
+        purchase_requests = fetch("requests", user_id, date)
+        material_consumption = fetch("consumption", user_id, date)
+        time_tracking_data = fetch("time_tracking", user_id, date)
+        # Инструменты, которые были у пользователя в этот день (кто выдал)
+        active_tools = fetch("tools", user_id, date, date)
+
+        object_ids = sorted({t["object_id"] for t in tasks if t.get("object_id") is not None})
+        user_objects: List[Dict[str, Any]] = []
+        other_expenses: List[Dict[str, Any]] = []
+        issued_materials_cost = 0.0
+        if object_ids:
+            ids_json = json.dumps(object_ids)
+            user_objects = fetch("objects", ids_json)
+            other_expenses = fetch("other_expenses", date, ids_json)
+            cur.execute(_DAILY_SQL["issued_cost"], (date, ids_json))
+            issued_materials_cost = float(cur.fetchone()[0])
+
+    daily_earnings = _daily_earnings(salary_data[0] if salary_data else None)
+    work_stats, costs = _daily_blocks(
+        fact, daily_earnings, issued_materials_cost, _sum_amounts(other_expenses, lambda r: True)
+    )
+    stats = {
+        "user": user_data,
+        "date": date,
+        "work_stats": work_stats,
+        "tasks": tasks,
+        "materials": {
+            "requests": purchase_requests,
+            "consumption": material_consumption
+        },
+        "tools": active_tools,
+        "time_tracking": time_tracking_data,
+        "finances": {
+            "salary": salary_data,
+            "expenses": other_expenses,
+            "daily_earnings": round(daily_earnings, 2)
+        },
+        "costs": costs,
+        "household": {
+            "accommodation_type": user_data.get('accommodation_type'),
+            "accommodation_address": user_data.get('accommodation_address'),
+            "room_number": user_data.get('room_number'),
+            "meals_included": user_data.get('meals_included'),
+            "transport_provided": user_data.get('transport_provided'),
+            "transport_type": user_data.get('transport_type'),
+            "utilities_included": user_data.get('utilities_included')
+        },
+        "personal": {
+            "clothing_size": user_data.get('clothing_size'),
+            "shoe_size": user_data.get('shoe_size'),
+            "position": user_data.get('position'),
+            "department": user_data.get('department'),
+            "status": user_data.get('status'),
+            "age": user_data.get('age'),
+            "gender": user_data.get('gender'),
+            "bad_habits": user_data.get('bad_habits')
+        },
+        "objects": user_objects
+    }
+    return JSONResponse(stats)
+
+
+# Те же показатели за период и по нескольким пользователям: каждый источник —
+# один запрос по всем (user_id, day), упорядоченный по этому ключу.
+_DAILY_RANGE_SQL: Dict[str, str] = {
+    "users": "SELECT id FROM users WHERE id IN (SELECT value FROM json_each(?)) ORDER BY id",
+    "facts": """
+        SELECT * FROM daily_user_facts
+        WHERE user_id IN (SELECT value FROM json_each(?)) AND day BETWEEN ? AND ?
+        ORDER BY user_id, day
+    """,
+    # Прочие расходы и выдачи со склада по объектам, где пользователь работал в этот день
+    "objects": """
+        WITH day_objects AS (
+            SELECT DISTINCT assignee_id AS user_id, DATE(COALESCE(work_date, created_at)) AS day, object_id
+            FROM tasks
+            WHERE assignee_id IN (SELECT value FROM json_each(?)) AND DATE(COALESCE(work_date, created_at)) BETWEEN ? AND ?
+              AND object_id IS NOT NULL
+        )
+        SELECT user_id, day,
+               SUM((SELECT COALESCE(SUM(oe.amount), 0) FROM other_expenses oe
+                    WHERE DATE(oe.date) = day_objects.day AND oe.object_id = day_objects.object_id)) AS other,
+               SUM((SELECT COALESCE(SUM(ca.cost), 0) FROM cost_allocations ca
+                    WHERE ca.date = day_objects.day AND ca.object_id = day_objects.object_id)) AS issued
+        FROM day_objects
+        GROUP BY user_id, day
+        ORDER BY user_id, day
+    """,
+    # Ключ — месяц: дневная ставка берётся из первой записи месяца
+    "salaries": """
+        SELECT user_id, substr(DATE(date), 1, 7) AS day, amount
+        FROM salaries
+        WHERE user_id IN (SELECT value FROM json_each(?)) AND DATE(date) BETWEEN ? AND ?
+        ORDER BY user_id, DATE(date), id
+    """,
+}
+
+DAILY_RANGE_MAX_DAYS = int(os.getenv("DAILY_RANGE_MAX_DAYS", "366"))
+
+
+class _KeyedRows:
+    """Курсор, упорядоченный по (user_id, day): отдаёт строки ключа по мере продвижения."""
+
+    def __init__(self, cur: sqlite3.Cursor) -> None:
+        self._cur = cur
+        self._next = cur.fetchone()
+
+    def take(self, user_id: int, day: str) -> List[sqlite3.Row]:
+        key = (user_id, day)
+        rows = []
+        # Ключи, которых нет в сетке дней (нестандартные даты), пропускаем
+        while self._next is not None and (self._next["user_id"], self._next["day"]) < key:
+            self._next = self._cur.fetchone()
+        while self._next is not None and (self._next["user_id"], self._next["day"]) == key:
+            rows.append(self._next)
+            self._next = self._cur.fetchone()
+        return rows
+
+
+def _parse_day(value: Optional[str], name: str) -> date:
+    try:
+        return date.fromisoformat(value or "")
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must be YYYY-MM-DD")
+
+
+def _parse_user_ids(user_ids: Optional[str]) -> Optional[List[int]]:
+    if not user_ids:
+        return None
+    try:
+        return sorted({int(v) for v in user_ids.split(",") if v.strip()})
+    except ValueError:
+        raise HTTPException(status_code=400, detail="user_ids must be a comma-separated list of integers")
+
+
+def _select_users(cur: sqlite3.Cursor, ids: Optional[List[int]]) -> List[int]:
+    """Запрошенные существующие пользователи, по умолчанию — все неархивные."""
+    if ids is None:
+        cur.execute("SELECT id FROM users WHERE archived_at IS NULL ORDER BY id")
+    else:
+        cur.execute(_DAILY_RANGE_SQL["users"], (json.dumps(ids),))
+    return [r[0] for r in cur.fetchall()]
+
+
+@app.get("/api/users/daily")
+def get_daily_stats_range(
+    user_ids: str | None = None,
+    frm: str | None = Query(None, alias="from"),
+    to: str | None = None,
+) -> StreamingResponse:
+    """work_stats/costs по дням периода для нескольких пользователей (NDJSON).
+
+    ``user_ids=1,2,3`` (по умолчанию — все неархивные), ``from``/``to`` — границы
+    включительно. Факты дня читаются диапазоном из daily_user_facts, объекты дня
+    и зарплата — по одному запросу на всех; строки сливаются по (user_id, day)
+    и отдаются потоком: по строке на пользователя и день, в том числе на дни без данных.
+    """
+    first = _parse_day(frm, "from")
+    last = _parse_day(to, "to")
+    if last < first:
+        raise HTTPException(status_code=400, detail="to must not be earlier than from")
+    if (last - first).days >= DAILY_RANGE_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Range is limited to {DAILY_RANGE_MAX_DAYS} days")
+    ids = _parse_user_ids(user_ids)
+    days = [date.fromordinal(d).isoformat() for d in range(first.toordinal(), last.toordinal() + 1)]
+    frm_day, to_day = days[0], days[-1]
+    with _db() as con:
+        _ensure_daily_facts(con)
+
+    def generate() -> Iterator[bytes]:
+        with _POOL.detached() as con:
+            users = _select_users(con.cursor(), ids)
+            if not users:
+                return
+            users_json = json.dumps(users)
+            sources: Dict[str, _KeyedRows] = {}
+            for name in ("facts", "objects"):
+                source = con.cursor()
+                source.execute(_DAILY_RANGE_SQL[name], (users_json, frm_day, to_day))
+                sources[name] = _KeyedRows(source)
+            salaries = con.cursor()
+            salaries.execute(_DAILY_RANGE_SQL["salaries"], (users_json, frm_day[:7] + "-01", to_day[:7] + "-31"))
+            sources["salaries"] = _KeyedRows(salaries)
+
+            for user_id in users:
+                salary_row: Optional[Dict[str, Any]] = None
+                month = None
+                batch: List[bytes] = []
+                for day in days:
+                    if day[:7] != month:
+                        month = day[:7]
+                        rows = sources["salaries"].take(user_id, month)
+                        salary_row = dict(rows[0]) if rows else None
+                    facts = sources["facts"].take(user_id, day)
+                    objects = sources["objects"].take(user_id, day)
+                    o = objects[0] if objects else None
+                    work_stats, costs = _daily_blocks(
+                        facts[0] if facts else None,
+                        _daily_earnings(salary_row),
+                        float(o["issued"] or 0) if o else 0.0,
+                        float(o["other"] or 0) if o else 0.0,
+                    )
+                    batch.append(_json_bytes({"user_id": user_id, "date": day, "work_stats": work_stats, "costs": costs}) + b"\n")
+                yield b"".join(batch)
+
+    return StreamingResponse(generate(), media_type=NDJSON)
+
+
+# Отчёты по сотрудникам за день/неделю/месяц — агрегаты по диапазону daily_user_facts
+_FACTS_REPORT_COLUMNS = """
+    SUM(tasks_total) AS tasks_total, SUM(tasks_completed) AS tasks_completed,
+    SUM(tasks_in_progress) AS tasks_in_progress, SUM(labor_cost) AS labor_cost,
+    SUM(advances) AS advances, SUM(withholdings) AS withholdings, SUM(bonuses) AS bonuses,
+    SUM(materials_cost) AS materials_cost, SUM(tracked) AS tracked_days,
+    SUM(COALESCE(worked_hours, 0)) AS tracked_hours, COUNT(*) AS active_days
+"""
+
+
+@app.get("/api/users/facts")
+def get_user_facts_report(
+    user_ids: str | None = None,
+    frm: str | None = Query(None, alias="from"),
+    to: str | None = None,
+    group_by: str | None = None,
+) -> JSONResponse:
+    """Сводка по сотрудникам из daily_user_facts: индексное чтение диапазона и SUM в SQL.
+
+    group_by=day|week|month — разбивка по периодам, без него — итог за период.
+    """
+    first = _parse_day(frm, "from").isoformat()
+    last = _parse_day(to, "to").isoformat()
+    period = _period_expr("day", group_by)
+    ids = _parse_user_ids(user_ids)
+    with _db() as con:
+        _ensure_daily_facts(con)
         cur = con.cursor()
-        cur.execute("SELECT * FROM timesheets ORDER BY id DESC")
-        return JSONResponse(_rows_to_dicts(cur.fetchall()))
+        if ids is None:
+            cur.execute(
+                f"""
+                SELECT user_id, {period} AS period, {_FACTS_REPORT_COLUMNS}
+                FROM daily_user_facts
+                WHERE day BETWEEN ? AND ?
+                GROUP BY user_id, period
+                ORDER BY user_id, period
+                """,
+                (first, last),
+            )
+        else:
+            cur.execute(
+                f"""
+                SELECT user_id, {period} AS period, {_FACTS_REPORT_COLUMNS}
+                FROM daily_user_facts
+                WHERE user_id IN (SELECT value FROM json_each(?)) AND day BETWEEN ? AND ?
+                GROUP BY user_id, period
+                ORDER BY user_id, period
+                """,
+                (json.dumps(ids), first, last),
+            )
+        return RowsResponse(cur)
+
+
+_init_daily_facts()
+
+
+# ===== Списки: постраничная выборка, фильтры, проекция =====
+
+LIST_MAX_LIMIT = 1000
+_TABLE_COLUMNS: Dict[str, List[str]] = {}
+
+
+def _table_columns(cur: sqlite3.Cursor, table: str) -> List[str]:
+    cols = _TABLE_COLUMNS.get(table)
+    if cols is None:
+        cur.execute(f"PRAGMA table_info('{table}')")
+        cols = [r[1] for r in cur.fetchall()]
+        _TABLE_COLUMNS[table] = cols
+    return cols
+
+
+def _int_param(request: Request, name: str) -> Optional[int]:
+    raw = request.query_params.get(name)
+    if raw in (None, ""):
+        return None
+    try:
+        return int(raw)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must be an integer")
+
+
+# Коллекции с журналом изменений (?since=<revision>)
+SYNC_TABLES = (
+    "objects", "users", "tasks", "purchases", "salaries", "absences", "items",
+    "suppliers", "customers", "invoices", "budgets", "cash_transactions", "payments",
+    "other_expenses", "warehouse_consumption", "tools", "tool_assignments",
+    "purchase_requests", "documents",
+)
+
+
+@_on_write(*SYNC_TABLES)
+def _track_change(cur: sqlite3.Cursor, table: str, row_id: int, op: str) -> None:
+    """Новая ревизия на каждую запись; удаление оставляет надгробие.
+
+    Счётчик увеличивается внутри пишущей транзакции, поэтому порядок ревизий
+    совпадает с порядком коммитов.
+    """
+    cur.execute("UPDATE sync_revision SET value = value + 1 WHERE id = 1 RETURNING value")
+    revision = cur.fetchone()[0]
+    cur.execute(
+        """INSERT INTO row_changes(table_name, row_id, revision, deleted) VALUES (?, ?, ?, ?)
+           ON CONFLICT(table_name, row_id) DO UPDATE SET revision = excluded.revision, deleted = excluded.deleted""",
+        (table, row_id, revision, 1 if op == "delete" else 0),
+    )
+    _POOL.defer(lambda committed: _publish_revision(table, revision if committed else None))
+
+
+def _current_revision(cur: sqlite3.Cursor) -> int:
+    cur.execute("SELECT value FROM sync_revision WHERE id = 1")
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+
+# Последняя ревизия каждой таблицы в памяти процесса: по ней строится ETag, и
+# 304 отдаётся без обращения к базе. Публикуется только после коммита записи.
+_TABLE_REVISIONS: Dict[str, int] = {}
+_TABLE_REVISIONS_LOCK = threading.Lock()
+
+
+def _load_table_revisions(*tables: str) -> None:
+    """Перечитать ревизии из row_changes (все таблицы или только указанные)."""
+    with _db() as con:
+        cur = con.cursor()
+        if tables:
+            marks = ", ".join("?" for _ in tables)
+            cur.execute(
+                f"SELECT table_name, MAX(revision) FROM row_changes WHERE table_name IN ({marks}) GROUP BY table_name",
+                tables,
+            )
+        else:
+            cur.execute("SELECT table_name, MAX(revision) FROM row_changes GROUP BY table_name")
+        rows = cur.fetchall()
+    with _TABLE_REVISIONS_LOCK:
+        for table, revision in rows:
+            _TABLE_REVISIONS[table] = revision
+
+
+def _publish_revision(table: str, revision: Optional[int]) -> None:
+    if revision is None:
+        # Транзакция откатилась (возможно, после явного commit) — берём истину из базы
+        _load_table_revisions(table)
+        return
+    with _TABLE_REVISIONS_LOCK:
+        if revision > _TABLE_REVISIONS.get(table, 0):
+            _TABLE_REVISIONS[table] = revision
+
+
+def _collection_etag(tables: tuple[str, ...]) -> str:
+    return f'W/"{max(_TABLE_REVISIONS.get(t, 0) for t in tables)}"'
+
+
+_load_table_revisions()
+
+
+def _changes_since(
+    cur: sqlite3.Cursor,
+    table: str,
+    since: int,
+    projection: str,
+    conds: List[str],
+    args: List[Any],
+    limit: Optional[int],
+) -> Dict[str, Any]:
+    """Строки коллекции, изменённые после ревизии ``since``.
+
+    ``changed`` — актуальные строки (с учётом фильтров), ``deleted`` — id удалённых
+    строк и строк, переставших подходить под фильтры. ``revision`` передаётся
+    следующим ``since``; при ``has_more`` запрос нужно повторить.
+    """
+    upto = _current_revision(cur)
+    sql = "SELECT row_id, revision FROM row_changes WHERE table_name = ? AND revision > ? AND revision <= ? ORDER BY revision"
+    change_args: List[Any] = [table, since, upto]
+    if limit is not None:
+        sql += " LIMIT ?"
+        change_args.append(limit + 1)
+    cur.execute(sql, change_args)
+    changes = cur.fetchall()
+    has_more = limit is not None and len(changes) > limit
+    if has_more:
+        changes = changes[:limit]
+        upto = changes[-1][1]
+    if not changes:
+        return {"revision": max(upto, since), "changed": [], "deleted": [], "has_more": False}
+
+    # Живые строки берём тем же фильтром, что и обычный список
+    row_conds = ["id IN (SELECT row_id FROM row_changes WHERE table_name = ? AND revision > ? AND revision <= ? AND deleted = 0)"]
+    cur.execute(
+        f"SELECT {projection} FROM {table} WHERE {' AND '.join(row_conds + conds)} ORDER BY id",
+        [table, since, upto] + args,
+    )
+    changed = _rows_to_dicts(cur.fetchall())
+    alive = {r["id"] for r in changed}
+    deleted = [r[0] for r in changes if r[0] not in alive]
+    return {"revision": upto, "changed": changed, "deleted": deleted, "has_more": has_more}
+
+
+def _list_rows(
+    request: Request,
+    table: str,
+    *,
+    filters: tuple[str, ...] = (),
+    date_col: str | None = None,
+    order: str = "id",
+    where: str = "",
+    params: tuple = (),
+) -> JSONResponse:
+    """Общий обработчик списков.
+
+    Параметры запроса: ``after_id`` + ``limit`` (keyset по порядку списка),
+    ``fields=a,b`` (проекция), равенство по колонкам из ``filters``,
+    ``date_from``/``date_to`` по ``date_col``. Без ``limit`` возвращается весь
+    список, как раньше. Курсор следующей страницы — в заголовке X-Next-Cursor,
+    ревизия, с которой продолжать ``?since=``, — в X-Revision.
+    ``stream=1`` или ``Accept: application/x-ndjson`` — построчная выдача NDJSON.
+    ``since=<revision>`` переключает в режим дельты (см. _changes_since).
+    """
+    qp = request.query_params
+    conds: List[str] = [where] if where else []
+    args: List[Any] = list(params)
+    for col in filters:
+        if col in qp:
+            conds.append(f"{col} = ?")
+            args.append(qp[col])
+    if date_col:
+        if qp.get("date_from"):
+            conds.append(f"{date_col} >= ?")
+            args.append(qp["date_from"])
+        if qp.get("date_to"):
+            conds.append(f"{date_col} < date(?, '+1 day')")
+            args.append(qp["date_to"])
+
+    after_id = _int_param(request, "after_id")
+    limit = _int_param(request, "limit")
+    since = _int_param(request, "since")
+    order_sql = "id DESC" if order == "id" else f"{order} DESC, id DESC"
+    if limit is not None:
+        limit = max(1, min(limit, LIST_MAX_LIMIT))
+
+    with _db() as con:
+        cur = con.cursor()
+        # Ревизию читаем до выборки: всё, что запишут позже, попадёт в следующую дельту
+        revision = _current_revision(cur)
+        if after_id is not None and since is None:
+            key = None
+            if order != "id":
+                cur.execute(f"SELECT {order} FROM {table} WHERE id = ?", (after_id,))
+                key = cur.fetchone()
+            if key is None:
+                # Порядок по id (или строка-курсор уже удалена) — продолжаем по id
+                conds.append("id < ?")
+                args.append(after_id)
+            else:
+                # Развёрнутое (key, id) < (?, ?): так SQLite ищет по индексу выражения
+                conds.append(f"{order} <= ? AND ({order} < ? OR id < ?)")
+                args.extend([key[0], key[0], after_id])
+        projection = "*"
+        if qp.get("fields"):
+            known = _table_columns(cur, table)
+            fields = [f.strip() for f in qp["fields"].split(",") if f.strip()]
+            unknown = [f for f in fields if f not in known]
+            if unknown:
+                raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+            if "id" not in fields:
+                fields.insert(0, "id")
+            projection = ", ".join(fields)
+        if since is not None:
+            return FastJSONResponse(_changes_since(cur, table, since, projection, conds, args, limit))
+        sql = f"SELECT {projection} FROM {table}"
+        if conds:
+            sql += " WHERE " + " AND ".join(conds)
+        sql += f" ORDER BY {order_sql}"
+        if _wants_stream(request):
+            if limit is not None:
+                sql += " LIMIT ?"
+                args.append(limit)
+            return _stream_rows(sql, args, headers={"X-Revision": str(revision)})
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(limit + 1)
+        cur.execute(sql, args)
+        columns = [d[0] for d in cur.description]
+        cur.row_factory = None
+        rows = cur.fetchall()
+    headers: Dict[str, str] = {"X-Revision": str(revision)}
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        headers["X-Next-Cursor"] = str(rows[-1][columns.index("id")])
+    return RowsResponse(rows, columns, headers=headers)
+
+
+@app.get("/api/objects")
+def get_objects(request: Request) -> JSONResponse:
+    return _list_rows(request, "objects", filters=("status", "created_by"), date_col="start_date")
+
+
+USER_FILTERS = ("role", "status", "department", "position", "is_admin")
+
+
+@app.get("/api/users")
+def get_users(request: Request, include_archived: bool = False) -> JSONResponse:
+    return _list_rows(
+        request, "users", filters=USER_FILTERS, date_col="hire_date",
+        where="" if include_archived else "archived_at IS NULL",
+    )
+
+@app.get("/api/users/archived")
+def get_archived_users(request: Request) -> JSONResponse:
+    return _list_rows(
+        request, "users", filters=USER_FILTERS, date_col="archived_at",
+        order="archived_at", where="archived_at IS NOT NULL",
+    )
+
+@app.post("/api/users/{user_id}/restore")
+def restore_user(user_id: int) -> JSONResponse:
+    with _db() as con:
+        cur = con.cursor()
+        cur.execute("UPDATE users SET archived_at = NULL, status = 'active' WHERE id = ?", (user_id,))
+        if cur.rowcount == 0:
+            raise HTTPException(status_code=404, detail="User not found")
+        _after_write(cur, "users", user_id, "update")
+        con.commit()
+        cur.execute("SELECT * FROM users WHERE id = ?", (user_id,))
+        return JSONResponse(dict(cur.fetchone()))
+
+
+@app.get("/api/tasks")
+def get_tasks(request: Request) -> JSONResponse:
+    return _list_rows(request, "tasks", filters=("status", "assignee_id", "object_id", "priority", "task_type", "created_by"), date_col="COALESCE(work_date, created_at)")
+
+
+@app.get("/api/purchases")
+def get_purchases(request: Request) -> JSONResponse:
+    return _list_rows(request, "purchases", filters=("status", "item", "item_key", "type", "unit", "object_id", "supplier_id", "assignee_id", "user_id", "payment_status"), date_col="date")
+
+
+@app.get("/api/salaries")
+def get_salaries(request: Request) -> JSONResponse:
+    return _list_rows(request, "salaries", filters=("user_id", "object_id", "task_id", "type", "paid"), date_col="date")
+
+
+@app.get("/api/absences")
+def get_absences(request: Request) -> JSONResponse:
+    return _list_rows(request, "absences", filters=("user_id", "object_id", "task_id", "type"), date_col="date")
+
+
+@app.get("/api/timesheets")
+def get_timesheets(request: Request) -> JSONResponse:
+    return _list_rows(request, "timesheets", filters=("user_id", "object_id", "task_id", "kind"), date_col="start_time")
 
 
 @app.get("/api/settings")
 def get_settings() -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute("SELECT key, value FROM settings")
-        return JSONResponse(_rows_to_dicts(cur.fetchall()))
+        return RowsResponse(cur)
 
 
 @app.put("/api/settings/{key}")
 def put_setting(key: str, value: Dict[str, Any]) -> JSONResponse:
     # Accepts JSON body and saves as string
     val = json.dumps(value) if isinstance(value, dict) else str(value)
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute("INSERT INTO settings(key, value) VALUES(?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value", (key, val))
         con.commit()
     return JSONResponse({"ok": True, "key": key})
 
 
+# ===== KPI дашборда: снимок в памяти =====
+
+# Страховочный срок жизни раздела: изменения мимо API (timesheets, другие
+# процессы) и ручной статус 'overdue' подхватываются не позже чем через TTL
+METRICS_TTL = float(os.getenv("METRICS_TTL", "60"))
+
+
+def _kpi_objects(cur: sqlite3.Cursor) -> tuple[Any, Optional[str]]:
+    cur.execute("SELECT COUNT(*) FROM objects")
+    return cur.fetchone()[0], None
+
+
+def _kpi_users(cur: sqlite3.Cursor) -> tuple[Any, Optional[str]]:
+    cur.execute("SELECT COUNT(*) FROM users")
+    return cur.fetchone()[0], None
+
+
+def _kpi_tasks(cur: sqlite3.Cursor) -> tuple[Any, Optional[str]]:
+    """Всего задач и просроченные; второй элемент — ближайший будущий дедлайн.
+
+    Просрочка меняется со временем без записей, поэтому раздел устаревает,
+    когда наступает следующий дедлайн открытой задачи.
+    """
+    cur.execute("SELECT COUNT(*) FROM tasks")
+    total = cur.fetchone()[0]
+    cur.execute("SELECT COUNT(*) FROM tasks WHERE status IN ('overdue')")
+    overdue = cur.fetchone()[0]
+    if overdue:
+        return {"total": total, "overdue": overdue}, None
+    # If 'overdue' not used, detect by deadline < now and not completed
+    cur.execute(
+        """
+        SELECT SUM(datetime(deadline) < datetime('now')), MIN(CASE WHEN datetime(deadline) >= datetime('now') THEN datetime(deadline) END)
+        FROM tasks
+        WHERE completed_at IS NULL AND deadline IS NOT NULL
+        """
+    )
+    overdue, next_deadline = cur.fetchone()
+    return {"total": total, "overdue": overdue or 0}, next_deadline
+
+
+def _kpi_working_now(cur: sqlite3.Cursor) -> tuple[Any, Optional[str]]:
+    """Открытые смены за сегодня (UTC, как date('now')); раздел устаревает в полночь."""
+    tomorrow = time.strftime("%Y-%m-%d 00:00:00", time.gmtime(time.time() + 86400))
+    # Workers working now: timesheets with open interval (end_time NULL) today
+    try:
+        cur.execute(
+            """
+            SELECT COUNT(DISTINCT user_id) FROM timesheets
+            WHERE end_time IS NULL AND (date(start_time) = date('now') OR start_time IS NULL)
+            """
+        )
+    except sqlite3.OperationalError:
+        # В старых базах таблицы timesheets может не быть
+        return 0, tomorrow
+    return cur.fetchone()[0], tomorrow
+
+
+def _kpi_payables(cur: sqlite3.Cursor) -> tuple[Any, Optional[str]]:
+    cur.execute("SELECT COALESCE(SUM(amount), 0) FROM salaries")
+    return cur.fetchone()[0] or 0, None
+
+
+def _kpi_absences(cur: sqlite3.Cursor) -> tuple[Any, Optional[str]]:
+    cur.execute("SELECT COALESCE(SUM(amount), 0) FROM absences")
+    return cur.fetchone()[0] or 0, None
+
+
+# Раздел снимка -> (расчёт, таблицы, запись в которые делает раздел устаревшим)
+KPI_SECTIONS: Dict[str, tuple[Callable[[sqlite3.Cursor], tuple[Any, Optional[str]]], tuple[str, ...]]] = {
+    "objects": (_kpi_objects, ("objects",)),
+    "users": (_kpi_users, ("users",)),
+    "tasks": (_kpi_tasks, ("tasks",)),
+    "working_now": (_kpi_working_now, ("timesheets",)),
+    "payables": (_kpi_payables, ("salaries",)),
+    "absences": (_kpi_absences, ("absences",)),
+}
+
+
+class _KpiSnapshot:
+    """Значения KPI по разделам с поколениями, как _TABLE_REVISIONS для ETag.
+
+    Запись в таблицу раздела увеличивает его поколение после commit; чтение
+    пересчитывает только разделы, у которых поколение сменилось, истёк TTL
+    или наступил сохранённый срок (дедлайн задачи), остальные отдаёт из памяти.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._generation: Dict[str, int] = {name: 0 for name in KPI_SECTIONS}
+        # раздел -> (значение, поколение, monotonic расчёта, срок 'YYYY-MM-DD HH:MM:SS' или None, время расчёта)
+        self._values: Dict[str, tuple[Any, int, float, Optional[str], str]] = {}
+        self._stats = {"reads": 0, "recomputed": 0}
+
+    def invalidate(self, sections: List[str]) -> None:
+        with self._lock:
+            for name in sections:
+                self._generation[name] += 1
+
+    def _stale(self, name: str, now: float, now_utc: str) -> bool:
+        entry = self._values.get(name)
+        if entry is None:
+            return True
+        _, generation, computed, expires, _ = entry
+        return generation != self._generation[name] or now - computed > METRICS_TTL or (expires is not None and now_utc > expires)
+
+    def read(self, fresh: bool = False) -> Dict[str, tuple[Any, str]]:
+        now = time.monotonic()
+        now_utc = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        with self._lock:
+            self._stats["reads"] += 1
+            stale = {name: self._generation[name] for name in KPI_SECTIONS if fresh or self._stale(name, now, now_utc)}
+        computed: Dict[str, tuple[Any, int, float, Optional[str], str]] = {}
+        if stale:
+            with _db() as con:
+                cur = con.cursor()
+                for name, generation in stale.items():
+                    value, expires = KPI_SECTIONS[name][0](cur)
+                    computed[name] = (value, generation, now, expires, datetime.now().isoformat())
+        with self._lock:
+            self._stats["recomputed"] += len(computed)
+            # Поколение прочитано до расчёта: запись во время расчёта оставит раздел устаревшим
+            self._values.update(computed)
+            values = dict(self._values)
+        return {name: (entry[0], entry[4]) for name, entry in values.items()}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats, ttl=METRICS_TTL)
+
+
+_KPI = _KpiSnapshot()
+
+
+@_on_write(*{table for _, tables in KPI_SECTIONS.values() for table in tables})
+def _kpi_invalidate(cur: sqlite3.Cursor, table: str, row_id: int, op: str) -> None:
+    sections = [name for name, (_, tables) in KPI_SECTIONS.items() if table in tables]
+    _POOL.defer(lambda committed: committed and _KPI.invalidate(sections))
+
+
 @app.get("/api/metrics")
-def get_metrics() -> JSONResponse:
-    """Aggregate basic KPIs for dashboard."""
-    now_iso = datetime.now().isoformat()
-    today = date.today().isoformat()
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute("SELECT COUNT(*) AS c FROM objects")
-        objects_total = cur.fetchone()[0]
+def get_metrics(fresh: int = 0) -> JSONResponse:
+    """Aggregate basic KPIs for dashboard.
+
+    Значения берутся из снимка _KPI в памяти; ``fresh=1`` пересчитывает все
+    разделы по базе. generated_at — время самого старого раздела ответа.
+    """
+    return JSONResponse(_metrics_payload(_KPI.read(fresh=bool(fresh))))
+
+
+def _metrics_payload(kpi: Dict[str, tuple[Any, str]]) -> Dict[str, Any]:
+    objects_total = kpi["objects"][0]
+    tasks = kpi["tasks"][0]
+    return {
         # Treat all as active for demo; in real app add status column
-        objects_active = objects_total
+        "objects": {"total": objects_total, "active": objects_total, "completed": 0},
+        "users": {"total": kpi["users"][0], "working_now": kpi["working_now"][0]},
+        "tasks": {"total": tasks["total"], "overdue": tasks["overdue"]},
+        "finance": {"payables": kpi["payables"][0], "absences": kpi["absences"][0], "income": 0},
+        "statist": {"idle_minutes": 0, "smoke_minutes": 0},
+        "generated_at": min(generated for _, generated in kpi.values()),
+    }
 
-        cur.execute("SELECT COUNT(*) FROM users")
-        users_total = cur.fetchone()[0]
 
-        cur.execute("SELECT COUNT(*) FROM tasks")
-        tasks_total = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM tasks WHERE status IN ('overdue')")
-        tasks_overdue = cur.fetchone()[0]
-        # If 'overdue' not used, detect by deadline < now and not completed
-        if tasks_overdue == 0:
-            try:
-                cur.execute("SELECT COUNT(*) FROM tasks WHERE (deadline IS NOT NULL AND datetime(deadline) < datetime('now')) AND (completed_at IS NULL)")
-                tasks_overdue = cur.fetchone()[0]
-            except Exception:
-                tasks_overdue = 0
+@app.get("/api/health/metrics")
+def health_metrics() -> Dict[str, Any]:
+    """Снимок KPI: число чтений и пересчитанных разделов."""
+    return _KPI.stats()
+
+
+# ===== Поток событий изменений (SSE) =====
+
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "256"))
+STREAM_HEARTBEAT = float(os.getenv("STREAM_HEARTBEAT", "15"))
+STREAM_MAX_CLIENTS = int(os.getenv("STREAM_MAX_CLIENTS", "500"))
+STREAM_RETRY_MS = int(os.getenv("STREAM_RETRY_MS", "3000"))
+SSE = "text/event-stream"
+
+# Таблицы, о записи в которые сообщает /api/stream, и событие пересчёта KPI
+STREAM_TABLES = SYNC_TABLES + ("metrics",)
+
+
+def _sse(event: str, data: Any, event_id: Optional[int] = None) -> bytes:
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {event}\n".encode() + b"data: " + _json_bytes(data) + b"\n\n"
+
+
+class _StreamClient:
+    __slots__ = ("queue", "tables", "overflowed")
+
+    def __init__(self, tables: frozenset[str]) -> None:
+        # None в очереди — маркер переполнения: клиенту нужно перечитать данные
+        self.queue: asyncio.Queue[Optional[bytes]] = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        self.tables = tables
+        self.overflowed = False
+
+
+class _EventHub:
+    """Рассылка событий изменений подписчикам /api/stream.
 
-        # Workers working now: timesheets with open interval (end_time NULL) today
+    publish() вызывается из потоков обработчиков после commit: события копятся
+    в буфере, и в event loop планируется одна рассылка на пачку. Событие
+    кодируется один раз и кладётся в очереди всех подписанных клиентов.
+    Очередь клиента ограничена STREAM_QUEUE_SIZE: если браузер не успевает
+    читать, его очередь очищается и вместо неё приходит одно событие resync —
+    запись и остальные клиенты медленного не ждут.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pending: List[tuple[str, str, Dict[str, Any], Optional[int]]] = []
+        self._scheduled = False
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # Меняется только в event loop
+        self._clients: set[_StreamClient] = set()
+        self._stats = {"published": 0, "delivered": 0, "overflows": 0, "connections": 0}
+
+    @property
+    def active(self) -> bool:
+        return bool(self._clients)
+
+    @property
+    def clients(self) -> int:
+        return len(self._clients)
+
+    def subscribe(self, tables: frozenset[str]) -> _StreamClient:
+        self._loop = asyncio.get_running_loop()
+        client = _StreamClient(tables)
+        self._clients.add(client)
+        self._stats["connections"] += 1
+        return client
+
+    def unsubscribe(self, client: _StreamClient) -> None:
+        self._clients.discard(client)
+
+    def publish(self, table: str, event: str, data: Dict[str, Any], event_id: Optional[int] = None) -> None:
+        """Из любого потока; без подписчиков ничего не делает."""
+        loop = self._loop
+        if not self._clients or loop is None:
+            return
+        with self._lock:
+            self._pending.append((table, event, data, event_id))
+            if self._scheduled:
+                return
+            self._scheduled = True
         try:
-            cur.execute(
-                """
-                SELECT COUNT(DISTINCT user_id) FROM timesheets
-                WHERE (date(start_time) = date('now') OR start_time IS NULL)
-                  AND (end_time IS NULL)
-            """
-            )
-            workers_working_now = cur.fetchone()[0]
-        except Exception:
-            workers_working_now = 0
+            loop.call_soon_threadsafe(self._dispatch)
+        except RuntimeError:
+            # event loop уже закрыт
+            with self._lock:
+                self._pending.clear()
+                self._scheduled = False
+
+    def _dispatch(self) -> None:
+        with self._lock:
+            batch, self._pending = self._pending, []
+            self._scheduled = False
+        # Пересчёты KPI за пачку сливаются в одно событие
+        sections = sorted({s for table, _, data, _ in batch if table == "metrics" for s in data["sections"]})
+        encoded = [(table, _sse(event, data, event_id)) for table, event, data, event_id in batch if table != "metrics"]
+        if sections:
+            encoded.append(("metrics", _sse("metrics", {"sections": sections})))
+        self._stats["published"] += len(encoded)
+        for client in list(self._clients):
+            if client.overflowed:
+                continue
+            for table, payload in encoded:
+                if table not in client.tables:
+                    continue
+                try:
+                    client.queue.put_nowait(payload)
+                except asyncio.QueueFull:
+                    self._overflow(client)
+                    break
+                self._stats["delivered"] += 1
+
+    def _overflow(self, client: _StreamClient) -> None:
+        while not client.queue.empty():
+            client.queue.get_nowait()
+        client.queue.put_nowait(None)
+        client.overflowed = True
+        self._stats["overflows"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(self._stats, clients=len(self._clients), queue_size=STREAM_QUEUE_SIZE)
+
+
+_HUB = _EventHub()
+
+
+@_on_write(*set(SYNC_TABLES) | {table for _, tables in KPI_SECTIONS.values() for table in tables})
+def _stream_change(cur: sqlite3.Cursor, table: str, row_id: int, op: str) -> None:
+    """Событие change (и metrics для таблиц KPI) подписчикам после commit.
 
-        # Payables (salaries)
+    Регистрируется после _track_change, так что текущая ревизия уже включает
+    эту запись: она уходит как id события и годится для ?since=.
+    """
+    if not _HUB.active:
+        return
+    if table in SYNC_TABLES:
+        revision = _current_revision(cur)
+        change = {"table": table, "id": row_id, "op": op, "revision": revision}
+        _POOL.defer(lambda committed: committed and _HUB.publish(table, "change", change, revision))
+    sections = [name for name, (_, tables) in KPI_SECTIONS.items() if table in tables]
+    if sections:
+        _POOL.defer(lambda committed: committed and _HUB.publish("metrics", "metrics", {"sections": sections}))
+
+
+def _stream_revision(tables: frozenset[str]) -> int:
+    with _TABLE_REVISIONS_LOCK:
+        return max((_TABLE_REVISIONS.get(t, 0) for t in tables), default=0)
+
+
+@app.get("/api/stream")
+async def stream_events(
+    request: Request,
+    tables: str | None = None,
+    last_event_id: str | None = Header(None),
+) -> StreamingResponse:
+    """События изменений для виджетов дашборда (text/event-stream).
+
+    ``change``: {table, id, op, revision} — строку можно дочитать через
+    GET /api/<table>?since=<revision - 1>, удаление применить сразу.
+    ``metrics``: {sections} — разделы /api/metrics, которые устарели.
+    ``resync``: {revision} — события пропущены (медленный клиент или
+    переподключение с отставшим Last-Event-ID), нужно перечитать коллекции
+    через ?since=. ``hello`` — первое событие с текущей ревизией.
+    ``tables`` — через запятую, по умолчанию все из STREAM_TABLES.
+    """
+    if tables:
+        wanted = frozenset(t.strip() for t in tables.split(",") if t.strip())
+        unknown = sorted(wanted - set(STREAM_TABLES))
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown tables: {', '.join(unknown)}")
+    else:
+        wanted = frozenset(STREAM_TABLES)
+    if _HUB.clients >= STREAM_MAX_CLIENTS:
+        raise HTTPException(status_code=503, detail="Too many stream clients")
+    try:
+        since = int(last_event_id) if last_event_id else None
+    except ValueError:
+        since = None
+
+    async def generate() -> AsyncIterator[bytes]:
+        client = _HUB.subscribe(wanted)
         try:
-            cur.execute("SELECT COALESCE(SUM(amount),0) FROM salaries")
-            payables = cur.fetchone()[0] or 0
-        except Exception:
-            payables = 0
+            revision = _stream_revision(wanted)
+            yield f"retry: {STREAM_RETRY_MS}\n\n".encode()
+            if since is not None and since < revision:
+                yield _sse("resync", {"revision": revision, "since": since}, revision)
+            else:
+                yield _sse("hello", {"revision": revision, "tables": sorted(wanted)})
+            while True:
+                try:
+                    payload = await asyncio.wait_for(client.queue.get(), STREAM_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    # Комментарий держит соединение через прокси и выявляет отвалившихся
+                    yield b": ping\n\n"
+                    continue
+                if payload is None:
+                    client.overflowed = False
+                    revision = _stream_revision(wanted)
+                    yield _sse("resync", {"revision": revision}, revision)
+                else:
+                    yield payload
+        finally:
+            _HUB.unsubscribe(client)
+
+    return StreamingResponse(
+        generate(), media_type=SSE, headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.get("/api/health/stream")
+def health_stream() -> Dict[str, Any]:
+    """Подписчики /api/stream: число клиентов, доставленных событий и переполнений."""
+    return _HUB.stats()
+
+
+# ===== Стартовая загрузка дашборда =====
+
+# Только колонки, которые читают виджеты Dashboard.tsx. Массив JSON собирает
+# сама SQLite: без кортежей и dict в Python выборка вдвое быстрее; порядок
+# строк задаёт подзапрос (как ORDER BY id DESC у списков).
+_BOOTSTRAP_SQL = {
+    "objects": """SELECT json_group_array(json_object('id', id, 'name', name, 'address', address))
+                  FROM (SELECT id, name, address FROM objects ORDER BY id DESC)""",
+    "users": """SELECT json_group_array(json_object('id', id, 'full_name', full_name))
+                FROM (SELECT id, full_name FROM users WHERE archived_at IS NULL ORDER BY id DESC)""",
+    "tasks": """SELECT json_group_array(json_object(
+                    'id', id, 'title', title, 'status', status, 'deadline', deadline, 'assignee_id', assignee_id,
+                    'object_id', object_id, 'created_at', created_at, 'completed_at', completed_at))
+                FROM (SELECT id, title, status, deadline, assignee_id, object_id, created_at, completed_at
+                      FROM tasks ORDER BY id DESC)""",
+    "purchases": """SELECT json_group_array(json_object('id', id, 'item', item, 'status', status, 'amount', amount, 'date', date))
+                    FROM (SELECT id, item, status, amount, date FROM purchases ORDER BY id DESC)""",
+    "salaries": """SELECT json_group_array(json_object('id', id, 'user_id', user_id, 'amount', amount, 'date', date))
+                   FROM (SELECT id, user_id, amount, date FROM salaries ORDER BY id DESC)""",
+    "absences": """SELECT json_group_array(json_object('id', id, 'user_id', user_id, 'amount', amount, 'date', date))
+                   FROM (SELECT id, user_id, amount, date FROM absences ORDER BY id DESC)""",
+}
+
+
+@app.get("/api/dashboard/bootstrap")
+def dashboard_bootstrap() -> Response:
+    """Всё для первой отрисовки дашборда одним запросом.
+
+    Коллекции читаются на одном соединении в одной транзакции чтения, то есть
+    из одного снимка базы; metrics — из снимка KPI в памяти, как /api/metrics.
+    ``revision`` — ревизия этого снимка: с неё продолжать ?since= по
+    коллекциям и Last-Event-ID для /api/stream.
+    """
+    metrics = _metrics_payload(_KPI.read())
+    with _db() as con:
+        if not con.in_transaction:
+            con.execute("BEGIN")
+        cur = con.cursor()
+        revision = _current_revision(cur)
+        parts = [b'{"revision":', str(revision).encode(), b',"metrics":', _json_bytes(metrics)]
+        for name, sql in _BOOTSTRAP_SQL.items():
+            cur.execute(sql)
+            parts += [b',"', name.encode(), b'":', cur.fetchone()[0].encode()]
+    parts.append(b"}")
+    return Response(b"".join(parts), media_type="application/json")
 
-        # Absences total
+
+# ===== Пакетные запросы =====
+
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "20"))
+# Сколько подзапросов выполняется одновременно: каждый держит соединение пула
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+# Заголовки подзапроса, которые не передаются: тело, сжатие, CORS и формат ответа задаёт пакет
+_BATCH_DROP_HEADERS = {b"content-length", b"content-type", b"accept", b"accept-encoding", b"origin", b"if-none-match", b"transfer-encoding"}
+# Заголовки ответа подзапроса, которые попадают в результат
+BATCH_RESPONSE_HEADERS = ("etag", "x-next-cursor", "x-revision")
+
+
+class BatchSubRequest(BaseModel):
+    path: str
+    method: str = "GET"
+
+
+class BatchRequest(BaseModel):
+    requests: List[BatchSubRequest]
+
+
+def _batch_path(raw: str) -> str:
+    """Путь подзапроса в том виде, в каком его получит маршрутизатор.
+
+    Проверяется уже раскодированный путь, и по нему же выполняется подзапрос:
+    иначе /api/%73tream обходит запрет. Бесконечный поток (stream_events) и сам
+    пакет внутри пакета отсекаются по обработчику маршрута, а не по строке пути.
+    """
+    encoded = urlsplit(raw).path
+    path = unquote(encoded)
+    # %2F внутри сегмента после раскодирования меняет разбиение пути на сегменты
+    if "%2f" in encoded.lower() or not path.startswith("/api/"):
+        raise HTTPException(status_code=400, detail=f"Path not allowed in batch: {raw}")
+    scope = {"type": "http", "path": path.rstrip("/"), "root_path": "", "method": "GET"}
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match != Match.NONE and getattr(route, "endpoint", None) in (stream_events, batch_requests):
+            raise HTTPException(status_code=400, detail=f"Path not allowed in batch: {raw}")
+    return path
+
+
+async def _batch_call(request: Request, path: str, sub: BatchSubRequest, limit: asyncio.Semaphore) -> bytes:
+    """Выполнить GET-подзапрос через стек приложения без HTTP и вернуть элемент ответа.
+
+    Подзапрос проходит те же middleware и обработчики исключений, что и
+    обычный запрос, поэтому статус и тело совпадают с отдельным вызовом.
+    """
+    url = urlsplit(sub.path)
+    headers = [(k, v) for k, v in request.scope["headers"] if k not in _BATCH_DROP_HEADERS]
+    headers.append((b"accept", b"application/json"))
+    scope = {
+        "type": "http",
+        "asgi": request.scope.get("asgi", {"version": "3.0"}),
+        "http_version": request.scope.get("http_version", "1.1"),
+        "method": "GET",
+        "scheme": request.scope.get("scheme", "http"),
+        "server": request.scope.get("server"),
+        "client": request.scope.get("client"),
+        "root_path": request.scope.get("root_path", ""),
+        "path": path,
+        "raw_path": url.path.encode(),
+        "query_string": url.query.encode(),
+        "headers": headers,
+    }
+    status = 500
+    response_headers: Dict[str, str] = {}
+    content_type = ""
+    body: List[bytes] = []
+    done = asyncio.Event()
+    sent = False
+
+    async def receive() -> Dict[str, Any]:
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message: Dict[str, Any]) -> None:
+        nonlocal status, content_type
+        if message["type"] == "http.response.start":
+            status = message["status"]
+            raw = Headers(raw=message.get("headers", []))
+            content_type = raw.get("content-type", "")
+            response_headers.update({k: raw[k] for k in BATCH_RESPONSE_HEADERS if k in raw})
+        elif message["type"] == "http.response.body":
+            body.append(message.get("body", b""))
+
+    async with limit:
         try:
-            cur.execute("SELECT COALESCE(SUM(amount),0) FROM absences")
-            abs_total = cur.fetchone()[0] or 0
+            await app(scope, receive, send)
         except Exception:
-            abs_total = 0
+            # ServerErrorMiddleware уже отправил 500 и пробрасывает исключение дальше
+            status = 500
+        finally:
+            done.set()
+    payload = b"".join(body)
+    if payload and content_type.startswith("application/json"):
+        encoded = payload
+    else:
+        encoded = _json_bytes(payload.decode("utf-8", "replace") if payload else None)
+    head = _json_bytes({"path": sub.path, "status": status, "headers": response_headers})
+    return head[:-1] + b',"body":' + encoded + b"}"
 
-    metrics = {
-        "objects": {"total": objects_total, "active": objects_active, "completed": 0},
-        "users": {"total": users_total, "working_now": workers_working_now},
-        "tasks": {"total": tasks_total, "overdue": tasks_overdue},
-        "finance": {"payables": payables, "absences": abs_total, "income": 0},
-        "statist": {"idle_minutes": 0, "smoke_minutes": 0},
-        "generated_at": now_iso,
-    }
-    return JSONResponse(metrics)
+
+@app.post("/api/batch")
+async def batch_requests(request: Request, payload: BatchRequest) -> Response:
+    """Несколько GET-запросов к API одним вызовом.
+
+    ``{"requests": [{"path": "/api/objects"}, {"path": "/api/users?limit=50"}]}``
+    → ``{"responses": [{"path", "status", "headers", "body"}, ...]}`` в том же
+    порядке. Подзапросы выполняются в процессе обработчиками маршрутов,
+    до BATCH_CONCURRENCY одновременно; они только читают, так что порядок их
+    выполнения на результат не влияет. Ошибка подзапроса — его собственный
+    status, остальные ответы от неё не зависят.
+    """
+    if len(payload.requests) > BATCH_MAX_REQUESTS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_REQUESTS} requests per batch")
+    paths = []
+    for sub in payload.requests:
+        if sub.method.upper() != "GET":
+            raise HTTPException(status_code=400, detail=f"Only GET sub-requests are supported: {sub.method} {sub.path}")
+        paths.append(_batch_path(sub.path))
+    limit = asyncio.Semaphore(max(1, BATCH_CONCURRENCY))
+    parts = await asyncio.gather(*(_batch_call(request, path, sub, limit) for path, sub in zip(paths, payload.requests)))
+    return Response(b'{"responses":[' + b",".join(parts) + b"]}", media_type="application/json")
 
 
 class TaskCreate(BaseModel):
@@ -1170,7 +3096,7 @@ class TaskCreate(BaseModel):
 
 @app.post("/api/tasks")
 def create_task(payload: TaskCreate) -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute(
             """
@@ -1192,6 +3118,7 @@ def create_task(payload: TaskCreate) -> JSONResponse:
             ),
         )
         task_id = cur.lastrowid
+        _after_write(cur, "tasks", task_id, "insert")
         con.commit()
         cur.execute("SELECT * FROM tasks WHERE id= ?", (task_id,))
         return JSONResponse(dict(cur.fetchone()))
@@ -1218,9 +3145,10 @@ def update_task(task_id: int, payload: TaskUpdate) -> JSONResponse:
     if not fields:
         raise HTTPException(status_code=400, detail="No fields to update")
     values.append(task_id)
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute(f"UPDATE tasks SET {', '.join(fields)} WHERE id = ?", values)
+        _after_write(cur, "tasks", task_id, "update")
         con.commit()
         cur.execute("SELECT * FROM tasks WHERE id= ?", (task_id,))
         row = cur.fetchone()
@@ -1294,55 +3222,573 @@ async def _parse_purchase_request(request: Request) -> Dict[str, Any]:
                 pass
     return {"data": data, "file": upload}
 
-# Подсчёт доступного остатка по ключу item|unit|type
+# ===== Склад: остатки по нормализованному ключу =====
+
 IN_STATUSES = ("stock_in", "completed", "complete", "done", "received")
 OUT_STATUSES = ("issued", "writeoff", "spent")
+STOCK_VERSION = 3
 
-def _available_for(con: sqlite3.Connection, item: str, unit: Optional[str], mtype: Optional[str]) -> float:
-    """Возвращает доступный остаток по ключу item|unit|type с учётом нормализации:
-    - сравнение unit в нижнем регистре
-    - типы '' и 'materials' считаются эквивалентными
+
+def _material_key(item: Optional[str], unit: Optional[str], mtype: Optional[str]) -> tuple[str, str, str]:
+    """Нормализованный ключ материала (item_key, unit_norm, type_norm).
+
+    - наименование без учёта регистра и крайних пробелов
+    - единицы в нижнем регистре без точек, пустая единица считается 'шт'
+    - пустой тип и 'materials' — одно множество
     """
-    cur = con.cursor()
-    unit_norm = (unit or '').strip().lower()
-    unit_norm = unit_norm.replace('.', '')
-    type_norm = (mtype or '').strip().lower()
-    # Пустой тип и 'materials' считаем одним множеством
-    type_candidates = ['materials', ''] if type_norm in ('', 'materials') else [type_norm]
-    type_placeholders = ','.join(['?'] * len(type_candidates)) or "?"
-    # Единицы: '' и 'шт' считаем эквивалентными (учтём также 'шт.')
-    if unit_norm in ('', 'шт', 'шт.'):
-      unit_candidates = ['', 'шт', 'шт.']
-    else:
-      unit_candidates = [unit_norm]
-    unit_placeholders = ','.join(['?'] * len(unit_candidates)) or "?"
+    item_key = str(item or "").strip().lower()
+    unit_norm = str(unit or "").strip().lower().replace(".", "") or "шт"
+    type_norm = str(mtype or "").strip().lower() or "materials"
+    return item_key, unit_norm, type_norm
+
+
+def _stock_direction(status: Optional[str]) -> int:
+    """+1 — приход, -1 — расход, 0 — не влияет на остаток."""
+    status = (status or "").strip().lower()
+    if status in IN_STATUSES:
+        return 1
+    if status in OUT_STATUSES:
+        return -1
+    return 0
+
+
+_DAY_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+def _stock_day(value: Any) -> str:
+    """День движения YYYY-MM-DD; нераспознанная дата — '' (раньше любых дат).
+
+    Совпадает с COALESCE(DATE(substr(..., 1, 10)), '') в _stock_rebuild.
+    """
+    day = str(value or "")[:10]
+    if not _DAY_RE.match(day):
+        return ""
+    try:
+        return date.fromisoformat(day).isoformat()
+    except ValueError:
+        return ""
+
+
+def _stock_move(row: sqlite3.Row) -> Optional[tuple]:
+    """Движение по строке purchases: (id, item_key, unit_norm, type_norm, qty со знаком, date)."""
+    direction = _stock_direction(row["status"])
+    try:
+        qty = float(row["qty"] or 0)
+    except (TypeError, ValueError):
+        qty = 0.0
+    if not direction or not qty:
+        return None
+    return (row["id"], row["item_key"], row["unit_norm"], row["type_norm"], direction * qty, _stock_day(row["date"] or row["created_at"]))
+
+
+MATERIAL_KEY_BATCH = 1000
+
+
+@_on_write("purchases")
+def _purchase_material_key(cur: sqlite3.Cursor, table: str, row_id: int, op: str) -> None:
+    """Пересчитывает item_key/unit_norm/type_norm строки (до хука остатков)."""
+    if op == "delete":
+        return
+    cur.execute("SELECT item, unit, type FROM purchases WHERE id = ?", (row_id,))
+    row = cur.fetchone()
+    if row:
+        cur.execute(
+            "UPDATE purchases SET item_key = ?, unit_norm = ?, type_norm = ? WHERE id = ?",
+            (*_material_key(row["item"], row["unit"], row["type"]), row_id),
+        )
+
+
+def _backfill_material_keys() -> int:
+    """Заполняет ключи у исторических строк пачками, каждая в своей транзакции."""
+    total = 0
+    while True:
+        with _db() as con:
+            cur = con.cursor()
+            cur.execute("SELECT id, item, unit, type FROM purchases WHERE item_key IS NULL LIMIT ?", (MATERIAL_KEY_BATCH,))
+            rows = cur.fetchall()
+            if not rows:
+                return total
+            cur.executemany(
+                "UPDATE purchases SET item_key = ?, unit_norm = ?, type_norm = ? WHERE id = ?",
+                [(*_material_key(r["item"], r["unit"], r["type"]), r["id"]) for r in rows],
+            )
+        total += len(rows)
+
 
-    # Вход
+def _apply_stock_move(cur: sqlite3.Cursor, move: tuple, display: tuple, sign: int = 1) -> None:
+    _, item_key, unit_norm, type_norm, qty, day = move
+    in_qty = sign * qty if qty > 0 else 0.0
+    out_qty = sign * -qty if qty < 0 else 0.0
     cur.execute(
-        f"""
-        SELECT COALESCE(SUM(qty),0) FROM purchases
-        WHERE lower(item)=lower(?)
-          AND lower(REPLACE(COALESCE(unit,''),'.','')) IN ({unit_placeholders})
-          AND lower(COALESCE(type,'')) IN ({type_placeholders})
-          AND status IN ({','.join(['?']*len(IN_STATUSES))})
+        """
+        INSERT INTO stock_balances(item_key, unit_norm, type_norm, item, unit, type, in_qty, out_qty)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(item_key, unit_norm, type_norm)
+        DO UPDATE SET in_qty = in_qty + excluded.in_qty, out_qty = out_qty + excluded.out_qty
+        """,
+        (item_key, unit_norm, type_norm, *display, in_qty, out_qty),
+    )
+    # Движение задним числом меняет и уже снятые снимки начиная с его даты
+    cur.execute(
+        """
+        INSERT INTO stock_snapshots(day, item_key, unit_norm, type_norm, in_qty, out_qty)
+        SELECT day, ?, ?, ?, ?, ? FROM stock_snapshot_days WHERE day >= ?
+        ON CONFLICT(day, item_key, unit_norm, type_norm)
+        DO UPDATE SET in_qty = in_qty + excluded.in_qty, out_qty = out_qty + excluded.out_qty
         """,
-        (item, *unit_candidates, *type_candidates, *IN_STATUSES),
+        (item_key, unit_norm, type_norm, in_qty, out_qty, day or ""),
     )
-    inflow = cur.fetchone()[0] or 0.0
 
-    # Расход
+
+_STOCK_ROW_SQL = "SELECT id, item, unit, type, item_key, unit_norm, type_norm, status, qty, date, created_at FROM purchases"
+
+
+@_on_write("purchases")
+def _stock_sync(cur: sqlite3.Cursor, table: str, row_id: int, op: str) -> None:
+    """Снимаем прежнее движение строки и применяем новое — в той же транзакции."""
+    cur.execute("SELECT purchase_id, item_key, unit_norm, type_norm, qty, date FROM stock_moves WHERE purchase_id = ?", (row_id,))
+    prev = cur.fetchone()
+    if prev:
+        _apply_stock_move(cur, tuple(prev), (None, None, None), sign=-1)
+        cur.execute("DELETE FROM stock_moves WHERE purchase_id = ?", (row_id,))
+    if op == "delete":
+        return
+    cur.execute(f"{_STOCK_ROW_SQL} WHERE id = ?", (row_id,))
+    row = cur.fetchone()
+    move = _stock_move(row) if row else None
+    if move:
+        cur.execute("INSERT INTO stock_moves(purchase_id, item_key, unit_norm, type_norm, qty, date) VALUES (?, ?, ?, ?, ?, ?)", move)
+        _apply_stock_move(cur, move, (row["item"], row["unit"], row["type"]))
+
+
+def _stock_rebuild(cur: sqlite3.Cursor) -> None:
+    """Пересборка по сохранённым ключам purchases — два запроса, без разбора строк в Python."""
+    in_marks = ",".join("?" for _ in IN_STATUSES)
+    out_marks = ",".join("?" for _ in OUT_STATUSES)
+    cur.execute("DELETE FROM stock_moves")
+    cur.execute("DELETE FROM stock_balances")
+    cur.execute("DELETE FROM stock_snapshots")
+    cur.execute("DELETE FROM stock_snapshot_days")
     cur.execute(
         f"""
-        SELECT COALESCE(SUM(qty),0) FROM purchases
-        WHERE lower(item)=lower(?)
-          AND lower(REPLACE(COALESCE(unit,''),'.','')) IN ({unit_placeholders})
-          AND lower(COALESCE(type,'')) IN ({type_placeholders})
-          AND status IN ({','.join(['?']*len(OUT_STATUSES))})
+        -- full-scan: пересборка из всей истории
+        INSERT INTO stock_moves(purchase_id, item_key, unit_norm, type_norm, qty, date)
+        SELECT id, item_key, unit_norm, type_norm,
+               CASE WHEN lower(trim(status)) IN ({in_marks}) THEN 1 ELSE -1 END * CAST(qty AS REAL),
+               COALESCE(DATE(substr(COALESCE(date, created_at, ''), 1, 10)), '')
+        FROM purchases
+        WHERE lower(trim(status)) IN ({in_marks}, {out_marks}) AND CAST(qty AS REAL) != 0
+        """,
+        (*IN_STATUSES, *IN_STATUSES, *OUT_STATUSES),
+    )
+    cur.execute(
+        """
+        INSERT INTO stock_balances(item_key, unit_norm, type_norm, item, unit, type, in_qty, out_qty)
+        SELECT m.item_key, m.unit_norm, m.type_norm, p.item, p.unit, p.type, m.in_qty, m.out_qty
+        FROM (
+            SELECT item_key, unit_norm, type_norm, MIN(purchase_id) AS first_id,
+                   SUM(CASE WHEN qty > 0 THEN qty ELSE 0 END) AS in_qty,
+                   SUM(CASE WHEN qty < 0 THEN -qty ELSE 0 END) AS out_qty
+            FROM stock_moves
+            GROUP BY item_key, unit_norm, type_norm
+        ) AS m
+        JOIN purchases p ON p.id = m.first_id
+        """
+    )
+
+
+def _init_stock() -> bool:
+    """Первичное заполнение stock_moves/stock_balances (и пересборка при смене STOCK_VERSION).
+
+    Возвращает True, если движения были пересобраны.
+    """
+    with _db() as con:
+        cur = con.cursor()
+        if _schema_version(cur, "stock_balances") >= STOCK_VERSION:
+            return False
+        _stock_rebuild(cur)
+        _set_schema_version(cur, "stock_balances", STOCK_VERSION)
+        return True
+
+
+def _month_end(day: date) -> date:
+    nxt = date(day.year + day.month // 12, day.month % 12 + 1, 1)
+    return date.fromordinal(nxt.toordinal() - 1)
+
+
+def _day_after(day: Optional[str]) -> str:
+    """Нижняя граница движений после снимка day ('' — с самого начала)."""
+    return (date.fromisoformat(day) + timedelta(days=1)).isoformat() if day else ""
+
+
+def _last_closed_month_end() -> str:
+    return date.fromordinal(date.today().replace(day=1).toordinal() - 1).isoformat()
+
+
+def _stock_snapshots_due(cur: sqlite3.Cursor) -> bool:
+    cur.execute("SELECT MAX(day) FROM stock_snapshot_days")
+    last = cur.fetchone()[0]
+    return last is None or last < _last_closed_month_end()
+
+
+def _ensure_stock_snapshots(cur: sqlite3.Cursor) -> None:
+    """Досоздаёт снимки на конец каждого завершённого месяца.
+
+    Снимок = предыдущий снимок + движения за месяц, поэтому создание стоит
+    одного месяца движений. Дальше снимки поддерживает _apply_stock_move.
+    """
+    last_closed = date.fromisoformat(_last_closed_month_end()).toordinal()
+    cur.execute("SELECT MAX(day) FROM stock_snapshot_days")
+    prev = cur.fetchone()[0]
+    if prev:
+        start = date.fromisoformat(prev) + timedelta(days=1)
+    else:
+        cur.execute("SELECT MIN(date) FROM stock_moves WHERE date > ''")
+        first = cur.fetchone()[0]
+        try:
+            start = date.fromisoformat(first) if first else None
+        except ValueError:
+            start = None
+        if start is None:
+            return
+    while _month_end(start).toordinal() <= last_closed:
+        day = _month_end(start).isoformat()
+        cur.execute(
+            """
+            INSERT INTO stock_snapshots(day, item_key, unit_norm, type_norm, in_qty, out_qty)
+            SELECT ?, item_key, unit_norm, type_norm, SUM(in_qty), SUM(out_qty)
+            FROM (
+                SELECT item_key, unit_norm, type_norm, in_qty, out_qty FROM stock_snapshots WHERE day = ?
+                UNION ALL
+                SELECT item_key, unit_norm, type_norm,
+                       CASE WHEN qty > 0 THEN qty ELSE 0 END, CASE WHEN qty < 0 THEN -qty ELSE 0 END
+                FROM stock_moves WHERE date >= ? AND date <= ?
+            )
+            GROUP BY item_key, unit_norm, type_norm
+            """,
+            (day, prev or "", _day_after(prev), day),
+        )
+        cur.execute("INSERT INTO stock_snapshot_days(day) VALUES (?)", (day,))
+        prev = day
+        start = date.fromisoformat(day) + timedelta(days=1)
+
+
+def _stock_as_of(cur: sqlite3.Cursor, as_of: str) -> List[tuple]:
+    """Остатки на конец дня as_of: ближайший снимок не позже as_of + движения после него."""
+    cur.execute("SELECT MAX(day) FROM stock_snapshot_days WHERE day <= ?", (as_of,))
+    snap = cur.fetchone()[0]
+    cur.execute(
+        """
+        SELECT sb.item, sb.unit, sb.type, SUM(t.in_qty) AS in_qty, SUM(t.out_qty) AS out_qty,
+               SUM(t.in_qty) - SUM(t.out_qty) AS balance
+        FROM (
+            SELECT item_key, unit_norm, type_norm, in_qty, out_qty FROM stock_snapshots WHERE day = ?
+            UNION ALL
+            SELECT item_key, unit_norm, type_norm,
+                   CASE WHEN qty > 0 THEN qty ELSE 0 END, CASE WHEN qty < 0 THEN -qty ELSE 0 END
+            FROM stock_moves WHERE date >= ? AND date <= ?
+        ) AS t
+        JOIN stock_balances sb USING (item_key, unit_norm, type_norm)
+        GROUP BY t.item_key, t.unit_norm, t.type_norm
+        HAVING SUM(t.in_qty) != 0 OR SUM(t.out_qty) != 0
+        ORDER BY t.item_key, t.unit_norm, t.type_norm
+        """,
+        (snap, _day_after(snap), as_of),
+    )
+    return cur
+
+
+# ===== Себестоимость материалов: FIFO / средневзвешенная =====
+
+# fifo — списание из самых ранних приходов; average — по скользящей средней цене
+COSTING_METHODS = ("fifo", "average")
+COSTING_METHOD = os.getenv("COSTING_METHOD", "fifo").strip().lower()
+if COSTING_METHOD not in COSTING_METHODS:
+    COSTING_METHOD = "fifo"
+COSTING_VERSION = 1
+_COST_EPS = 1e-9
+
+def _purchase_amount(value: Any) -> float:
+    """purchases.amount хранится как TEXT: '1 200,50' → 1200.5, мусор → 0."""
+    try:
+        return float(str(value or 0).replace(" ", "").replace(",", "."))
+    except ValueError:
+        return 0.0
+
+
+def _consume_layers(layers: List[list], qty: float, last_cost: float) -> float:
+    """Списывает qty из открытых слоёв [purchase_id, remaining, unit_cost] и возвращает стоимость.
+
+    Слои изменяются на месте. Недостача (списание сверх прихода) оценивается
+    по цене последнего прихода, чтобы объект не получил материал бесплатно.
+    """
+    available = sum(layer[1] for layer in layers)
+    take = min(qty, available)
+    cost = 0.0
+    if take > _COST_EPS:
+        if COSTING_METHOD == "average":
+            cost = sum(layer[1] * layer[2] for layer in layers) * take / available
+            keep = 1.0 - take / available
+            for layer in layers:
+                layer[1] *= keep
+        else:
+            need = take
+            for layer in layers:
+                part = min(layer[1], need)
+                layer[1] -= part
+                cost += part * layer[2]
+                need -= part
+                if need <= _COST_EPS:
+                    break
+        for layer in layers:
+            if layer[1] <= _COST_EPS:
+                layer[1] = 0.0
+    if qty - take > _COST_EPS:
+        cost += (qty - take) * last_cost
+    return cost
+
+
+def _cost_replay(cur: sqlite3.Cursor, key: tuple) -> None:
+    """Пересчитывает слои и списания одного материала по его движениям."""
+    cur.execute("DELETE FROM cost_layers WHERE item_key = ? AND unit_norm = ? AND type_norm = ?", key)
+    cur.execute("DELETE FROM cost_allocations WHERE item_key = ? AND unit_norm = ? AND type_norm = ?", key)
+    cur.execute(
+        """
+        SELECT m.purchase_id, m.qty, m.date, p.amount, p.object_id, p.user_id
+        FROM stock_moves m JOIN purchases p ON p.id = m.purchase_id
+        WHERE m.item_key = ? AND m.unit_norm = ? AND m.type_norm = ?
+        ORDER BY m.date, m.purchase_id
+        """,
+        key,
+    )
+    layers: List[list] = []
+    open_layers: List[list] = []
+    layer_rows: List[tuple] = []
+    allocations: List[tuple] = []
+    last_cost = 0.0
+    for purchase_id, qty, day, amount, object_id, user_id in cur.fetchall():
+        if qty > 0:
+            last_cost = _purchase_amount(amount) / qty
+            layer = [purchase_id, qty, last_cost]
+            layers.append(layer)
+            open_layers.append(layer)
+            layer_rows.append((purchase_id, day, qty, last_cost))
+        else:
+            cost = _consume_layers(open_layers, -qty, last_cost)
+            open_layers = [layer for layer in open_layers if layer[1] > 0]
+            allocations.append((purchase_id, object_id, user_id, day, -qty, cost))
+    remaining = {layer[0]: layer[1] for layer in layers}
+    cur.executemany(
+        """INSERT INTO cost_layers(purchase_id, item_key, unit_norm, type_norm, date, qty, unit_cost, remaining)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+        [(pid, *key, day, qty, unit_cost, remaining[pid]) for pid, day, qty, unit_cost in layer_rows],
+    )
+    cur.executemany(
+        """INSERT INTO cost_allocations(purchase_id, item_key, unit_norm, type_norm, object_id, user_id, date, qty, cost)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        [(pid, *key, object_id, user_id, day, qty, cost) for pid, object_id, user_id, day, qty, cost in allocations],
+    )
+
+
+def _cost_append(cur: sqlite3.Cursor, row_id: int, move: sqlite3.Row) -> bool:
+    """Быстрый путь: новое движение позже всех остальных по материалу.
+
+    Приход добавляет слой, списание расходует только открытые слои своего
+    материала. Если движение задним числом — False, нужен _cost_replay.
+    """
+    key = (move["item_key"], move["unit_norm"], move["type_norm"])
+    day = move["date"]
+    cur.execute(
+        """
+        SELECT 1 FROM stock_moves
+        WHERE item_key = ? AND unit_norm = ? AND type_norm = ? AND (date > ? OR (date = ? AND purchase_id > ?))
+        LIMIT 1
+        """,
+        (*key, day, day, row_id),
+    )
+    if cur.fetchone():
+        return False
+    cur.execute("SELECT amount, object_id, user_id FROM purchases WHERE id = ?", (row_id,))
+    amount, object_id, user_id = cur.fetchone()
+    qty = move["qty"]
+    if qty > 0:
+        cur.execute(
+            """INSERT INTO cost_layers(purchase_id, item_key, unit_norm, type_norm, date, qty, unit_cost, remaining)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            (row_id, *key, day, qty, _purchase_amount(amount) / qty, qty),
+        )
+        return True
+    cur.execute(
+        "SELECT unit_cost FROM cost_layers WHERE item_key = ? AND unit_norm = ? AND type_norm = ? ORDER BY date DESC, purchase_id DESC LIMIT 1",
+        key,
+    )
+    last = cur.fetchone()
+    cur.execute(
+        """
+        SELECT purchase_id, remaining, unit_cost FROM cost_layers
+        WHERE item_key = ? AND unit_norm = ? AND type_norm = ? AND remaining > 0
+        ORDER BY date, purchase_id
+        """,
+        key,
+    )
+    layers = [list(r) for r in cur.fetchall()]
+    before = [layer[1] for layer in layers]
+    cost = _consume_layers(layers, -qty, last[0] if last else 0.0)
+    cur.executemany(
+        "UPDATE cost_layers SET remaining = ? WHERE purchase_id = ?",
+        [(layer[1], layer[0]) for layer, prev in zip(layers, before) if layer[1] != prev],
+    )
+    cur.execute(
+        """INSERT INTO cost_allocations(purchase_id, item_key, unit_norm, type_norm, object_id, user_id, date, qty, cost)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        (row_id, *key, object_id, user_id, day, -qty, cost),
+    )
+    return True
+
+
+@_on_write("purchases")
+def _cost_sync(cur: sqlite3.Cursor, table: str, row_id: int, op: str) -> None:
+    """Себестоимость после _stock_sync: затрагивается только материал изменённой строки."""
+    cur.execute(
+        """
+        SELECT item_key, unit_norm, type_norm FROM cost_layers WHERE purchase_id = ?
+        UNION ALL
+        SELECT item_key, unit_norm, type_norm FROM cost_allocations WHERE purchase_id = ?
         """,
-        (item, *unit_candidates, *type_candidates, *OUT_STATUSES),
+        (row_id, row_id),
+    )
+    prev = cur.fetchone()
+    cur.execute("SELECT item_key, unit_norm, type_norm, qty, date FROM stock_moves WHERE purchase_id = ?", (row_id,))
+    move = cur.fetchone()
+    if prev is None and move is not None and _cost_append(cur, row_id, move):
+        return
+    keys = {tuple(prev)} if prev else set()
+    if move is not None:
+        keys.add((move["item_key"], move["unit_norm"], move["type_norm"]))
+    for key in keys:
+        _cost_replay(cur, key)
+
+
+def _cost_rebuild(cur: sqlite3.Cursor) -> None:
+    cur.execute("DELETE FROM cost_layers")
+    cur.execute("DELETE FROM cost_allocations")
+    cur.execute(
+        """
+        -- full-scan: пересборка по всем материалам
+        SELECT DISTINCT item_key, unit_norm, type_norm FROM stock_moves
+        """
+    )
+    for key in cur.fetchall():
+        _cost_replay(cur, tuple(key))
+
+
+def _init_costs(force: bool = False) -> None:
+    """Пересборка себестоимости при смене COSTING_VERSION, метода или движений склада."""
+    name = f"material_costs:{COSTING_METHOD}"
+    with _db() as con:
+        cur = con.cursor()
+        if not force and _schema_version(cur, name) >= COSTING_VERSION:
+            return
+        _cost_rebuild(cur)
+        cur.executemany("DELETE FROM schema_migrations WHERE name = ?", [(f"material_costs:{m}",) for m in COSTING_METHODS])
+        _set_schema_version(cur, name, COSTING_VERSION)
+
+
+_backfill_material_keys()
+_init_costs(force=_init_stock())
+with _db() as _con:
+    _ensure_stock_snapshots(_con.cursor())
+
+
+def _available_for(con: sqlite3.Connection, item: str, unit: Optional[str], mtype: Optional[str]) -> float:
+    """Доступный остаток по ключу item|unit|type — одна выборка из stock_balances."""
+    cur = con.cursor()
+    cur.execute(
+        "SELECT in_qty - out_qty FROM stock_balances WHERE item_key = ? AND unit_norm = ? AND type_norm = ?",
+        _material_key(item, unit, mtype),
     )
-    outflow = cur.fetchone()[0] or 0.0
-    return float(inflow) - float(outflow)
+    row = cur.fetchone()
+    return float(row[0]) if row else 0.0
+
+
+@contextmanager
+def _write_tx() -> Iterator[sqlite3.Connection]:
+    """Пишущая транзакция, открытая через BEGIN IMMEDIATE.
+
+    Блокировка записи берётся до первого чтения, поэтому проверка остатка и
+    списание выполняются атомарно: параллельные списания ждут своей очереди
+    (busy timeout пула) и видят уже уменьшенный остаток.
+    """
+    with _db() as con:
+        if not con.in_transaction:
+            con.execute("BEGIN IMMEDIATE")
+        yield con
+
+
+def _stock_shortage(available: float, requested: float, item: Any, unit: Any, mtype: Any) -> Dict[str, Any]:
+    available_disp = max(0.0, float(available))
+    return {
+        "code": "stock_insufficient",
+        "message": f"Недостаточно на складе. Доступно: {available_disp} {unit or ''}. Запрошено: {requested} {unit or ''}.",
+        "available": available_disp,
+        "requested": float(requested),
+        "unit": unit,
+        "type": mtype,
+        "item": item,
+    }
+
+
+def _reserve_stock(con: sqlite3.Connection, lines: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Проверяет списания по строкам; строки одного материала суммируются.
+
+    Вызывается внутри _write_tx(). Возвращает список нехваток (пустой — можно списывать).
+    """
+    requested: Dict[tuple[str, str, str], float] = {}
+    first: Dict[tuple[str, str, str], Dict[str, Any]] = {}
+    for line in lines:
+        if (line.get("status") or "").lower() not in OUT_STATUSES:
+            continue
+        qty = float(line.get("qty") or 0)
+        if qty <= 0:
+            continue
+        key = _material_key(line.get("item"), line.get("unit"), line.get("type"))
+        requested[key] = requested.get(key, 0.0) + qty
+        first.setdefault(key, line)
+    shortages = []
+    for key, qty in requested.items():
+        line = first[key]
+        available = _available_for(con, line.get("item"), line.get("unit"), line.get("type"))
+        if qty > available + 1e-9:
+            shortages.append(_stock_shortage(available, qty, line.get("item"), line.get("unit"), line.get("type")))
+    return shortages
+
+
+def _insert_purchase(cur: sqlite3.Cursor, data: Dict[str, Any], receipt_path: Optional[str] = None) -> int:
+    cur.execute(
+        """
+        INSERT INTO purchases(item, assignee_id, status, amount, user_id, date, notes, object_id, qty, unit, type, supplier_id, url, receipt_file, created_at)
+        VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
+        """,
+        (
+            data.get("item"),
+            data.get("assignee_id"),
+            data.get("status"),
+            str(data.get("amount")) if data.get("amount") is not None else None,
+            data.get("user_id"),
+            data.get("date") or date.today().isoformat(),
+            data.get("notes"),
+            data.get("object_id"),
+            data.get("qty"),
+            data.get("unit"),
+            data.get("type"),
+            data.get("supplier_id"),
+            data.get("url"),
+            receipt_path,
+        ),
+    )
+    rid = cur.lastrowid
+    _after_write(cur, "purchases", rid, "insert")
+    return rid
 
 # Заменяем эндпоинты purchases на версии с поддержкой multipart
 
@@ -1355,67 +3801,84 @@ async def create_purchase(request: Request) -> JSONResponse:
     if not str(data.get("item", "")).strip():
         raise HTTPException(status_code=400, detail="item is required")
 
-    # Валидация на недостаток остатков при списании
-    status = (data.get("status") or "").lower()
-    qty = float(data.get("qty") or 0)
-    if status in OUT_STATUSES and qty > 0:
-        with _connect() as con:
-            available = _available_for(con, data.get("item"), data.get("unit"), data.get("type"))
-        if qty > available + 1e-9:
-            available_disp = max(0.0, float(available))
-            raise HTTPException(
-                status_code=400,
-                detail={
-                    "code": "stock_insufficient",
-                    "message": f"Недостаточно на складе. Доступно: {available_disp} {data.get('unit') or ''}. Запрошено: {qty} {data.get('unit') or ''}.",
-                    "available": available_disp,
-                    "requested": float(qty),
-                    "unit": data.get("unit"),
-                    "type": data.get("type"),
-                    "item": data.get("item"),
-                },
-            )
+    contents = await upload.read() if upload else None
+
+    # Проверка остатка и вставка — в одной транзакции под блокировкой записи
+    def write() -> JSONResponse:
+        with _write_tx() as con:
+            shortages = _reserve_stock(con, [data])
+            if shortages:
+                raise HTTPException(status_code=400, detail=shortages[0])
+
+            receipt_path: Optional[str] = None
+            if upload:
+                safe_name = f"purchase_{int(datetime.now().timestamp())}_{upload.filename or 'file'}"
+                with open(os.path.join(UPLOAD_DIR, safe_name), "wb") as f:
+                    f.write(contents)
+                receipt_path = f"/files/{safe_name}"
+
+            cur = con.cursor()
+            rid = _insert_purchase(cur, data, receipt_path)
+            con.commit()
+            cur.execute("SELECT * FROM purchases WHERE id= ?", (rid,))
+            return JSONResponse(dict(cur.fetchone()))
+    return await run_in_threadpool(write)
+
+
+class PurchaseIssueLine(BaseModel):
+    item: str
+    qty: float
+    unit: str | None = None
+    type: str | None = None
+    object_id: int | None = None
+    notes: str | None = None
 
-    receipt_path: Optional[str] = None
-    if upload:
-        safe_name = f"purchase_{int(datetime.now().timestamp())}_{upload.filename or 'file'}"
-        dest_path = os.path.join(UPLOAD_DIR, safe_name)
-        with open(dest_path, "wb") as f:
-            f.write(await upload.read())
-        receipt_path = f"/files/{safe_name}"
 
-    # Дата/создание по умолчанию
-    if not data.get("date"):
-        data["date"] = date.today().isoformat()
+class PurchaseIssue(BaseModel):
+    lines: List[PurchaseIssueLine]
+    status: str = "issued"
+    object_id: int | None = None
+    assignee_id: int | None = None
+    user_id: int | None = None
+    date: str | None = None
+    notes: str | None = None
+
 
-    with _connect() as con:
+@app.post("/api/purchases/issue")
+def issue_purchases(payload: PurchaseIssue) -> JSONResponse:
+    """Многострочное списание: все строки проверяются и записываются одной транзакцией.
+
+    При нехватке хотя бы по одному материалу ничего не списывается (400, список нехваток).
+    """
+    if not payload.lines:
+        raise HTTPException(status_code=400, detail="lines are required")
+    if payload.status.lower() not in OUT_STATUSES:
+        raise HTTPException(status_code=400, detail=f"status must be one of: {', '.join(OUT_STATUSES)}")
+    lines = []
+    for line in payload.lines:
+        if not line.item.strip() or line.qty <= 0:
+            raise HTTPException(status_code=400, detail="Each line needs item and positive qty")
+        lines.append({
+            "item": line.item,
+            "qty": line.qty,
+            "unit": line.unit,
+            "type": line.type,
+            "status": payload.status,
+            "object_id": line.object_id if line.object_id is not None else payload.object_id,
+            "assignee_id": payload.assignee_id,
+            "user_id": payload.user_id,
+            "date": payload.date,
+            "notes": line.notes if line.notes is not None else payload.notes,
+        })
+    with _write_tx() as con:
+        shortages = _reserve_stock(con, lines)
+        if shortages:
+            raise HTTPException(status_code=400, detail={"code": "stock_insufficient", "shortages": shortages})
         cur = con.cursor()
-        cur.execute(
-            """
-            INSERT INTO purchases(item, assignee_id, status, amount, user_id, date, notes, object_id, qty, unit, type, supplier_id, url, receipt_file, created_at)
-            VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
-            """,
-            (
-                data.get("item"),
-                data.get("assignee_id"),
-                data.get("status"),
-                str(data.get("amount")) if data.get("amount") is not None else None,
-                data.get("user_id"),
-                data.get("date"),
-                data.get("notes"),
-                data.get("object_id"),
-                data.get("qty"),
-                data.get("unit"),
-                data.get("type"),
-                data.get("supplier_id"),
-                data.get("url"),
-                receipt_path,
-            ),
-        )
-        rid = cur.lastrowid
+        ids = [_insert_purchase(cur, line) for line in lines]
         con.commit()
-        cur.execute("SELECT * FROM purchases WHERE id= ?", (rid,))
-        return JSONResponse(dict(cur.fetchone()))
+        cur.execute(f"SELECT * FROM purchases WHERE id IN ({','.join('?' for _ in ids)}) ORDER BY id", ids)
+        return JSONResponse(_rows_to_dicts(cur.fetchall()))
 
 @app.patch("/api/purchases/{purchase_id}")
 async def update_purchase(purchase_id: int, request: Request) -> JSONResponse:
@@ -1441,46 +3904,40 @@ async def update_purchase(purchase_id: int, request: Request) -> JSONResponse:
     # Если меняем статус/qty на списание — проверим остаток
     new_status = (updates.get("status") or "").lower()
     new_qty = float(updates.get("qty") or 0)
-    # Получим старую запись для ключа item|unit|type
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute("SELECT item, unit, type, status, qty FROM purchases WHERE id= ?", (purchase_id,))
-        row = cur.fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="Purchase not found")
-        item0, unit0, type0, status0, qty0 = row[0], row[1], row[2], (row[3] or '').lower(), float(row[4] or 0)
-        target_status = new_status or status0
-        target_qty = new_qty if updates.get("qty") is not None else qty0
-        target_item = updates.get("item") or item0
-        target_unit = updates.get("unit") or unit0
-        target_type = updates.get("type") or type0
-        if target_status in OUT_STATUSES and target_qty > 0:
-            available = _available_for(con, target_item, target_unit, target_type)
-            # Если старая запись тоже была списанием, вернём её qty в доступный остаток
-            if status0 in OUT_STATUSES:
-                available += qty0
-            if target_qty > available + 1e-9:
-                available_disp = max(0.0, float(available))
-                raise HTTPException(
-                    status_code=400,
-                    detail={
-                        "code": "stock_insufficient",
-                        "message": f"Недостаточно на складе. Доступно: {available_disp} {target_unit or ''}. Запрошено: {target_qty} {target_unit or ''}.",
-                        "available": available_disp,
-                        "requested": float(target_qty),
-                        "unit": target_unit,
-                        "type": target_type,
-                        "item": target_item,
-                    },
-                )
-        # Применяем апдейт
-        fields = [f"{k} = ?" for k in updates.keys()]
-        values = list(updates.values()) + [purchase_id]
-        cur.execute(f"UPDATE purchases SET {', '.join(fields)} WHERE id = ?", values)
-        con.commit()
-        cur.execute("SELECT * FROM purchases WHERE id= ?", (purchase_id,))
-        row2 = cur.fetchone()
-        return JSONResponse(dict(row2))
+    # Получим старую запись для ключа item|unit|type (проверка и апдейт — под блокировкой записи)
+    def write() -> JSONResponse:
+        with _write_tx() as con:
+            cur = con.cursor()
+            cur.execute("SELECT item, unit, type, status, qty FROM purchases WHERE id= ?", (purchase_id,))
+            row = cur.fetchone()
+            if not row:
+                raise HTTPException(status_code=404, detail="Purchase not found")
+            item0, unit0, type0, status0, qty0 = row[0], row[1], row[2], (row[3] or '').lower(), float(row[4] or 0)
+            target_status = new_status or status0
+            target_qty = new_qty if updates.get("qty") is not None else qty0
+            target_item = updates.get("item") or item0
+            target_unit = updates.get("unit") or unit0
+            target_type = updates.get("type") or type0
+            if target_status in OUT_STATUSES and target_qty > 0:
+                available = _available_for(con, target_item, target_unit, target_type)
+                # Если старая запись тоже была списанием того же материала, вернём её qty в доступный остаток
+                if status0 in OUT_STATUSES and _material_key(item0, unit0, type0) == _material_key(target_item, target_unit, target_type):
+                    available += qty0
+                if target_qty > available + 1e-9:
+                    raise HTTPException(
+                        status_code=400,
+                        detail=_stock_shortage(available, target_qty, target_item, target_unit, target_type),
+                    )
+            # Применяем апдейт
+            fields = [f"{k} = ?" for k in updates.keys()]
+            values = list(updates.values()) + [purchase_id]
+            cur.execute(f"UPDATE purchases SET {', '.join(fields)} WHERE id = ?", values)
+            _after_write(cur, "purchases", purchase_id, "update")
+            con.commit()
+            cur.execute("SELECT * FROM purchases WHERE id= ?", (purchase_id,))
+            row2 = cur.fetchone()
+            return JSONResponse(dict(row2))
+    return await run_in_threadpool(write)
 
 class SalaryCreate(BaseModel):
     user_id: int
@@ -1502,7 +3959,7 @@ class SalaryUpdate(BaseModel):
 
 @app.post("/api/salaries")
 def create_salary(payload: SalaryCreate) -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute(
             """INSERT INTO salaries(user_id, amount, date, reason, type, task_id, object_id)
@@ -1510,6 +3967,7 @@ def create_salary(payload: SalaryCreate) -> JSONResponse:
             (payload.user_id, payload.amount, payload.date, payload.reason, payload.type, payload.task_id, payload.object_id),
         )
         rid = cur.lastrowid
+        _after_write(cur, "salaries", rid, "insert")
         con.commit()
         cur.execute("SELECT * FROM salaries WHERE id= ?", (rid,))
         return JSONResponse(dict(cur.fetchone()))
@@ -1524,9 +3982,10 @@ def update_salary(salary_id: int, payload: SalaryUpdate) -> JSONResponse:
     if not fields:
         raise HTTPException(status_code=400, detail="No fields to update")
     values.append(salary_id)
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute(f"UPDATE salaries SET {', '.join(fields)} WHERE id = ?", values)
+        _after_write(cur, "salaries", salary_id, "update")
         con.commit()
         cur.execute("SELECT * FROM salaries WHERE id= ?", (salary_id,))
         row = cur.fetchone()
@@ -1554,7 +4013,7 @@ class AbsenceUpdate(BaseModel):
 
 @app.post("/api/absences")
 def create_absence(payload: AbsenceCreate) -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute(
             """INSERT INTO absences(user_id, type, amount, date, comment, task_id, object_id)
@@ -1562,6 +4021,7 @@ def create_absence(payload: AbsenceCreate) -> JSONResponse:
             (payload.user_id, payload.type, payload.amount, payload.date, payload.comment, payload.task_id, payload.object_id),
         )
         rid = cur.lastrowid
+        _after_write(cur, "absences", rid, "insert")
         con.commit()
         cur.execute("SELECT * FROM absences WHERE id= ?", (rid,))
         return JSONResponse(dict(cur.fetchone()))
@@ -1576,9 +4036,10 @@ def update_absence(absence_id: int, payload: AbsenceUpdate) -> JSONResponse:
     if not fields:
         raise HTTPException(status_code=400, detail="No fields to update")
     values.append(absence_id)
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute(f"UPDATE absences SET {', '.join(fields)} WHERE id = ?", values)
+        _after_write(cur, "absences", absence_id, "update")
         con.commit()
         cur.execute("SELECT * FROM absences WHERE id= ?", (absence_id,))
         row = cur.fetchone()
@@ -1610,15 +4071,12 @@ class ItemUpdate(BaseModel):
     price: Optional[float] = None
 
 @app.get("/api/items")
-def api_get_items() -> JSONResponse:
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute("SELECT * FROM items ORDER BY id DESC")
-        return JSONResponse(_rows_to_dicts(cur.fetchall()))
+def api_get_items(request: Request) -> JSONResponse:
+    return _list_rows(request, "items", filters=("type", "unit"))
 
 @app.post("/api/items")
 def api_create_item(payload: ItemCreate) -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         try:
             cur.execute(
@@ -1629,6 +4087,7 @@ def api_create_item(payload: ItemCreate) -> JSONResponse:
         except sqlite3.IntegrityError:
             raise HTTPException(status_code=400, detail="Item with this name already exists")
         rid = cur.lastrowid
+        _after_write(cur, "items", rid, "insert")
         con.commit()
         cur.execute("SELECT * FROM items WHERE id= ?", (rid,))
         return JSONResponse(dict(cur.fetchone()))
@@ -1640,9 +4099,10 @@ def api_update_item(item_id: int, payload: ItemUpdate) -> JSONResponse:
         raise HTTPException(status_code=400, detail="No fields to update")
     fields = [f"{k} = ?" for k in updates.keys()]
     values = list(updates.values()) + [item_id]
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute(f"UPDATE items SET {', '.join(fields)} WHERE id = ?", values)
+        _after_write(cur, "items", item_id, "update")
         con.commit()
         cur.execute("SELECT * FROM items WHERE id= ?", (item_id,))
         row = cur.fetchone()
@@ -1652,9 +4112,10 @@ def api_update_item(item_id: int, payload: ItemUpdate) -> JSONResponse:
 
 @app.delete("/api/items/{item_id}")
 def api_delete_item(item_id: int) -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute("DELETE FROM items WHERE id= ?", (item_id,))
+        _after_write(cur, "items", item_id, "delete")
         con.commit()
         return JSONResponse({"ok": True})
 
@@ -1676,15 +4137,12 @@ class SupplierUpdate(BaseModel):
     notes: Optional[str] = None
 
 @app.get("/api/suppliers")
-def api_get_suppliers() -> JSONResponse:
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute("SELECT * FROM suppliers ORDER BY id DESC")
-        return JSONResponse(_rows_to_dicts(cur.fetchall()))
+def api_get_suppliers(request: Request) -> JSONResponse:
+    return _list_rows(request, "suppliers")
 
 @app.post("/api/suppliers")
 def api_create_supplier(payload: SupplierCreate) -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         try:
             cur.execute(
@@ -1695,6 +4153,7 @@ def api_create_supplier(payload: SupplierCreate) -> JSONResponse:
         except sqlite3.IntegrityError:
             raise HTTPException(status_code=400, detail="Supplier with this name already exists")
         rid = cur.lastrowid
+        _after_write(cur, "suppliers", rid, "insert")
         con.commit()
         cur.execute("SELECT * FROM suppliers WHERE id= ?", (rid,))
         return JSONResponse(dict(cur.fetchone()))
@@ -1706,9 +4165,10 @@ def api_update_supplier(supplier_id: int, payload: SupplierUpdate) -> JSONRespon
         raise HTTPException(status_code=400, detail="No fields to update")
     fields = [f"{k} = ?" for k in updates.keys()]
     values = list(updates.values()) + [supplier_id]
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute(f"UPDATE suppliers SET {', '.join(fields)} WHERE id = ?", values)
+        _after_write(cur, "suppliers", supplier_id, "update")
         con.commit()
         cur.execute("SELECT * FROM suppliers WHERE id= ?", (supplier_id,))
         row = cur.fetchone()
@@ -1718,9 +4178,10 @@ def api_update_supplier(supplier_id: int, payload: SupplierUpdate) -> JSONRespon
 
 @app.delete("/api/suppliers/{supplier_id}")
 def api_delete_supplier(supplier_id: int) -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute("DELETE FROM suppliers WHERE id= ?", (supplier_id,))
+        _after_write(cur, "suppliers", supplier_id, "delete")
         con.commit()
         return JSONResponse({"ok": True})
 
@@ -1742,15 +4203,12 @@ class CustomerUpdate(BaseModel):
     notes: Optional[str] = None
 
 @app.get("/api/customers")
-def api_get_customers() -> JSONResponse:
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute("SELECT * FROM customers ORDER BY id DESC")
-        return JSONResponse(_rows_to_dicts(cur.fetchall()))
+def api_get_customers(request: Request) -> JSONResponse:
+    return _list_rows(request, "customers")
 
 @app.post("/api/customers")
 def api_create_customer(payload: CustomerCreate) -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         try:
             cur.execute(
@@ -1761,6 +4219,7 @@ def api_create_customer(payload: CustomerCreate) -> JSONResponse:
         except sqlite3.IntegrityError:
             raise HTTPException(status_code=400, detail="Customer with this name already exists")
         rid = cur.lastrowid
+        _after_write(cur, "customers", rid, "insert")
         con.commit()
         cur.execute("SELECT * FROM customers WHERE id= ?", (rid,))
         return JSONResponse(dict(cur.fetchone()))
@@ -1772,9 +4231,10 @@ def api_update_customer(customer_id: int, payload: CustomerUpdate) -> JSONRespon
         raise HTTPException(status_code=400, detail="No fields to update")
     fields = [f"{k} = ?" for k in updates.keys()]
     values = list(updates.values()) + [customer_id]
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute(f"UPDATE customers SET {', '.join(fields)} WHERE id = ?", values)
+        _after_write(cur, "customers", customer_id, "update")
         con.commit()
         cur.execute("SELECT * FROM customers WHERE id= ?", (customer_id,))
         row = cur.fetchone()
@@ -1784,20 +4244,18 @@ def api_update_customer(customer_id: int, payload: CustomerUpdate) -> JSONRespon
 
 @app.delete("/api/customers/{customer_id}")
 def api_delete_customer(customer_id: int) -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute("DELETE FROM customers WHERE id= ?", (customer_id,))
+        _after_write(cur, "customers", customer_id, "delete")
         con.commit()
         return JSONResponse({"ok": True})
 
 # INVOICES (поддержка JSON и multipart)
 
 @app.get("/api/invoices")
-def api_get_invoices() -> JSONResponse:
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute("SELECT * FROM invoices ORDER BY id DESC")
-        return JSONResponse(_rows_to_dicts(cur.fetchall()))
+def api_get_invoices(request: Request) -> JSONResponse:
+    return _list_rows(request, "invoices", filters=("status", "customer", "object_id", "number"), date_col="date")
 
 async def _parse_invoice_request(request: Request) -> Dict[str, Any]:
     content_type = request.headers.get("content-type", "")
@@ -1838,27 +4296,30 @@ async def api_create_invoice(request: Request) -> JSONResponse:
             f.write(await upload.read())
         file_url = f"/files/{safe_name}"
 
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute(
-            """INSERT INTO invoices(number, date, amount, status, due_date, customer, object_id, comment, file_url, created_at)
-                 VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))""",
-            (
-                data.get("number"),
-                data.get("date"),
-                data.get("amount"),
-                data.get("status"),
-                data.get("due_date"),
-                data.get("customer"),
-                data.get("object_id"),
-                data.get("comment"),
-                file_url or data.get("file_url"),
-            ),
-        )
-        rid = cur.lastrowid
-        con.commit()
-        cur.execute("SELECT * FROM invoices WHERE id= ?", (rid,))
-        return JSONResponse(dict(cur.fetchone()))
+    def write() -> JSONResponse:
+        with _db() as con:
+            cur = con.cursor()
+            cur.execute(
+                """INSERT INTO invoices(number, date, amount, status, due_date, customer, object_id, comment, file_url, created_at)
+                     VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))""",
+                (
+                    data.get("number"),
+                    data.get("date"),
+                    data.get("amount"),
+                    data.get("status"),
+                    data.get("due_date"),
+                    data.get("customer"),
+                    data.get("object_id"),
+                    data.get("comment"),
+                    file_url or data.get("file_url"),
+                ),
+            )
+            rid = cur.lastrowid
+            _after_write(cur, "invoices", rid, "insert")
+            con.commit()
+            cur.execute("SELECT * FROM invoices WHERE id= ?", (rid,))
+            return JSONResponse(dict(cur.fetchone()))
+    return await run_in_threadpool(write)
 
 @app.patch("/api/invoices/{invoice_id}")
 async def api_update_invoice(invoice_id: int, request: Request) -> JSONResponse:
@@ -1887,32 +4348,33 @@ async def api_update_invoice(invoice_id: int, request: Request) -> JSONResponse:
 
     fields = [f"{k} = ?" for k in updates.keys()]
     values = list(updates.values()) + [invoice_id]
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute(f"UPDATE invoices SET {', '.join(fields)} WHERE id = ?", values)
-        con.commit()
-        cur.execute("SELECT * FROM invoices WHERE id= ?", (invoice_id,))
-        row = cur.fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="Invoice not found")
-        return JSONResponse(dict(row))
+    def write() -> JSONResponse:
+        with _db() as con:
+            cur = con.cursor()
+            cur.execute(f"UPDATE invoices SET {', '.join(fields)} WHERE id = ?", values)
+            _after_write(cur, "invoices", invoice_id, "update")
+            con.commit()
+            cur.execute("SELECT * FROM invoices WHERE id= ?", (invoice_id,))
+            row = cur.fetchone()
+            if not row:
+                raise HTTPException(status_code=404, detail="Invoice not found")
+            return JSONResponse(dict(row))
+    return await run_in_threadpool(write)
 
 @app.delete("/api/invoices/{invoice_id}")
 def api_delete_invoice(invoice_id: int) -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute("DELETE FROM invoices WHERE id= ?", (invoice_id,))
+        _after_write(cur, "invoices", invoice_id, "delete")
         con.commit()
         return JSONResponse({"ok": True})
 
 # ===== Бюджеты =====
 
 @app.get("/api/budgets")
-def api_get_budgets() -> JSONResponse:
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute("SELECT * FROM budgets ORDER BY id DESC")
-        return JSONResponse(_rows_to_dicts(cur.fetchall()))
+def api_get_budgets(request: Request) -> JSONResponse:
+    return _list_rows(request, "budgets", filters=("object_id", "category", "month", "year"))
 
 @app.post("/api/budgets")
 async def api_create_budget(request: Request) -> JSONResponse:
@@ -1920,25 +4382,28 @@ async def api_create_budget(request: Request) -> JSONResponse:
         data = await request.json()
     except:
         raise HTTPException(status_code=400, detail="Invalid JSON")
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute(
-            """INSERT INTO budgets(object_id, category, planned_amount, actual_amount, month, year, notes, created_at)
-                   VALUES(?, ?, ?, ?, ?, ?, ?, datetime('now'))""",
-            (
-                data.get("object_id"),
-                data.get("category"),
-                data.get("planned_amount"),
-                data.get("actual_amount", 0),
-                data.get("month"),
-                data.get("year"),
-                data.get("notes"),
-            ),
-        )
-        rid = cur.lastrowid
-        con.commit()
-        cur.execute("SELECT * FROM budgets WHERE id=?", (rid,))
-        return JSONResponse(dict(cur.fetchone()))
+    def write() -> JSONResponse:
+        with _db() as con:
+            cur = con.cursor()
+            cur.execute(
+                """INSERT INTO budgets(object_id, category, planned_amount, actual_amount, month, year, notes, created_at)
+                       VALUES(?, ?, ?, ?, ?, ?, ?, datetime('now'))""",
+                (
+                    data.get("object_id"),
+                    data.get("category"),
+                    data.get("planned_amount"),
+                    data.get("actual_amount", 0),
+                    data.get("month"),
+                    data.get("year"),
+                    data.get("notes"),
+                ),
+            )
+            rid = cur.lastrowid
+            _after_write(cur, "budgets", rid, "insert")
+            con.commit()
+            cur.execute("SELECT * FROM budgets WHERE id=?", (rid,))
+            return JSONResponse(dict(cur.fetchone()))
+    return await run_in_threadpool(write)
 
 @app.patch("/api/budgets/{budget_id}")
 async def api_update_budget(budget_id: int, request: Request) -> JSONResponse:
@@ -1954,32 +4419,36 @@ async def api_update_budget(budget_id: int, request: Request) -> JSONResponse:
         raise HTTPException(status_code=400, detail="No fields to update")
     fields = [f"{k} = ?" for k in updates.keys()]
     values = list(updates.values()) + [budget_id]
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute(f"UPDATE budgets SET {', '.join(fields)} WHERE id = ?", values)
-        con.commit()
-        cur.execute("SELECT * FROM budgets WHERE id=?", (budget_id,))
-        row = cur.fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="Budget not found")
-        return JSONResponse(dict(row))
+    def write() -> JSONResponse:
+        with _db() as con:
+            cur = con.cursor()
+            cur.execute(f"UPDATE budgets SET {', '.join(fields)} WHERE id = ?", values)
+            _after_write(cur, "budgets", budget_id, "update")
+            con.commit()
+            cur.execute("SELECT * FROM budgets WHERE id=?", (budget_id,))
+            row = cur.fetchone()
+            if not row:
+                raise HTTPException(status_code=404, detail="Budget not found")
+            return JSONResponse(dict(row))
+    return await run_in_threadpool(write)
 
 @app.delete("/api/budgets/{budget_id}")
 def api_delete_budget(budget_id: int) -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute("DELETE FROM budgets WHERE id=?", (budget_id,))
+        _after_write(cur, "budgets", budget_id, "delete")
         con.commit()
         return JSONResponse({"ok": True})
 
 # ===== Кассовые операции =====
 
 @app.get("/api/cash")
-def api_get_cash() -> JSONResponse:
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute("SELECT * FROM cash_transactions ORDER BY COALESCE(date, created_at) DESC, id DESC")
-        return JSONResponse(_rows_to_dicts(cur.fetchall()))
+def api_get_cash(request: Request) -> JSONResponse:
+    return _list_rows(
+        request, "cash_transactions", filters=("type", "category", "payment_method", "object_id", "user_id"),
+        date_col="COALESCE(date, created_at)", order="COALESCE(date, created_at, '')",
+    )
 
 @app.post("/api/cash")
 async def api_create_cash(request: Request) -> JSONResponse:
@@ -1987,27 +4456,30 @@ async def api_create_cash(request: Request) -> JSONResponse:
         data = await request.json()
     except:
         raise HTTPException(status_code=400, detail="Invalid JSON")
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute(
-            """INSERT INTO cash_transactions(type, amount, category, description, date, payment_method, object_id, user_id, notes, created_at)
-                   VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))""",
-            (
-                data.get("type"),
-                data.get("amount"),
-                data.get("category"),
-                data.get("description"),
-                data.get("date"),
-                data.get("payment_method"),
-                data.get("object_id"),
-                data.get("user_id"),
-                data.get("notes"),
-            ),
-        )
-        rid = cur.lastrowid
-        con.commit()
-        cur.execute("SELECT * FROM cash_transactions WHERE id=?", (rid,))
-        return JSONResponse(dict(cur.fetchone()))
+    def write() -> JSONResponse:
+        with _db() as con:
+            cur = con.cursor()
+            cur.execute(
+                """INSERT INTO cash_transactions(type, amount, category, description, date, payment_method, object_id, user_id, notes, created_at)
+                       VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))""",
+                (
+                    data.get("type"),
+                    data.get("amount"),
+                    data.get("category"),
+                    data.get("description"),
+                    data.get("date"),
+                    data.get("payment_method"),
+                    data.get("object_id"),
+                    data.get("user_id"),
+                    data.get("notes"),
+                ),
+            )
+            rid = cur.lastrowid
+            _after_write(cur, "cash_transactions", rid, "insert")
+            con.commit()
+            cur.execute("SELECT * FROM cash_transactions WHERE id=?", (rid,))
+            return JSONResponse(dict(cur.fetchone()))
+    return await run_in_threadpool(write)
 
 @app.patch("/api/cash/{cash_id}")
 async def api_update_cash(cash_id: int, request: Request) -> JSONResponse:
@@ -2023,59 +4495,66 @@ async def api_update_cash(cash_id: int, request: Request) -> JSONResponse:
         raise HTTPException(status_code=400, detail="No fields to update")
     fields = [f"{k} = ?" for k in updates.keys()]
     values = list(updates.values()) + [cash_id]
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute(f"UPDATE cash_transactions SET {', '.join(fields)} WHERE id = ?", values)
-        con.commit()
-        cur.execute("SELECT * FROM cash_transactions WHERE id=?", (cash_id,))
-        row = cur.fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="Cash transaction not found")
-        return JSONResponse(dict(row))
+    def write() -> JSONResponse:
+        with _db() as con:
+            cur = con.cursor()
+            cur.execute(f"UPDATE cash_transactions SET {', '.join(fields)} WHERE id = ?", values)
+            _after_write(cur, "cash_transactions", cash_id, "update")
+            con.commit()
+            cur.execute("SELECT * FROM cash_transactions WHERE id=?", (cash_id,))
+            row = cur.fetchone()
+            if not row:
+                raise HTTPException(status_code=404, detail="Cash transaction not found")
+            return JSONResponse(dict(row))
+    return await run_in_threadpool(write)
 
 @app.delete("/api/cash/{cash_id}")
 def api_delete_cash(cash_id: int) -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute("DELETE FROM cash_transactions WHERE id= ?", (cash_id,))
+        _after_write(cur, "cash_transactions", cash_id, "delete")
         con.commit()
         return JSONResponse({"ok": True})
 
 # ===== Оплаты =====
 
 @app.get("/api/payments")
-def api_get_payments() -> JSONResponse:
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute("SELECT * FROM payments ORDER BY COALESCE(date, created_at) DESC, id DESC")
-        return JSONResponse(_rows_to_dicts(cur.fetchall()))
+def api_get_payments(request: Request) -> JSONResponse:
+    return _list_rows(
+        request, "payments", filters=("source_type", "source_id", "method", "object_id", "counterparty"),
+        date_col="COALESCE(date, created_at)", order="COALESCE(date, created_at, '')",
+    )
 
 @app.post("/api/payments")
-async def api_create_payment(request: Request) -> JSONResponse:
-    try:
-        data = await request.json()
-    except:
-        raise HTTPException(status_code=400, detail="Invalid JSON")
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute(
-            """INSERT INTO payments(source_type, source_id, amount, date, method, counterparty, object_id, notes, created_at)
-                   VALUES(?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))""",
-            (
-                data.get("source_type"),
-                data.get("source_id"),
-                data.get("amount"),
-                data.get("date"),
-                data.get("method"),
-                data.get("counterparty"),
-                data.get("object_id"),
-                data.get("notes"),
-            ),
-        )
-        rid = cur.lastrowid
-        con.commit()
-        cur.execute("SELECT * FROM payments WHERE id=?", (rid,))
-        return JSONResponse(dict(cur.fetchone()))
+async def api_create_payment(request: Request) -> JSONResponse:
+    try:
+        data = await request.json()
+    except:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    def write() -> JSONResponse:
+        with _db() as con:
+            cur = con.cursor()
+            cur.execute(
+                """INSERT INTO payments(source_type, source_id, amount, date, method, counterparty, object_id, notes, created_at)
+                       VALUES(?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))""",
+                (
+                    data.get("source_type"),
+                    data.get("source_id"),
+                    data.get("amount"),
+                    data.get("date"),
+                    data.get("method"),
+                    data.get("counterparty"),
+                    data.get("object_id"),
+                    data.get("notes"),
+                ),
+            )
+            rid = cur.lastrowid
+            _after_write(cur, "payments", rid, "insert")
+            con.commit()
+            cur.execute("SELECT * FROM payments WHERE id=?", (rid,))
+            return JSONResponse(dict(cur.fetchone()))
+    return await run_in_threadpool(write)
 
 @app.patch("/api/payments/{payment_id}")
 async def api_update_payment(payment_id: int, request: Request) -> JSONResponse:
@@ -2091,32 +4570,36 @@ async def api_update_payment(payment_id: int, request: Request) -> JSONResponse:
         raise HTTPException(status_code=400, detail="No fields to update")
     fields = [f"{k} = ?" for k in updates.keys()]
     values = list(updates.values()) + [payment_id]
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute(f"UPDATE payments SET {', '.join(fields)} WHERE id = ?", values)
-        con.commit()
-        cur.execute("SELECT * FROM payments WHERE id=?", (payment_id,))
-        row = cur.fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="Payment not found")
-        return JSONResponse(dict(row))
+    def write() -> JSONResponse:
+        with _db() as con:
+            cur = con.cursor()
+            cur.execute(f"UPDATE payments SET {', '.join(fields)} WHERE id = ?", values)
+            _after_write(cur, "payments", payment_id, "update")
+            con.commit()
+            cur.execute("SELECT * FROM payments WHERE id=?", (payment_id,))
+            row = cur.fetchone()
+            if not row:
+                raise HTTPException(status_code=404, detail="Payment not found")
+            return JSONResponse(dict(row))
+    return await run_in_threadpool(write)
 
 @app.delete("/api/payments/{payment_id}")
 def api_delete_payment(payment_id: int) -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute("DELETE FROM payments WHERE id=?", (payment_id,))
+        _after_write(cur, "payments", payment_id, "delete")
         con.commit()
         return JSONResponse({"ok": True})
 
 # ===== Прочие расходы =====
 
 @app.get("/api/expenses/other")
-def api_get_other_expenses() -> JSONResponse:
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute("SELECT * FROM other_expenses ORDER BY COALESCE(date, created_at) DESC, id DESC")
-        return JSONResponse(_rows_to_dicts(cur.fetchall()))
+def api_get_other_expenses(request: Request) -> JSONResponse:
+    return _list_rows(
+        request, "other_expenses", filters=("category", "object_id", "supplier_id", "payment_status"),
+        date_col="COALESCE(date, created_at)", order="COALESCE(date, created_at, '')",
+    )
 
 @app.post("/api/expenses/other")
 async def api_create_other_expense(request: Request) -> JSONResponse:
@@ -2124,26 +4607,29 @@ async def api_create_other_expense(request: Request) -> JSONResponse:
         data = await request.json()
     except:
         raise HTTPException(status_code=400, detail="Invalid JSON")
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute(
-            """INSERT INTO other_expenses(category, amount, date, object_id, supplier_id, description, payment_status, due_date, created_at)
-                   VALUES(?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))""",
-            (
-                data.get("category"),
-                data.get("amount"),
-                data.get("date"),
-                data.get("object_id"),
-                data.get("supplier_id"),
-                data.get("description"),
-                data.get("payment_status"),
-                data.get("due_date"),
-            ),
-        )
-        rid = cur.lastrowid
-        con.commit()
-        cur.execute("SELECT * FROM other_expenses WHERE id=?", (rid,))
-        return JSONResponse(dict(cur.fetchone()))
+    def write() -> JSONResponse:
+        with _db() as con:
+            cur = con.cursor()
+            cur.execute(
+                """INSERT INTO other_expenses(category, amount, date, object_id, supplier_id, description, payment_status, due_date, created_at)
+                       VALUES(?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))""",
+                (
+                    data.get("category"),
+                    data.get("amount"),
+                    data.get("date"),
+                    data.get("object_id"),
+                    data.get("supplier_id"),
+                    data.get("description"),
+                    data.get("payment_status"),
+                    data.get("due_date"),
+                ),
+            )
+            rid = cur.lastrowid
+            _after_write(cur, "other_expenses", rid, "insert")
+            con.commit()
+            cur.execute("SELECT * FROM other_expenses WHERE id=?", (rid,))
+            return JSONResponse(dict(cur.fetchone()))
+    return await run_in_threadpool(write)
 
 @app.patch("/api/expenses/other/{expense_id}")
 async def api_update_other_expense(expense_id: int, request: Request) -> JSONResponse:
@@ -2159,344 +4645,554 @@ async def api_update_other_expense(expense_id: int, request: Request) -> JSONRes
         raise HTTPException(status_code=400, detail="No fields to update")
     fields = [f"{k} = ?" for k in updates.keys()]
     values = list(updates.values()) + [expense_id]
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute(f"UPDATE other_expenses SET {', '.join(fields)} WHERE id = ?", values)
-        con.commit()
-        cur.execute("SELECT * FROM other_expenses WHERE id=?", (expense_id,))
-        row = cur.fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="Expense not found")
-        return JSONResponse(dict(row))
+    def write() -> JSONResponse:
+        with _db() as con:
+            cur = con.cursor()
+            cur.execute(f"UPDATE other_expenses SET {', '.join(fields)} WHERE id = ?", values)
+            _after_write(cur, "other_expenses", expense_id, "update")
+            con.commit()
+            cur.execute("SELECT * FROM other_expenses WHERE id=?", (expense_id,))
+            row = cur.fetchone()
+            if not row:
+                raise HTTPException(status_code=404, detail="Expense not found")
+            return JSONResponse(dict(row))
+    return await run_in_threadpool(write)
 
 @app.delete("/api/expenses/other/{expense_id}")
 def api_delete_other_expense(expense_id: int) -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute("DELETE FROM other_expenses WHERE id=?", (expense_id,))
+        _after_write(cur, "other_expenses", expense_id, "delete")
         con.commit()
         return JSONResponse({"ok": True})
 
 # ===== Централизованный финансовый журнал и дебиторка =====
 
+# Источники журнала: source -> (таблица, алиас, SELECT колонок ledger без WHERE).
+# Колонки: doc_date, kind, category, amount, object_id, user_id, counterparty, description, status.
+LEDGER_SOURCES: Dict[str, tuple[str, str, str]] = {
+    "invoice": ("invoices", "i", """
+        SELECT 'invoice', i.id, COALESCE(i.date, i.created_at) AS doc_date, 'income', 'Счёт', COALESCE(i.amount, 0),
+               i.object_id, NULL, i.customer, i.comment, i.status
+        FROM invoices i"""),
+    "purchase": ("purchases", "p", """
+        SELECT 'purchase', p.id, COALESCE(p.date, p.created_at) AS doc_date, 'expense', COALESCE(p.type, 'Материалы'),
+               COALESCE(CAST(p.amount AS REAL), 0), p.object_id, p.assignee_id, NULL, p.notes, p.status
+        FROM purchases p"""),
+    "salary": ("salaries", "s", """
+        SELECT 'salary', s.id, s.date AS doc_date, 'expense', 'Зарплата', COALESCE(s.amount, 0),
+               s.object_id, s.user_id, NULL, s.reason, NULL
+        FROM salaries s"""),
+    "absence": ("absences", "a", """
+        SELECT 'absence', a.id, a.date AS doc_date, 'expense', 'Удержания', COALESCE(a.amount, 0),
+               a.object_id, a.user_id, NULL, a.comment, a.type
+        FROM absences a"""),
+    "cash": ("cash_transactions", "c", """
+        SELECT 'cash', c.id, COALESCE(c.date, c.created_at) AS doc_date, c.type,
+               COALESCE(c.category, CASE WHEN c.type='income' THEN 'Прочие доходы' ELSE 'Прочие расходы' END),
+               COALESCE(c.amount, 0), c.object_id, c.user_id, NULL, c.description, c.payment_method
+        FROM cash_transactions c"""),
+    "payment": ("payments", "pm", """
+        SELECT 'payment', pm.id, COALESCE(pm.date, pm.created_at) AS doc_date,
+               CASE WHEN COALESCE(pm.amount, 0) >= 0 THEN 'income' ELSE 'expense' END, 'Оплата',
+               COALESCE(pm.amount, 0), pm.object_id, NULL, pm.counterparty, pm.notes, pm.method
+        FROM payments pm"""),
+}
+LEDGER_VERSION = 1
+_LEDGER_BY_TABLE = {table: source for source, (table, _, _) in LEDGER_SOURCES.items()}
+_LEDGER_INSERT = """
+    INSERT INTO finance_ledger(source, source_id, doc_date, kind, category, amount, object_id, user_id,
+                               counterparty, description, status, date)
+    SELECT src.*, COALESCE(DATE(src.doc_date), src.doc_date, '') FROM ({select}) AS src
+"""
+# WHERE true снимает неоднозначность ON CONFLICT с ON у join в INSERT ... SELECT
+_LEDGER_UPSERT = _LEDGER_INSERT + """    WHERE true
+    ON CONFLICT(source, source_id) DO UPDATE SET
+        doc_date = excluded.doc_date, kind = excluded.kind, category = excluded.category,
+        amount = excluded.amount, object_id = excluded.object_id, user_id = excluded.user_id,
+        counterparty = excluded.counterparty, description = excluded.description,
+        status = excluded.status, date = excluded.date
+"""
+
+
+@_on_write(*_LEDGER_BY_TABLE)
+def _ledger_sync(cur: sqlite3.Cursor, table: str, row_id: int, op: str) -> None:
+    """Обновляет строку журнала на месте: id не меняется, курсоры (date, id) остаются валидными."""
+    source = _LEDGER_BY_TABLE[table]
+    if op == "delete":
+        cur.execute("DELETE FROM finance_ledger WHERE source = ? AND source_id = ?", (source, row_id))
+        return
+    _, alias, select = LEDGER_SOURCES[source]
+    cur.execute(_LEDGER_UPSERT.format(select=f"{select} WHERE {alias}.id = ?"), (row_id,))
+
+
+def _ledger_rebuild(cur: sqlite3.Cursor) -> None:
+    cur.execute("DELETE FROM finance_ledger")
+    for source, (_, _, select) in LEDGER_SOURCES.items():
+        try:
+            cur.execute(_LEDGER_INSERT.format(select=select))
+        except sqlite3.OperationalError as e:
+            print(f"⚠️ Журнал: источник {source} пропущен: {e}")
+
+
+def _init_ledger() -> None:
+    """Первичное заполнение finance_ledger (и пересборка при смене LEDGER_VERSION)."""
+    with _db() as con:
+        cur = con.cursor()
+        if _schema_version(cur, "finance_ledger") >= LEDGER_VERSION:
+            return
+        _ledger_rebuild(cur)
+        _set_schema_version(cur, "finance_ledger", LEDGER_VERSION)
+
+
+_init_ledger()
+
+
 @app.get("/api/finance/journal")
-def api_finance_journal() -> JSONResponse:
-    """Универсальный журнал: объединяем доходы/расходы из разных источников в один список."""
-    with _connect() as con:
+def api_finance_journal(
+    request: Request,
+    limit: int | None = None,
+    cursor: str | None = None,
+    kind: str | None = None,
+    source: str | None = None,
+    object_id: int | None = None,
+    user_id: int | None = None,
+    frm: str | None = None,
+    to: str | None = None,
+) -> JSONResponse:
+    """Универсальный журнал: объединяем доходы/расходы из разных источников в один список.
+
+    Читается из finance_ledger по индексу (date, id). Постранично: limit + cursor,
+    курсор следующей страницы приходит в заголовке X-Next-Cursor.
+    ``stream=1`` / ``Accept: application/x-ndjson`` — выгрузка NDJSON без ограничения limit.
+    """
+    conds: List[str] = []
+    params: List[Any] = []
+    for col, val in (("kind", kind), ("source", source), ("object_id", object_id), ("user_id", user_id)):
+        if val is not None:
+            conds.append(f"{col} = ?")
+            params.append(val)
+    if frm:
+        conds.append("date >= ?")
+        params.append(frm)
+    if to:
+        conds.append("date <= ?")
+        params.append(to)
+    if cursor:
+        try:
+            c_date, c_id = cursor.rsplit("|", 1)
+            params.extend([c_date, c_date, int(c_id)])
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        conds.append("date <= ? AND (date < ? OR id < ?)")
+    where = (" WHERE " + " AND ".join(conds)) if conds else ""
+    sql = f"""
+        SELECT doc_date AS date, kind, category, amount, object_id, user_id, counterparty,
+               description, source, source_id, status, id AS ledger_id, date AS ledger_date
+        FROM finance_ledger{where}
+        ORDER BY finance_ledger.date DESC, id DESC
+    """
+    if _wants_stream(request):
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(max(1, limit))
+        return _stream_rows(sql, params, exclude=("ledger_id", "ledger_date"))
+    if limit is not None:
+        limit = max(1, min(limit, 5000))
+        sql += " LIMIT ?"
+        params.append(limit + 1)
+    with _db() as con:
+        cur = con.cursor()
+        cur.execute(sql, params)
+        columns = [d[0] for d in cur.description]
+        cur.row_factory = None
+        rows = cur.fetchall()
+    headers: Dict[str, str] = {}
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        headers["X-Next-Cursor"] = f"{rows[-1][-1]}|{rows[-1][-2]}"
+    return RowsResponse(rows, columns, exclude=("ledger_id", "ledger_date"), headers=headers)
+
+AGING_BUCKETS = (("0-30", 0, 30), ("31-60", 31, 60), ("61-90", 61, 90), ("90+", 91, None))
+
+
+def _aging_bucket(days_overdue: int) -> str:
+    for name, lo, hi in AGING_BUCKETS:
+        if days_overdue >= lo and (hi is None or days_overdue <= hi):
+            return name
+    return AGING_BUCKETS[0][0]
+
+
+@app.get("/api/finance/receivables")
+def api_finance_receivables(summary: bool = False) -> JSONResponse:
+    """Дебиторка по счетам: все неоплаченные счета с просрочкой и сроками.
+
+    Остаток и дни просрочки считаются одним запросом (счета + агрегат оплат).
+    summary=1 возвращает также корзины старения и свод по заказчикам.
+    """
+    with _db() as con:
         cur = con.cursor()
-        # Приводим суммы к REAL, даты к COALESCE(date, created_at)
         cur.execute(
             """
-            SELECT COALESCE(i.date, i.created_at) AS date,
-                   'income' AS kind,
-                   'Счёт' AS category,
-                   COALESCE(i.amount, 0) AS amount,
-                   i.object_id AS object_id,
-                   NULL AS user_id,
-                   i.customer AS counterparty,
-                   i.comment AS description,
-                   'invoice' AS source,
-                   i.id AS source_id,
-                   i.status AS status
+            -- full-scan: нужен остаток по каждому счёту
+            SELECT i.id, i.number, i.date, i.due_date, i.customer, i.object_id, i.status,
+                   COALESCE(i.amount, 0) - COALESCE(p.paid, 0) AS outstanding,
+                   COALESCE(MAX(0, CAST(julianday('now') - julianday(NULLIF(i.due_date, '')) AS INTEGER)), 0) AS days_overdue
             FROM invoices i
-            UNION ALL
-            SELECT COALESCE(p.date, p.created_at) AS date,
-                   'expense' AS kind,
-                   COALESCE(p.type, 'Материалы') AS category,
-                   COALESCE(CAST(p.amount AS REAL), 0) AS amount,
-                   p.object_id AS object_id,
-                   p.assignee_id AS user_id,
-                   NULL AS counterparty,
-                   p.notes AS description,
-                   'purchase' AS source,
-                   p.id AS source_id,
-                   p.status AS status
-            FROM purchases p
-            UNION ALL
-            SELECT s.date AS date,
-                   'expense' AS kind,
-                   'Зарплата' AS category,
-                   COALESCE(s.amount, 0) AS amount,
-                   s.object_id AS object_id,
-                   s.user_id AS user_id,
-                   NULL AS counterparty,
-                   s.reason AS description,
-                   'salary' AS source,
-                   s.id AS source_id,
-                   NULL AS status
-            FROM salaries s
-            UNION ALL
-            SELECT a.date AS date,
-                   'expense' AS kind,
-                   'Удержания' AS category,
-                   COALESCE(a.amount, 0) AS amount,
-                   a.object_id AS object_id,
-                   a.user_id AS user_id,
-                   NULL AS counterparty,
-                   a.comment AS description,
-                   'absence' AS source,
-                   a.id AS source_id,
-                   a.type AS status
-            FROM absences a
-            UNION ALL
-            SELECT COALESCE(c.date, c.created_at) AS date,
-                   c.type AS kind,
-                   COALESCE(c.category, CASE WHEN c.type='income' THEN 'Прочие доходы' ELSE 'Прочие расходы' END) AS category,
-                   COALESCE(c.amount, 0) AS amount,
-                   c.object_id AS object_id,
-                   c.user_id AS user_id,
-                   NULL AS counterparty,
-                   c.description AS description,
-                   'cash' AS source,
-                   c.id AS source_id,
-                   c.payment_method AS status
-            FROM cash_transactions c
-            UNION ALL
-            SELECT COALESCE(date, created_at) AS date,
-                   CASE WHEN COALESCE(amount,0) >= 0 THEN 'income' ELSE 'expense' END AS kind,
-                   'Оплата' AS category,
-                   COALESCE(amount,0) AS amount,
-                   object_id,
-                   NULL AS user_id,
-                   counterparty,
-                   notes AS description,
-                   'payment' AS source,
-                   id AS source_id,
-                   method AS status
-            FROM payments
-            ORDER BY date DESC
+            LEFT JOIN (
+                SELECT source_id, SUM(amount) AS paid FROM payments
+                WHERE source_type = 'invoice' GROUP BY source_id
+            ) p ON p.source_id = i.id
+            WHERE COALESCE(i.amount, 0) - COALESCE(p.paid, 0) > 0
+            ORDER BY COALESCE(NULLIF(i.due_date, ''), NULLIF(i.date, ''), '')
             """
         )
-        return JSONResponse(_rows_to_dicts(cur.fetchall()))
-
-@app.get("/api/finance/receivables")
-def api_finance_receivables() -> JSONResponse:
-    """Дебиторка по счетам: все неоплаченные счета с просрочкой и сроками."""
-    with _connect() as con:
-        cur = con.cursor()
-        # Собираем остаток по каждому счёту: сумма счета - суммы оплат
-        cur.execute("SELECT id, number, date, due_date, customer, object_id, amount, status FROM invoices")
-        invoices = [dict(r) for r in cur.fetchall()]
-        # Оплаты по инвойсам
-        cur.execute("SELECT source_id, COALESCE(SUM(amount),0) FROM payments WHERE source_type='invoice' GROUP BY source_id")
-        paid_map = {int(r[0]): float(r[1]) for r in cur.fetchall() if r[0] is not None}
         res = []
-        for inv in invoices:
-            total = float(inv.get("amount") or 0)
-            paid = float(paid_map.get(int(inv["id"]), 0.0))
-            outstanding = max(0.0, total - paid)
-            if outstanding <= 0:
-                continue
-            due = inv.get("due_date")
-            days_overdue = 0
-            if due:
-                cur.execute("SELECT CAST((julianday('now') - julianday(?)) AS INTEGER)", (due,))
-                days_overdue = int(cur.fetchone()[0] or 0)
+        aging = {name: 0.0 for name, _, _ in AGING_BUCKETS}
+        customers: Dict[Any, Dict[str, Any]] = {}
+        for r in cur.fetchall():
+            outstanding = float(r["outstanding"])
+            days_overdue = int(r["days_overdue"])
+            bucket = _aging_bucket(days_overdue)
             res.append({
-                "id": inv["id"],
-                "number": inv.get("number"),
-                "date": inv.get("date"),
-                "due_date": inv.get("due_date"),
-                "customer": inv.get("customer"),
-                "object_id": inv.get("object_id"),
+                "id": r["id"],
+                "number": r["number"],
+                "date": r["date"],
+                "due_date": r["due_date"],
+                "customer": r["customer"],
+                "object_id": r["object_id"],
                 "amount": outstanding,
-                "status": inv.get("status"),
-                "days_overdue": max(0, days_overdue),
+                "status": r["status"],
+                "days_overdue": days_overdue,
+                "aging_bucket": bucket,
             })
-        # сортировка по сроку
-        res.sort(key=lambda r: (r.get("due_date") or r.get("date") or ""))
+            if summary:
+                aging[bucket] += outstanding
+                c = customers.setdefault(r["customer"], {
+                    "customer": r["customer"], "invoices": 0, "amount": 0.0, "max_days_overdue": 0,
+                    "aging": {name: 0.0 for name, _, _ in AGING_BUCKETS},
+                })
+                c["invoices"] += 1
+                c["amount"] += outstanding
+                c["max_days_overdue"] = max(c["max_days_overdue"], days_overdue)
+                c["aging"][bucket] += outstanding
+    if not summary:
         return JSONResponse(res)
+    return JSONResponse({
+        "items": res,
+        "total": sum(aging.values()),
+        "aging": aging,
+        "customers": sorted(customers.values(), key=lambda c: -c["amount"]),
+    })
 
 @app.get("/api/finance/payables")
-def api_finance_payables() -> JSONResponse:
-    """Кредиторка: поставщики (закупки, прочие расходы) и сотрудники (зарплаты unpaid)."""
-    with _connect() as con:
-        cur = con.cursor()
-        # Остаток по закупкам: сумма - оплаты (по source_type=purchase)
-        cur.execute("SELECT id, supplier_id, amount FROM purchases")
-        purchases = [dict(r) for r in cur.fetchall()]
-        cur.execute("SELECT source_id, COALESCE(SUM(amount),0) FROM payments WHERE source_type='purchase' GROUP BY source_id")
-        pay_purchase = {int(r[0]): float(r[1]) for r in cur.fetchall() if r[0] is not None}
-        purchases_owed: Dict[str, float] = {}
-        for p in purchases:
-            sup = str(p.get("supplier_id") or '')
-            total = float((p.get("amount") or 0))
-            paid = float(pay_purchase.get(int(p["id"]), 0.0))
-            rest = max(0.0, total - paid)
-            purchases_owed[sup] = purchases_owed.get(sup, 0.0) + rest
-        # Остаток по прочим расходам
-        cur.execute("SELECT id, supplier_id, amount FROM other_expenses")
-        others = [dict(r) for r in cur.fetchall()]
-        cur.execute("SELECT source_id, COALESCE(SUM(amount),0) FROM payments WHERE source_type='other' GROUP BY source_id")
-        pay_other = {int(r[0]): float(r[1]) for r in cur.fetchall() if r[0] is not None}
-        other_owed: Dict[str, float] = {}
-        for o in others:
-            sup = str(o.get("supplier_id") or '')
-            total = float((o.get("amount") or 0))
-            paid = float(pay_other.get(int(o["id"]), 0.0))
-            rest = max(0.0, total - paid)
-            other_owed[sup] = other_owed.get(sup, 0.0) + rest
-        # Сотрудники по зарплате
+def api_finance_payables(as_of: str | None = None, object_id: int | None = None) -> JSONResponse:
+    """Кредиторка: поставщики (закупки, прочие расходы) и сотрудники (зарплаты unpaid).
+
+    Один запрос: документы LEFT JOIN агрегат оплат, остаток по документу не ниже нуля,
+    затем свод по контрагенту с именем. as_of — на дату, object_id — по объекту.
+    """
+    doc_where, doc_params = _period_where("date", None, as_of, object_id)
+    pay_where, pay_params = _period_where("date", None, as_of, None)
+    pay_where = (pay_where + " AND " if pay_where else " WHERE ") + "source_type IN ('purchase', 'other', 'salary')"
+    with _db() as con:
+        cur = con.cursor()
         cur.execute(
-            """
-            SELECT s.id, s.user_id, s.amount FROM salaries s
-            """
+            f"""
+            WITH pay AS (
+                SELECT source_type, source_id, SUM(amount) AS paid
+                FROM payments{pay_where}
+                GROUP BY source_type, source_id
+            ),
+            owed AS (
+                SELECT 'supplier' AS party, p.supplier_id AS party_id, 'purchases' AS kind,
+                       MAX(0, COALESCE(CAST(p.amount AS REAL), 0) - COALESCE(pay.paid, 0)) AS rest
+                FROM purchases p
+                LEFT JOIN pay ON pay.source_type = 'purchase' AND pay.source_id = p.id{doc_where}
+                UNION ALL
+                SELECT 'supplier', o.supplier_id, 'other',
+                       MAX(0, COALESCE(o.amount, 0) - COALESCE(pay.paid, 0))
+                FROM other_expenses o
+                LEFT JOIN pay ON pay.source_type = 'other' AND pay.source_id = o.id{doc_where}
+                UNION ALL
+                SELECT 'employee', s.user_id, 'salaries',
+                       MAX(0, COALESCE(s.amount, 0) - COALESCE(pay.paid, 0))
+                FROM salaries s
+                LEFT JOIN pay ON pay.source_type = 'salary' AND pay.source_id = s.id{doc_where}
+            )
+            SELECT owed.party, owed.party_id, owed.kind, SUM(owed.rest) AS rest,
+                   COALESCE(sup.name, u.full_name, u.username) AS name
+            FROM owed
+            LEFT JOIN suppliers sup ON owed.party = 'supplier' AND sup.id = owed.party_id
+            LEFT JOIN users u ON owed.party = 'employee' AND u.id = owed.party_id
+            GROUP BY owed.party, owed.party_id, owed.kind
+            """,
+            (*pay_params, *doc_params, *doc_params, *doc_params),
         )
-        salaries = [dict(r) for r in cur.fetchall()]
-        cur.execute("SELECT source_id, COALESCE(SUM(amount),0) FROM payments WHERE source_type='salary' GROUP BY source_id")
-        pay_salary = {int(r[0]): float(r[1]) for r in cur.fetchall() if r[0] is not None}
-        salaries_owed: Dict[str, float] = {}
-        for s in salaries:
-            uid = str(s.get("user_id") or '')
-            total = float(s.get("amount") or 0)
-            paid = float(pay_salary.get(int(s["id"]), 0.0))
-            rest = max(0.0, total - paid)
-            salaries_owed[uid] = salaries_owed.get(uid, 0.0) + rest
+        suppliers: Dict[str, float] = {}
+        employees: Dict[str, float] = {}
+        balances: Dict[tuple, Dict[str, Any]] = {}
+        for party, party_id, kind, rest, name in cur.fetchall():
+            key = str(party_id or '')
+            amount = float(rest or 0)
+            target = suppliers if party == "supplier" else employees
+            target[key] = target.get(key, 0.0) + amount
+            b = balances.setdefault((party, key), {
+                ("supplier_id" if party == "supplier" else "user_id"): party_id,
+                "name": name,
+                "total": 0.0,
+            })
+            b[kind] = b.get(kind, 0.0) + amount
+            b["total"] += amount
         res = {
-            "suppliers": {k: purchases_owed.get(k,0) + other_owed.get(k,0) for k in set(purchases_owed)|set(other_owed)},
-            "employees": salaries_owed,
+            "suppliers": suppliers,
+            "employees": employees,
+            "supplier_balances": sorted((v for (p, _), v in balances.items() if p == "supplier"), key=lambda b: -b["total"]),
+            "employee_balances": sorted((v for (p, _), v in balances.items() if p == "employee"), key=lambda b: -b["total"]),
+            "as_of": as_of,
         }
         return JSONResponse(res)
 
 # ===== Финансовые отчёты: P&L и ДДС =====
 
+PERIOD_FORMATS = {"day": "%Y-%m-%d", "week": "%Y-W%W", "month": "%Y-%m"}
+
+
+def _period_expr(col: str, group_by: str | None) -> str:
+    """SQL-выражение ключа периода для группировки по day/week/month."""
+    if group_by is None:
+        return "NULL"
+    fmt = PERIOD_FORMATS.get(group_by)
+    if fmt is None:
+        raise HTTPException(status_code=400, detail="group_by must be one of: day, week, month")
+    return f"strftime('{fmt}', {col})"
+
+
+def _period_where(col: str, frm: str | None, to: str | None, object_id: int | None) -> tuple[str, List[Any]]:
+    """Условие по периоду и объекту; строки без даты, как и раньше, попадают в любой период."""
+    conds: List[str] = []
+    params: List[Any] = []
+    if frm:
+        conds.append(f"({col} IS NULL OR {col} = '' OR {col} >= ?)")
+        params.append(frm)
+    if to:
+        conds.append(f"({col} IS NULL OR {col} = '' OR {col} <= ?)")
+        params.append(to)
+    if object_id is not None:
+        conds.append("object_id = ?")
+        params.append(object_id)
+    return (" WHERE " + " AND ".join(conds)) if conds else "", params
+
+
+PNL_SOURCES = (
+    ("income", "invoices", "COALESCE(amount, 0)"),
+    ("purchases", "purchases", "COALESCE(CAST(amount AS REAL), 0)"),
+    ("salaries", "salaries", "COALESCE(amount, 0)"),
+    ("other", "other_expenses", "COALESCE(amount, 0)"),
+    ("material_cost", "cost_allocations", "cost"),
+)
+
+
 @app.get("/api/finance/pnl")
-def api_finance_pnl(frm: str | None = None, to: str | None = None, object_id: int | None = None) -> JSONResponse:
-    """Отчёт прибыль/убыток по периодам (актуально: по дате документа)."""
-    def within(d: str | None) -> bool:
-        if not d:
-            return True
-        if frm and d < frm:
-            return False
-        if to and d > to:
-            return False
-        return True
-    with _connect() as con:
-        cur = con.cursor()
-        # Доходы (инвойсы)
-        cur.execute("SELECT date, amount, object_id FROM invoices")
-        invoices = [dict(r) for r in cur.fetchall()]
-        income_total = sum(float(i.get("amount") or 0) for i in invoices if within(i.get("date")) and (object_id is None or i.get("object_id") == object_id))
-        # Расходы: закупки/зарплаты/прочие
-        cur.execute("SELECT date, amount, object_id FROM purchases")
-        purchases = [dict(r) for r in cur.fetchall()]
-        purchases_total = sum(float((p.get("amount") or 0)) for p in purchases if within(p.get("date")) and (object_id is None or p.get("object_id") == object_id))
-        cur.execute("SELECT date, amount, object_id FROM salaries")
-        salaries = [dict(r) for r in cur.fetchall()]
-        salaries_total = sum(float((s.get("amount") or 0)) for s in salaries if within(s.get("date")) and (object_id is None or s.get("object_id") == object_id))
-        cur.execute("SELECT date, amount, object_id FROM other_expenses")
-        others = [dict(r) for r in cur.fetchall()]
-        others_total = sum(float((o.get("amount") or 0)) for o in others if within(o.get("date")) and (object_id is None or o.get("object_id") == object_id))
-        expenses_total = purchases_total + salaries_total + others_total
-        pnl = {
-            "income": income_total,
-            "expenses": {
-                "purchases": purchases_total,
-                "salaries": salaries_total,
-                "other": others_total,
-            },
-            "profit": income_total - expenses_total,
-        }
-        return JSONResponse(pnl)
+def api_finance_pnl(
+    frm: str | None = None,
+    to: str | None = None,
+    object_id: int | None = None,
+    group_by: str | None = None,
+) -> JSONResponse:
+    """Отчёт прибыль/убыток по периодам (актуально: по дате документа).
+
+    Суммы считаются в SQL одним запросом по индексам (date, object_id);
+    group_by=day|week|month добавляет разбивку по периодам, by_object — по объектам.
+    material_cost — себестоимость списанных материалов из cost_allocations; в прибыль
+    не входит, т.к. закупки уже учтены в expenses.purchases.
+    """
+    period = _period_expr("date", group_by)
+    parts: List[str] = []
+    params: List[Any] = []
+    for key, table, amount in PNL_SOURCES:
+        where, p = _period_where("date", frm, to, object_id)
+        parts.append(
+            f"SELECT '{key}' AS src, {period} AS period, object_id, SUM({amount}) AS total "
+            f"FROM {table}{where} GROUP BY period, object_id"
+        )
+        params.extend(p)
+
+    def _empty() -> Dict[str, Any]:
+        return {"income": 0.0, "expenses": {"purchases": 0.0, "salaries": 0.0, "other": 0.0}, "material_cost": 0.0}
+
+    totals = _empty()
+    by_object: Dict[Any, Dict[str, Any]] = {}
+    by_period: Dict[Any, Dict[str, Any]] = {}
+    with _db() as con:
+        cur = con.cursor()
+        cur.execute(" UNION ALL ".join(parts), params)
+        for src, per, obj, total in cur.fetchall():
+            amount = float(total or 0)
+            targets = [totals, by_object.setdefault(obj, _empty())]
+            if group_by:
+                targets.append(by_period.setdefault(per, _empty()))
+            for t in targets:
+                if src == "income":
+                    t["income"] += amount
+                elif src == "material_cost":
+                    t["material_cost"] += amount
+                else:
+                    t["expenses"][src] += amount
+
+    def _finish(t: Dict[str, Any]) -> Dict[str, Any]:
+        t["profit"] = t["income"] - sum(t["expenses"].values())
+        return t
+
+    pnl = _finish(totals)
+    pnl["by_object"] = [
+        {"object_id": k, **_finish(v)}
+        for k, v in sorted(by_object.items(), key=lambda kv: (kv[0] is None, kv[0] or 0))
+    ]
+    if group_by:
+        pnl["group_by"] = group_by
+        pnl["periods"] = [
+            {"period": k, **_finish(v)}
+            for k, v in sorted(by_period.items(), key=lambda kv: (kv[0] is None, kv[0] or ""))
+        ]
+    return JSONResponse(pnl)
 
 @app.get("/api/finance/cashflow")
-def api_finance_cashflow(frm: str | None = None, to: str | None = None, object_id: int | None = None) -> JSONResponse:
-    """Денежный поток: на основе кассовых операций и оплат."""
-    def within(d: str | None) -> bool:
-        if not d:
-            return True
-        if frm and d < frm:
-            return False
-        if to and d > to:
-            return False
-        return True
-    with _connect() as con:
-        cur = con.cursor()
-        # Касса
-        cur.execute("SELECT type, amount, date, payment_method, object_id FROM cash_transactions")
-        cash = [dict(r) for r in cur.fetchall()]
-        # Оплаты
-        cur.execute("SELECT amount, date, method, object_id FROM payments")
-        pay = [dict(r) for r in cur.fetchall()]
-        inflow = 0.0
-        outflow = 0.0
-        by_method: Dict[str, Dict[str, float]] = {}
-        # Учтём кассу
-        for c in cash:
-            if not within(c.get("date")) or (object_id is not None and c.get("object_id") != object_id):
-                continue
-            amt = float(c.get("amount") or 0)
-            m = str(c.get("payment_method") or 'other')
-            if c.get("type") == 'income':
+def api_finance_cashflow(
+    frm: str | None = None,
+    to: str | None = None,
+    object_id: int | None = None,
+    group_by: str | None = None,
+) -> JSONResponse:
+    """Денежный поток: на основе кассовых операций и оплат.
+
+    Группировка по способу оплаты и периоду выполняется в SQL по индексу (date, object_id);
+    group_by=day|week|month добавляет временной ряд series.
+    """
+    period = _period_expr("date", group_by)
+    cash_where, cash_params = _period_where("date", frm, to, object_id)
+    pay_where, pay_params = _period_where("date", frm, to, object_id)
+    inflow = 0.0
+    outflow = 0.0
+    by_method: Dict[str, Dict[str, float]] = {}
+    series: Dict[Any, Dict[str, float]] = {}
+    with _db() as con:
+        cur = con.cursor()
+        # Касса: всё, что не income, — расход; оплаты: знак суммы задаёт направление
+        cur.execute(
+            f"""
+            SELECT COALESCE(NULLIF(payment_method, ''), 'other') AS method,
+                   CASE WHEN type = 'income' THEN 'income' ELSE 'expense' END AS kind,
+                   {period} AS period,
+                   SUM(COALESCE(amount, 0)) AS total
+            FROM cash_transactions{cash_where}
+            GROUP BY method, kind, period
+            UNION ALL
+            SELECT COALESCE(NULLIF(method, ''), 'other') AS method,
+                   CASE WHEN COALESCE(amount, 0) >= 0 THEN 'income' ELSE 'expense' END AS kind,
+                   {period} AS period,
+                   SUM(ABS(COALESCE(amount, 0))) AS total
+            FROM payments{pay_where}
+            GROUP BY method, kind, period
+            """,
+            (*cash_params, *pay_params),
+        )
+        for method, kind, per, total in cur.fetchall():
+            amt = float(total or 0)
+            if kind == "income":
                 inflow += amt
-                by_method.setdefault(m, {"income": 0.0, "expense": 0.0})["income"] += amt
             else:
                 outflow += amt
-                by_method.setdefault(m, {"income": 0.0, "expense": 0.0})["expense"] += amt
-        # Учтём оплаты (они уже учитывают факт денег)
-        for p in pay:
-            if not within(p.get("date")) or (object_id is not None and p.get("object_id") != object_id):
-                continue
-            amt = float(p.get("amount") or 0)
-            m = str(p.get("method") or 'other')
-            if amt >= 0:
-                inflow += amt
-                by_method.setdefault(m, {"income": 0.0, "expense": 0.0})["income"] += amt
-            else:
-                outflow += abs(amt)
-                by_method.setdefault(m, {"income": 0.0, "expense": 0.0})["expense"] += abs(amt)
-        return JSONResponse({
-            "inflow": inflow,
-            "outflow": outflow,
-            "net": inflow - outflow,
-            "by_method": by_method,
-        })
+            by_method.setdefault(method, {"income": 0.0, "expense": 0.0})[kind] += amt
+            if group_by:
+                point = series.setdefault(per, {"inflow": 0.0, "outflow": 0.0})
+                point["inflow" if kind == "income" else "outflow"] += amt
+    res: Dict[str, Any] = {
+        "inflow": inflow,
+        "outflow": outflow,
+        "net": inflow - outflow,
+        "by_method": by_method,
+    }
+    if group_by:
+        res["group_by"] = group_by
+        res["series"] = [
+            {"period": k, **v, "net": v["inflow"] - v["outflow"]}
+            for k, v in sorted(series.items(), key=lambda kv: (kv[0] is None, kv[0] or ""))
+        ]
+    return JSONResponse(res)
 
 # ===== Материалы: агрегаты и история =====
 
 @app.get("/api/materials")
-def api_materials_stock() -> JSONResponse:
-    with _connect() as con:
+def api_materials_stock(as_of: str | None = None) -> JSONResponse:
+    """Остатки склада из stock_balances (поддерживается хуком записи purchases).
+
+    ``as_of=YYYY-MM-DD`` — остатки на конец указанного дня по месячным снимкам.
+    """
+    if as_of is not None:
+        try:
+            as_of = date.fromisoformat(as_of).isoformat()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="as_of must be YYYY-MM-DD")
+        with _db() as con:
+            cur = con.cursor()
+            if _stock_snapshots_due(cur):
+                with _write_tx():
+                    _ensure_stock_snapshots(cur)
+            return RowsResponse(_stock_as_of(cur, as_of))
+    with _db() as con:
         cur = con.cursor()
         cur.execute(
-            f"""
-            SELECT item, unit, type,
-                   COALESCE(SUM(CASE WHEN status IN ({','.join(['?']*len(IN_STATUSES))}) THEN COALESCE(qty,0) ELSE 0 END),0) AS in_qty,
-                   COALESCE(SUM(CASE WHEN status IN ({','.join(['?']*len(OUT_STATUSES))}) THEN COALESCE(qty,0) ELSE 0 END),0) AS out_qty
-            FROM purchases
-            GROUP BY item, unit, type
-            ORDER BY item COLLATE NOCASE
-            """,
-            (*IN_STATUSES, *OUT_STATUSES),
+            """
+            -- full-scan: выдаётся весь склад
+            SELECT item, unit, type, in_qty, out_qty, in_qty - out_qty AS balance
+            FROM stock_balances
+            WHERE in_qty != 0 OR out_qty != 0
+            ORDER BY item_key, unit_norm, type_norm
+            """
         )
-        rows = cur.fetchall()
-        res = []
-        for r in rows:
-            item, unit, mtype, in_q, out_q = r[0], r[1], r[2], float(r[3] or 0), float(r[4] or 0)
-            res.append({
-                "item": item,
-                "unit": unit,
-                "type": mtype,
-                "in_qty": in_q,
-                "out_qty": out_q,
-                "balance": in_q - out_q,
-            })
-        return JSONResponse(res)
+        return RowsResponse(cur)
 
-@app.get("/api/materials/history")
-def api_materials_history() -> JSONResponse:
-    with _connect() as con:
+@app.get("/api/materials/costs")
+def api_material_costs(
+    frm: str | None = None,
+    to: str | None = None,
+    object_id: int | None = None,
+) -> JSONResponse:
+    """Себестоимость списанных материалов по объектам (метод — COSTING_METHOD).
+
+    Читает готовые суммы из cost_allocations, которые поддерживает хук записи purchases.
+    """
+    where, params = _period_where("date", frm, to, object_id)
+    with _db() as con:
         cur = con.cursor()
         cur.execute(
             f"""
-            SELECT id, item, qty, unit, type, status, object_id, assignee_id, supplier_id, url, date, notes, receipt_file, created_at
-            FROM purchases
-            WHERE status IN ({','.join(['?']*(len(IN_STATUSES)+len(OUT_STATUSES)))})
-            ORDER BY COALESCE(date, created_at) DESC, id DESC
+            SELECT object_id, SUM(qty) AS qty, SUM(cost) AS cost, COUNT(*) AS issues
+            FROM cost_allocations{where}
+            GROUP BY object_id
+            ORDER BY object_id
             """,
-            (*IN_STATUSES, *OUT_STATUSES),
+            params,
         )
-        return JSONResponse(_rows_to_dicts(cur.fetchall())) 
+        return RowsResponse(cur)
+
+@app.get("/api/materials/history")
+def api_materials_history(request: Request) -> JSONResponse:
+    sql = f"""
+        SELECT id, item, qty, unit, type, status, object_id, assignee_id, supplier_id, url, date, notes, receipt_file, created_at
+        FROM purchases
+        WHERE status IN ({','.join(['?']*(len(IN_STATUSES)+len(OUT_STATUSES)))})
+        ORDER BY COALESCE(date, created_at) DESC, id DESC
+    """
+    params = (*IN_STATUSES, *OUT_STATUSES)
+    if _wants_stream(request):
+        return _stream_rows(sql, params)
+    with _db() as con:
+        cur = con.cursor()
+        cur.execute(sql, params)
+        return RowsResponse(cur)
 
 @app.patch("/api/materials/history/{history_id}")
 async def api_update_materials_history(history_id: int, request: Request) -> JSONResponse:
@@ -2507,38 +5203,41 @@ async def api_update_materials_history(history_id: int, request: Request) -> JSO
         raise HTTPException(status_code=400, detail="Invalid JSON")
     
     # Проверяем, что запись существует
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute("SELECT id FROM purchases WHERE id = ?", (history_id,))
-        if not cur.fetchone():
-            raise HTTPException(status_code=404, detail="History record not found")
+    def write() -> JSONResponse:
+        with _db() as con:
+            cur = con.cursor()
+            cur.execute("SELECT id FROM purchases WHERE id = ?", (history_id,))
+            if not cur.fetchone():
+                raise HTTPException(status_code=404, detail="History record not found")
         
-        # Собираем поля для обновления
-        updates: Dict[str, Any] = {}
-        for key in ("item", "qty", "unit", "type", "status", "object_id", "assignee_id", "date", "notes"):
-            if key in data and data[key] is not None:
-                updates[key] = data[key]
+            # Собираем поля для обновления
+            updates: Dict[str, Any] = {}
+            for key in ("item", "qty", "unit", "type", "status", "object_id", "assignee_id", "date", "notes"):
+                if key in data and data[key] is not None:
+                    updates[key] = data[key]
         
-        if not updates:
-            raise HTTPException(status_code=400, detail="No fields to update")
+            if not updates:
+                raise HTTPException(status_code=400, detail="No fields to update")
         
-        # Обновляем запись
-        fields = [f"{k} = ?" for k in updates.keys()]
-        values = list(updates.values()) + [history_id]
-        cur.execute(f"UPDATE purchases SET {', '.join(fields)} WHERE id = ?", values)
-        con.commit()
+            # Обновляем запись
+            fields = [f"{k} = ?" for k in updates.keys()]
+            values = list(updates.values()) + [history_id]
+            cur.execute(f"UPDATE purchases SET {', '.join(fields)} WHERE id = ?", values)
+            _after_write(cur, "purchases", history_id, "update")
+            con.commit()
         
-        # Возвращаем обновленную запись
-        cur.execute("SELECT * FROM purchases WHERE id = ?", (history_id,))
-        row = cur.fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="History record not found after update")
-        return JSONResponse(dict(row))
+            # Возвращаем обновленную запись
+            cur.execute("SELECT * FROM purchases WHERE id = ?", (history_id,))
+            row = cur.fetchone()
+            if not row:
+                raise HTTPException(status_code=404, detail="History record not found after update")
+            return JSONResponse(dict(row))
+    return await run_in_threadpool(write)
 
 @app.delete("/api/materials/history/{history_id}")
 def api_delete_materials_history(history_id: int) -> JSONResponse:
     """Удаление записи истории материалов"""
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         # Проверяем, что запись существует
         cur.execute("SELECT id FROM purchases WHERE id = ?", (history_id,))
@@ -2547,13 +5246,14 @@ def api_delete_materials_history(history_id: int) -> JSONResponse:
         
         # Удаляем запись
         cur.execute("DELETE FROM purchases WHERE id = ?", (history_id,))
+        _after_write(cur, "purchases", history_id, "delete")
         con.commit()
         return JSONResponse({"ok": True, "message": "History record deleted successfully"})
 
 @app.delete("/api/purchases/{purchase_id}")
 def api_delete_purchase(purchase_id: int) -> JSONResponse:
     """Удаление закупки"""
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         # Проверяем, что запись существует
         cur.execute("SELECT id FROM purchases WHERE id = ?", (purchase_id,))
@@ -2562,17 +5262,18 @@ def api_delete_purchase(purchase_id: int) -> JSONResponse:
         
         # Удаляем запись
         cur.execute("DELETE FROM purchases WHERE id = ?", (purchase_id,))
+        _after_write(cur, "purchases", purchase_id, "delete")
         con.commit()
         return JSONResponse({"ok": True, "message": "Purchase deleted successfully"}) 
 
 # ===== Складские списания =====
 
 @app.get("/api/warehouse/consumption")
-def api_get_warehouse_consumption() -> JSONResponse:
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute("SELECT * FROM warehouse_consumption ORDER BY consumption_date DESC, id DESC")
-        return JSONResponse(_rows_to_dicts(cur.fetchall()))
+def api_get_warehouse_consumption(request: Request) -> JSONResponse:
+    return _list_rows(
+        request, "warehouse_consumption", filters=("object_id", "user_id", "item_id", "item_name"),
+        date_col="consumption_date", order="consumption_date",
+    )
 
 @app.post("/api/warehouse/consumption")
 async def api_create_warehouse_consumption(request: Request) -> JSONResponse:
@@ -2581,30 +5282,33 @@ async def api_create_warehouse_consumption(request: Request) -> JSONResponse:
     except:
         raise HTTPException(status_code=400, detail="Invalid JSON")
     
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute(
-            """INSERT INTO warehouse_consumption(
-                object_id, item_id, item_name, quantity, unit, unit_price, 
-                total_amount, consumption_date, reason, user_id, created_at
-            ) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))""",
-            (
-                data.get("object_id"),
-                data.get("item_id"),
-                data.get("item_name"),
-                data.get("quantity"),
-                data.get("unit"),
-                data.get("unit_price"),
-                data.get("total_amount"),
-                data.get("consumption_date"),
-                data.get("reason"),
-                data.get("user_id"),
-            ),
-        )
-        rid = cur.lastrowid
-        con.commit()
-        cur.execute("SELECT * FROM warehouse_consumption WHERE id=?", (rid,))
-        return JSONResponse(dict(cur.fetchone()))
+    def write() -> JSONResponse:
+        with _db() as con:
+            cur = con.cursor()
+            cur.execute(
+                """INSERT INTO warehouse_consumption(
+                    object_id, item_id, item_name, quantity, unit, unit_price, 
+                    total_amount, consumption_date, reason, user_id, created_at
+                ) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))""",
+                (
+                    data.get("object_id"),
+                    data.get("item_id"),
+                    data.get("item_name"),
+                    data.get("quantity"),
+                    data.get("unit"),
+                    data.get("unit_price"),
+                    data.get("total_amount"),
+                    data.get("consumption_date"),
+                    data.get("reason"),
+                    data.get("user_id"),
+                ),
+            )
+            rid = cur.lastrowid
+            _after_write(cur, "warehouse_consumption", rid, "insert")
+            con.commit()
+            cur.execute("SELECT * FROM warehouse_consumption WHERE id=?", (rid,))
+            return JSONResponse(dict(cur.fetchone()))
+    return await run_in_threadpool(write)
 
 @app.patch("/api/warehouse/consumption/{consumption_id}")
 async def api_update_warehouse_consumption(consumption_id: int, request: Request) -> JSONResponse:
@@ -2613,36 +5317,40 @@ async def api_update_warehouse_consumption(consumption_id: int, request: Request
     except:
         raise HTTPException(status_code=400, detail="Invalid JSON")
     
-    with _connect() as con:
-        cur = con.cursor()
-        updates = []
-        params = []
-        for key, value in data.items():
-            if key in ["object_id", "item_id", "item_name", "quantity", "unit", "unit_price", 
-                      "total_amount", "consumption_date", "reason", "user_id"]:
-                updates.append(f"{key} = ?")
-                params.append(value)
+    def write() -> JSONResponse:
+        with _db() as con:
+            cur = con.cursor()
+            updates = []
+            params = []
+            for key, value in data.items():
+                if key in ["object_id", "item_id", "item_name", "quantity", "unit", "unit_price", 
+                          "total_amount", "consumption_date", "reason", "user_id"]:
+                    updates.append(f"{key} = ?")
+                    params.append(value)
         
-        if not updates:
-            raise HTTPException(status_code=400, detail="No valid fields to update")
+            if not updates:
+                raise HTTPException(status_code=400, detail="No valid fields to update")
         
-        params.append(consumption_id)
-        cur.execute(f"UPDATE warehouse_consumption SET {', '.join(updates)} WHERE id = ?", params)
+            params.append(consumption_id)
+            cur.execute(f"UPDATE warehouse_consumption SET {', '.join(updates)} WHERE id = ?", params)
         
-        if cur.rowcount == 0:
-            raise HTTPException(status_code=404, detail="Warehouse consumption not found")
+            if cur.rowcount == 0:
+                raise HTTPException(status_code=404, detail="Warehouse consumption not found")
         
-        con.commit()
-        cur.execute("SELECT * FROM warehouse_consumption WHERE id=?", (consumption_id,))
-        return JSONResponse(dict(cur.fetchone()))
+            _after_write(cur, "warehouse_consumption", consumption_id, "update")
+            con.commit()
+            cur.execute("SELECT * FROM warehouse_consumption WHERE id=?", (consumption_id,))
+            return JSONResponse(dict(cur.fetchone()))
+    return await run_in_threadpool(write)
 
 @app.delete("/api/warehouse/consumption/{consumption_id}")
 def api_delete_warehouse_consumption(consumption_id: int) -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute("DELETE FROM warehouse_consumption WHERE id=?", (consumption_id,))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Warehouse consumption not found")
+        _after_write(cur, "warehouse_consumption", consumption_id, "delete")
         con.commit()
         return JSONResponse({"ok": True})
 
@@ -2682,7 +5390,7 @@ class ObjectUpdate(BaseModel):
 
 @app.post("/api/objects")
 def create_object(payload: ObjectCreate) -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute(
             """INSERT INTO objects(name, description, topic_id, address, plan, goal, actions, visibility_admin, visibility_foreman, visibility_worker, created_by, start_date, end_date, budget, status, created_at)
@@ -2690,6 +5398,7 @@ def create_object(payload: ObjectCreate) -> JSONResponse:
             (payload.name, payload.description, payload.topic_id, payload.address, payload.plan, payload.goal, payload.actions, payload.visibility_admin, payload.visibility_foreman, payload.visibility_worker, payload.created_by, payload.start_date, payload.end_date, payload.budget, payload.status),
         )
         rid = cur.lastrowid
+        _after_write(cur, "objects", rid, "insert")
         con.commit()
         cur.execute("SELECT * FROM objects WHERE id=?", (rid,))
         return JSONResponse(dict(cur.fetchone()))
@@ -2701,9 +5410,10 @@ def update_object(object_id: int, payload: ObjectUpdate) -> JSONResponse:
         raise HTTPException(status_code=400, detail="No fields to update")
     fields = [f"{k} = ?" for k in updates.keys()]
     values = list(updates.values()) + [object_id]
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute(f"UPDATE objects SET {', '.join(fields)} WHERE id = ?", values)
+        _after_write(cur, "objects", object_id, "update")
         con.commit()
         cur.execute("SELECT * FROM objects WHERE id=?", (object_id,))
         row = cur.fetchone()
@@ -2713,11 +5423,12 @@ def update_object(object_id: int, payload: ObjectUpdate) -> JSONResponse:
 
 @app.delete("/api/objects/{object_id}")
 def delete_object(object_id: int) -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute("DELETE FROM objects WHERE id=?", (object_id,))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Object not found")
+        _after_write(cur, "objects", object_id, "delete")
         con.commit()
         return JSONResponse({"ok": True})
 
@@ -2779,7 +5490,7 @@ class UserUpdate(BaseModel):
 
 @app.post("/api/users")
 def create_user(payload: UserCreate) -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute(
             """INSERT INTO users(username, full_name, role, phone, email, position, department, hire_date, salary, 
@@ -2794,6 +5505,7 @@ def create_user(payload: UserCreate) -> JSONResponse:
              payload.meals_included, payload.transport_provided, payload.transport_type, payload.utilities_included),
         )
         rid = cur.lastrowid
+        _after_write(cur, "users", rid, "insert")
         con.commit()
         cur.execute("SELECT * FROM users WHERE id=?", (rid,))
         return JSONResponse(dict(cur.fetchone()))
@@ -2834,23 +5546,26 @@ async def update_user(user_id: int, request: Request) -> JSONResponse:
         print(f"📊 SQL поля: {fields}")
         print(f"📊 SQL значения: {values}")
         
-        with _connect() as con:
-            cur = con.cursor()
-            sql_query = f"UPDATE users SET {', '.join(fields)} WHERE id = ?"
-            print(f"🔍 SQL запрос: {sql_query}")
+        def write() -> JSONResponse:
+            with _db() as con:
+                cur = con.cursor()
+                sql_query = f"UPDATE users SET {', '.join(fields)} WHERE id = ?"
+                print(f"🔍 SQL запрос: {sql_query}")
             
-            cur.execute(sql_query, values)
-            con.commit()
+                cur.execute(sql_query, values)
+                _after_write(cur, "users", user_id, "update")
+                con.commit()
             
-            print(f"✅ Обновление выполнено, затронуто строк: {cur.rowcount}")
+                print(f"✅ Обновление выполнено, затронуто строк: {cur.rowcount}")
             
-            cur.execute("SELECT * FROM users WHERE id=?", (user_id,))
-            row = cur.fetchone()
-            if not row:
-                raise HTTPException(status_code=404, detail="User not found")
+                cur.execute("SELECT * FROM users WHERE id=?", (user_id,))
+                row = cur.fetchone()
+                if not row:
+                    raise HTTPException(status_code=404, detail="User not found")
             
-            print(f"✅ Пользователь найден: {dict(row)}")
-            return JSONResponse(dict(row))
+                print(f"✅ Пользователь найден: {dict(row)}")
+                return JSONResponse(dict(row))
+        return await run_in_threadpool(write)
             
     except Exception as e:
         print(f"❌ Ошибка при обновлении пользователя: {e}")
@@ -2862,11 +5577,12 @@ async def update_user(user_id: int, request: Request) -> JSONResponse:
 @app.delete("/api/users/{user_id}")
 def delete_user(user_id: int) -> JSONResponse:
     """Мягкое удаление (архивирование) пользователя"""
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute("UPDATE users SET status = COALESCE(status, 'active'), archived_at = datetime('now') WHERE id = ?", (user_id,))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="User not found")
+        _after_write(cur, "users", user_id, "update")
         con.commit()
         return JSONResponse({"ok": True, "archived": True})
 
@@ -2910,19 +5626,22 @@ async def upload_user_photo(
         # Обновляем URL фото в базе данных
         photo_url = f"/files/photos/{filename}"
         
-        with _connect() as con:
-            cur = con.cursor()
-            cur.execute(
-                "UPDATE users SET photo_url = ?, updated_at = datetime('now') WHERE id = ?",
-                (photo_url, userId)
-            )
-            con.commit()
+        def write() -> None:
+            with _db() as con:
+                cur = con.cursor()
+                cur.execute(
+                    "UPDATE users SET photo_url = ?, updated_at = datetime('now') WHERE id = ?",
+                    (photo_url, userId)
+                )
+                _after_write(cur, "users", userId, "update")
+                con.commit()
             
-            # Проверяем что пользователь существует
-            if cur.rowcount == 0:
-                # Удаляем загруженный файл
-                os.remove(file_path)
-                raise HTTPException(status_code=404, detail="Пользователь не найден")
+                # Проверяем что пользователь существует
+                if cur.rowcount == 0:
+                    # Удаляем загруженный файл
+                    os.remove(file_path)
+                    raise HTTPException(status_code=404, detail="Пользователь не найден")
+        await run_in_threadpool(write)
         
         return JSONResponse({
             "success": True,
@@ -2938,11 +5657,12 @@ async def upload_user_photo(
 
 @app.delete("/api/users/{user_id}")
 def delete_user(user_id: int) -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute("DELETE FROM users WHERE id=?", (user_id,))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="User not found")
+        _after_write(cur, "users", user_id, "delete")
         con.commit()
         return JSONResponse({"ok": True})
 
@@ -2975,15 +5695,15 @@ class PurchaseRequestUpdate(BaseModel):
     purchase_id: Optional[int] = None
 
 @app.get("/api/purchase-requests")
-def get_purchase_requests() -> JSONResponse:
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute("SELECT * FROM purchase_requests ORDER BY created_at DESC")
-        return JSONResponse(_rows_to_dicts(cur.fetchall()))
+def get_purchase_requests(request: Request) -> JSONResponse:
+    return _list_rows(
+        request, "purchase_requests", filters=("status", "urgency", "object_id", "requested_by", "purchase_id"),
+        date_col="created_at", order="COALESCE(created_at, '')",
+    )
 
 @app.post("/api/purchase-requests")
 def create_purchase_request(payload: PurchaseRequestCreate) -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute(
             """INSERT INTO purchase_requests(
@@ -2998,6 +5718,7 @@ def create_purchase_request(payload: PurchaseRequestCreate) -> JSONResponse:
             ),
         )
         rid = cur.lastrowid
+        _after_write(cur, "purchase_requests", rid, "insert")
         con.commit()
         cur.execute("SELECT * FROM purchase_requests WHERE id=?", (rid,))
         return JSONResponse(dict(cur.fetchone()))
@@ -3022,9 +5743,10 @@ def update_purchase_request(request_id: int, payload: PurchaseRequestUpdate) ->
     
     values.append(request_id)
     
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute(f"UPDATE purchase_requests SET {', '.join(fields)} WHERE id = ?", values)
+        _after_write(cur, "purchase_requests", request_id, "update")
         con.commit()
         cur.execute("SELECT * FROM purchase_requests WHERE id=?", (request_id,))
         row = cur.fetchone()
@@ -3034,11 +5756,12 @@ def update_purchase_request(request_id: int, payload: PurchaseRequestUpdate) ->
 
 @app.delete("/api/purchase-requests/{request_id}")
 def delete_purchase_request(request_id: int) -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute("DELETE FROM purchase_requests WHERE id=?", (request_id,))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Purchase request not found")
+        _after_write(cur, "purchase_requests", request_id, "delete")
         con.commit()
         return JSONResponse({"ok": True})
 
@@ -3061,19 +5784,12 @@ class DocumentUpdate(BaseModel):
     due_date: Optional[str] = None
 
 @app.get("/api/documents")
-def get_documents(invoice_id: Optional[int] = None, object_id: Optional[int] = None) -> JSONResponse:
+def get_documents(request: Request) -> JSONResponse:
     """Получить документы с возможностью фильтрации по invoice_id или object_id"""
-    with _connect() as con:
-        cur = con.cursor()
-        
-        if invoice_id:
-            cur.execute("SELECT * FROM documents WHERE invoice_id=? ORDER BY created_at DESC", (invoice_id,))
-        elif object_id:
-            cur.execute("SELECT * FROM documents WHERE object_id=? ORDER BY created_at DESC", (object_id,))
-        else:
-            cur.execute("SELECT * FROM documents ORDER BY created_at DESC")
-        
-        return JSONResponse(_rows_to_dicts(cur.fetchall()))
+    return _list_rows(
+        request, "documents", filters=("invoice_id", "object_id", "type"),
+        date_col="created_at", order="COALESCE(created_at, '')",
+    )
 
 @app.post("/api/documents")
 async def create_document(data: DocumentCreate, file: Optional[UploadFile] = None) -> JSONResponse:
@@ -3105,32 +5821,35 @@ async def create_document(data: DocumentCreate, file: Optional[UploadFile] = Non
         # Сохраняем относительный путь для API
         file_path = f"/files/{unique_filename}"
     
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute("""
-            INSERT INTO documents (
-                type, title, description, amount, due_date, 
+    def write() -> JSONResponse:
+        with _db() as con:
+            cur = con.cursor()
+            cur.execute("""
+                INSERT INTO documents (
+                    type, title, description, amount, due_date, 
+                    file_path, file_name, file_size, mime_type,
+                    invoice_id, object_id, created_at, updated_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                data.type, data.title, data.description, data.amount, data.due_date,
                 file_path, file_name, file_size, mime_type,
-                invoice_id, object_id, created_at, updated_at
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            data.type, data.title, data.description, data.amount, data.due_date,
-            file_path, file_name, file_size, mime_type,
-            data.invoice_id, data.object_id, 
-            datetime.now().isoformat(), datetime.now().isoformat()
-        ))
-        doc_id = cur.lastrowid
-        con.commit()
+                data.invoice_id, data.object_id, 
+                datetime.now().isoformat(), datetime.now().isoformat()
+            ))
+            doc_id = cur.lastrowid
+            _after_write(cur, "documents", doc_id, "insert")
+            con.commit()
         
-        # Возвращаем созданный документ
-        cur.execute("SELECT * FROM documents WHERE id=?", (doc_id,))
-        document = dict(cur.fetchone())
-        return JSONResponse(document)
+            # Возвращаем созданный документ
+            cur.execute("SELECT * FROM documents WHERE id=?", (doc_id,))
+            document = dict(cur.fetchone())
+            return JSONResponse(document)
+    return await run_in_threadpool(write)
 
 @app.get("/api/documents/{doc_id}")
 def get_document(doc_id: int) -> JSONResponse:
     """Получить документ по ID"""
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute("SELECT * FROM documents WHERE id=?", (doc_id,))
         row = cur.fetchone()
@@ -3156,18 +5875,19 @@ def update_document(doc_id: int, data: DocumentUpdate) -> JSONResponse:
     values.append(datetime.now().isoformat())
     values.append(doc_id)
     
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute(f"UPDATE documents SET {', '.join(updates)} WHERE id=?", values)
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Document not found")
+        _after_write(cur, "documents", doc_id, "update")
         con.commit()
         return JSONResponse({"ok": True})
 
 @app.delete("/api/documents/{doc_id}")
 def delete_document(doc_id: int) -> JSONResponse:
     """Удалить документ и связанный файл"""
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         
         # Получаем информацию о файле перед удалением
@@ -3180,6 +5900,7 @@ def delete_document(doc_id: int) -> JSONResponse:
         
         # Удаляем запись из БД
         cur.execute("DELETE FROM documents WHERE id=?", (doc_id,))
+        _after_write(cur, "documents", doc_id, "delete")
         con.commit()
         
         # Удаляем файл с диска
@@ -3224,32 +5945,37 @@ def update_invoice(invoice_id: int, data: InvoiceUpdate) -> JSONResponse:
     values.append(datetime.now().isoformat())
     values.append(invoice_id)
     
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute(f"UPDATE invoices SET {', '.join(updates)} WHERE id=?", values)
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Invoice not found")
+        _after_write(cur, "invoices", invoice_id, "update")
         con.commit()
         return JSONResponse({"ok": True})
 
 @app.delete("/api/invoices/{invoice_id}")
 def delete_invoice(invoice_id: int) -> JSONResponse:
     """Удалить счет и все связанные документы"""
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         
         # Получаем связанные документы
-        cur.execute("SELECT file_path FROM documents WHERE invoice_id=?", (invoice_id,))
-        doc_files = [row[0] for row in cur.fetchall() if row[0]]
-        
+        cur.execute("SELECT id, file_path FROM documents WHERE invoice_id=?", (invoice_id,))
+        docs = cur.fetchall()
+        doc_files = [row[1] for row in docs if row[1]]
+
         # Удаляем связанные документы
         cur.execute("DELETE FROM documents WHERE invoice_id=?", (invoice_id,))
-        
+        for row in docs:
+            _after_write(cur, "documents", row[0], "delete")
+
         # Удаляем счет
         cur.execute("DELETE FROM invoices WHERE id=?", (invoice_id,))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Invoice not found")
         
+        _after_write(cur, "invoices", invoice_id, "delete")
         con.commit()
         
         # Удаляем файлы документов
@@ -3277,7 +6003,7 @@ def generate_invoice_pdf(invoice_id: int) -> JSONResponse:
     try:
         import uuid
         
-        with _connect() as con:
+        with _db() as con:
             cur = con.cursor()
             cur.execute("SELECT * FROM invoices WHERE id=?", (invoice_id,))
             invoice = cur.fetchone()
@@ -3308,7 +6034,7 @@ def generate_invoice_pdf(invoice_id: int) -> JSONResponse:
         raise HTTPException(status_code=500, detail=f"Error generating PDF: {str(e)}")
 
 # Обновляем схему auth_users: добавляем недостающие поля
-with _connect() as con:
+with _db() as con:
     cur = con.cursor()
     cur.execute("PRAGMA table_info('auth_users')")
     a_cols = {row[1] for row in cur.fetchall()}
@@ -3341,7 +6067,7 @@ class AuthUserCreate(BaseModel):
 def auth_create_user(payload: AuthUserCreate) -> JSONResponse:
     # Хеш пароля + сохранение исходного пароля для администратора до первой смены
     pwd_hash = hash_password(payload.password)
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         # Проверяем уникальность username
         cur.execute("SELECT id FROM auth_users WHERE username = ?", (payload.username,))
@@ -3370,7 +6096,7 @@ class AuthChangePassword(BaseModel):
 
 @app.post("/api/auth/change-password")
 def auth_change_password(payload: AuthChangePassword) -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute("SELECT id, password_hash FROM auth_users WHERE username = ?", (payload.username,))
         rec = cur.fetchone()
@@ -3388,21 +6114,19 @@ def auth_change_password(payload: AuthChangePassword) -> JSONResponse:
 
 @app.delete("/api/warehouse/consumption/{consumption_id}")
 def api_delete_warehouse_consumption(consumption_id: int) -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute("DELETE FROM warehouse_consumption WHERE id=?", (consumption_id,))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Warehouse consumption not found")
+        _after_write(cur, "warehouse_consumption", consumption_id, "delete")
         con.commit()
         return JSONResponse({"ok": True})
 
 # API для инструментов
 @app.get("/api/tools")
-def get_tools() -> JSONResponse:
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute("SELECT * FROM tools ORDER BY id DESC")
-        return JSONResponse(_rows_to_dicts(cur.fetchall()))
+def get_tools(request: Request) -> JSONResponse:
+    return _list_rows(request, "tools", filters=("type", "condition_status", "location"))
 
 @app.post("/api/tools")
 async def create_tool(request: Request) -> JSONResponse:
@@ -3411,28 +6135,31 @@ async def create_tool(request: Request) -> JSONResponse:
     except:
         raise HTTPException(status_code=400, detail="Invalid JSON")
     
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute(
-            """INSERT INTO tools(
-                name, serial_number, type, condition_status, location, 
-                purchase_date, price, notes, created_at
-            ) VALUES(?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))""",
-            (
-                data.get("name"),
-                data.get("serial_number"),
-                data.get("type"),
-                data.get("condition_status"),
-                data.get("location"),
-                data.get("purchase_date"),
-                data.get("price"),
-                data.get("notes"),
-            ),
-        )
-        tool_id = cur.lastrowid
-        con.commit()
-        cur.execute("SELECT * FROM tools WHERE id=?", (tool_id,))
-        return JSONResponse(dict(cur.fetchone()))
+    def write() -> JSONResponse:
+        with _db() as con:
+            cur = con.cursor()
+            cur.execute(
+                """INSERT INTO tools(
+                    name, serial_number, type, condition_status, location, 
+                    purchase_date, price, notes, created_at
+                ) VALUES(?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))""",
+                (
+                    data.get("name"),
+                    data.get("serial_number"),
+                    data.get("type"),
+                    data.get("condition_status"),
+                    data.get("location"),
+                    data.get("purchase_date"),
+                    data.get("price"),
+                    data.get("notes"),
+                ),
+            )
+            tool_id = cur.lastrowid
+            _after_write(cur, "tools", tool_id, "insert")
+            con.commit()
+            cur.execute("SELECT * FROM tools WHERE id=?", (tool_id,))
+            return JSONResponse(dict(cur.fetchone()))
+    return await run_in_threadpool(write)
 
 @app.patch("/api/tools/{tool_id}")
 async def update_tool(tool_id: int, request: Request) -> JSONResponse:
@@ -3441,43 +6168,47 @@ async def update_tool(tool_id: int, request: Request) -> JSONResponse:
     except:
         raise HTTPException(status_code=400, detail="Invalid JSON")
     
-    with _connect() as con:
-        cur = con.cursor()
-        updates = []
-        params = []
-        for key, value in data.items():
-            if key in ["name", "serial_number", "type", "condition_status", "location", 
-                      "purchase_date", "price", "notes"]:
-                updates.append(f"{key} = ?")
-                params.append(value)
+    def write() -> JSONResponse:
+        with _db() as con:
+            cur = con.cursor()
+            updates = []
+            params = []
+            for key, value in data.items():
+                if key in ["name", "serial_number", "type", "condition_status", "location", 
+                          "purchase_date", "price", "notes"]:
+                    updates.append(f"{key} = ?")
+                    params.append(value)
         
-        if not updates:
-            raise HTTPException(status_code=400, detail="No valid fields to update")
+            if not updates:
+                raise HTTPException(status_code=400, detail="No valid fields to update")
         
-        params.append(tool_id)
-        cur.execute(f"UPDATE tools SET {', '.join(updates)} WHERE id = ?", params)
+            params.append(tool_id)
+            cur.execute(f"UPDATE tools SET {', '.join(updates)} WHERE id = ?", params)
         
-        if cur.rowcount == 0:
-            raise HTTPException(status_code=404, detail="Tool not found")
+            if cur.rowcount == 0:
+                raise HTTPException(status_code=404, detail="Tool not found")
         
-        con.commit()
-        cur.execute("SELECT * FROM tools WHERE id=?", (tool_id,))
-        return JSONResponse(dict(cur.fetchone()))
+            _after_write(cur, "tools", tool_id, "update")
+            con.commit()
+            cur.execute("SELECT * FROM tools WHERE id=?", (tool_id,))
+            return JSONResponse(dict(cur.fetchone()))
+    return await run_in_threadpool(write)
 
 @app.delete("/api/tools/{tool_id}")
 def delete_tool(tool_id: int) -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute("DELETE FROM tools WHERE id=?", (tool_id,))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Tool not found")
+        _after_write(cur, "tools", tool_id, "delete")
         con.commit()
         return JSONResponse({"ok": True})
 
 # API для выдачи инструментов
 @app.get("/api/tool-assignments")
 def get_tool_assignments() -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute("""
             SELECT ta.*, t.name as tool_name, t.type as tool_type, t.serial_number,
@@ -3489,7 +6220,7 @@ def get_tool_assignments() -> JSONResponse:
             LEFT JOIN users assigned ON ta.assigned_by = assigned.id
             ORDER BY ta.assigned_date DESC
         """)
-        return JSONResponse(_rows_to_dicts(cur.fetchall()))
+        return RowsResponse(cur)
 
 @app.post("/api/tool-assignments")
 async def create_tool_assignment(request: Request) -> JSONResponse:
@@ -3498,26 +6229,29 @@ async def create_tool_assignment(request: Request) -> JSONResponse:
     except:
         raise HTTPException(status_code=400, detail="Invalid JSON")
     
-    with _connect() as con:
-        cur = con.cursor()
-        cur.execute(
-            """INSERT INTO tool_assignments(
-                tool_id, user_id, assigned_date, assigned_by, 
-                condition_out, notes, created_at
-            ) VALUES(?, ?, ?, ?, ?, ?, datetime('now'))""",
-            (
-                data.get("tool_id"),
-                data.get("user_id"),
-                data.get("assigned_date"),
-                data.get("assigned_by"),
-                data.get("condition_out"),
-                data.get("notes"),
-            ),
-        )
-        assignment_id = cur.lastrowid
-        con.commit()
-        cur.execute("SELECT * FROM tool_assignments WHERE id=?", (assignment_id,))
-        return JSONResponse(dict(cur.fetchone()))
+    def write() -> JSONResponse:
+        with _db() as con:
+            cur = con.cursor()
+            cur.execute(
+                """INSERT INTO tool_assignments(
+                    tool_id, user_id, assigned_date, assigned_by, 
+                    condition_out, notes, created_at
+                ) VALUES(?, ?, ?, ?, ?, ?, datetime('now'))""",
+                (
+                    data.get("tool_id"),
+                    data.get("user_id"),
+                    data.get("assigned_date"),
+                    data.get("assigned_by"),
+                    data.get("condition_out"),
+                    data.get("notes"),
+                ),
+            )
+            assignment_id = cur.lastrowid
+            _after_write(cur, "tool_assignments", assignment_id, "insert")
+            con.commit()
+            cur.execute("SELECT * FROM tool_assignments WHERE id=?", (assignment_id,))
+            return JSONResponse(dict(cur.fetchone()))
+    return await run_in_threadpool(write)
 
 @app.patch("/api/tool-assignments/{assignment_id}")
 async def update_tool_assignment(assignment_id: int, request: Request) -> JSONResponse:
@@ -3526,35 +6260,39 @@ async def update_tool_assignment(assignment_id: int, request: Request) -> JSONRe
     except:
         raise HTTPException(status_code=400, detail="Invalid JSON")
     
-    with _connect() as con:
-        cur = con.cursor()
-        updates = []
-        params = []
-        for key, value in data.items():
-            if key in ["returned_date", "condition_in", "notes"]:
-                updates.append(f"{key} = ?")
-                params.append(value)
+    def write() -> JSONResponse:
+        with _db() as con:
+            cur = con.cursor()
+            updates = []
+            params = []
+            for key, value in data.items():
+                if key in ["returned_date", "condition_in", "notes"]:
+                    updates.append(f"{key} = ?")
+                    params.append(value)
         
-        if not updates:
-            raise HTTPException(status_code=400, detail="No valid fields to update")
+            if not updates:
+                raise HTTPException(status_code=400, detail="No valid fields to update")
         
-        params.append(assignment_id)
-        cur.execute(f"UPDATE tool_assignments SET {', '.join(updates)} WHERE id = ?", params)
+            params.append(assignment_id)
+            cur.execute(f"UPDATE tool_assignments SET {', '.join(updates)} WHERE id = ?", params)
         
-        if cur.rowcount == 0:
-            raise HTTPException(status_code=404, detail="Tool assignment not found")
+            if cur.rowcount == 0:
+                raise HTTPException(status_code=404, detail="Tool assignment not found")
         
-        con.commit()
-        cur.execute("SELECT * FROM tool_assignments WHERE id=?", (assignment_id,))
-        return JSONResponse(dict(cur.fetchone()))
+            _after_write(cur, "tool_assignments", assignment_id, "update")
+            con.commit()
+            cur.execute("SELECT * FROM tool_assignments WHERE id=?", (assignment_id,))
+            return JSONResponse(dict(cur.fetchone()))
+    return await run_in_threadpool(write)
 
 @app.delete("/api/tool-assignments/{assignment_id}")
 def delete_tool_assignment(assignment_id: int) -> JSONResponse:
-    with _connect() as con:
+    with _db() as con:
         cur = con.cursor()
         cur.execute("DELETE FROM tool_assignments WHERE id=?", (assignment_id,))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Tool assignment not found")
+        _after_write(cur, "tool_assignments", assignment_id, "delete")
         con.commit()
         return JSONResponse({"ok": True})
 
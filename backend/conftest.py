@@ -0,0 +1,15 @@
+"""
+Настройка pytest для тестов бэкенда.
+
+backend — пакет, поэтому при запуске из корня репозитория pytest кладёт в
+sys.path корень, а не backend. Тесты импортируют temp_db и app как модули
+верхнего уровня (так же, как при запуске скриптом из backend/), поэтому
+добавляем каталог backend в sys.path до сбора тестов.
+"""
+
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+if HERE not in sys.path:
+    sys.path.insert(0, HERE)
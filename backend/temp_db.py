@@ -0,0 +1,49 @@
+"""
+Общая временная база для тестов бэкенда.
+
+app читает DB_PATH один раз при импорте и держит пул соединений на весь
+процесс, поэтому все тесты одного запуска (pytest по нескольким файлам или
+отдельный скрипт) работают с одной копией bot.db, созданной до первого
+импорта app. Копия удаляется при выходе из процесса.
+"""
+
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DB = os.path.join(HERE, '..', 'bot.db')
+
+_tmp_dir: str | None = None
+
+
+def load_app():
+    """Модуль app, работающий с временной копией bot.db (одной на процесс)."""
+    global _tmp_dir
+    if _tmp_dir is None and "app" not in sys.modules:
+        _tmp_dir = tempfile.mkdtemp()
+        db_path = os.path.join(_tmp_dir, 'bot.db')
+        # Копируем вместе с -wal: в нём закоммиченные строки, ещё не перенесённые в bot.db.
+        # Сам bot.db не открываем — закрытие соединения сделало бы checkpoint в рабочую базу
+        for suffix in ("", "-wal"):
+            if os.path.exists(SOURCE_DB + suffix):
+                shutil.copy(SOURCE_DB + suffix, db_path + suffix)
+        os.environ["DB_PATH"] = db_path
+        atexit.register(_cleanup)
+    if HERE not in sys.path:
+        sys.path.insert(0, HERE)
+    import app
+
+    # Защита рабочей базы: app, импортированный в обход load_app, смотрит не в копию
+    if _tmp_dir is None or not app.DB_PATH.startswith(_tmp_dir):
+        raise RuntimeError(f"app уже импортирован с базой {app.DB_PATH}, а не с временной копией")
+    return app
+
+
+def _cleanup() -> None:
+    app = sys.modules.get("app")
+    if app is not None:
+        app._POOL.close_all()
+    shutil.rmtree(_tmp_dir, ignore_errors=True)
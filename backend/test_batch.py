@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Проверка POST /api/batch: бесконечный поток и пакет внутри пакета нельзя
+вызвать подзапросом ни напрямую, ни через закодированный путь.
+"""
+
+import threading
+
+from temp_db import load_app
+
+# Каждый путь после раскодирования ведёт на /api/stream или /api/batch
+REFUSED_PATHS = (
+    "/api/stream",
+    "/api/stream/",
+    "/api/%73tream",
+    "/api/%73%74%72%65%61%6D?since=0",
+    "/api/stream%2F",
+    "/api%2Fstream",
+    "/api/batch",
+    "/api/%62atch",
+    "/objects",
+)
+# Запрещённый подзапрос мог бы держать пакет бесконечно — ждём ответ не дольше
+TIMEOUT = 5.0
+
+
+def test_batch() -> None:
+    print(f"🔍 Пакетные запросы: {len(REFUSED_PATHS)} запрещённых путей...")
+
+    app = load_app()
+    from fastapi.testclient import TestClient
+
+    client = TestClient(app.app)
+    statuses = {}
+
+    def call() -> None:
+        for path in REFUSED_PATHS:
+            statuses[path] = client.post("/api/batch", json={"requests": [{"path": path}]}).status_code
+
+    worker = threading.Thread(target=call, daemon=True)
+    worker.start()
+    worker.join(TIMEOUT)
+    assert not worker.is_alive(), f"❌ Пакет не ответил за {TIMEOUT} с, ответы: {statuses}"
+    allowed = {path: status for path, status in statuses.items() if status != 400}
+    assert not allowed, f"❌ Запрещённые пути выполнены: {allowed}"
+
+    # Разрешённый путь выполняется по тому же раскодированному пути, что и проверялся
+    r = client.post("/api/batch", json={"requests": [{"path": "/api/objects"}, {"path": "/api/%6Fbjects"}]})
+    assert r.status_code == 200, r.text
+    plain, encoded = r.json()["responses"]
+    assert plain["status"] == encoded["status"] == 200, r.text
+    assert plain["body"] == encoded["body"]
+    print("✅ Запрещённые пути отклонены, обычные выполняются")
+
+
+if __name__ == "__main__":
+    test_batch()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Микро-бенчмарк дневной статистики GET /api/users/{id}/daily/{date}.
+На временной копии базы создаётся год данных по бригаде (задачи, касса, учёт
+времени, списания, прочие расходы, зарплаты, инструменты, выдачи со склада),
+затем меряется время вызова get_daily_stats на случайных (пользователь, день).
+Цель — медиана меньше 5 мс; время только печатается, а падать по нему тест
+начинает с BENCH_STRICT=1 (на загруженной машине замер нестабилен). Для
+сравнения выгружается весь год по бригаде через /api/users/daily.
+"""
+
+import os
+import random
+import sqlite3
+import statistics
+import time
+from datetime import date, timedelta
+
+from temp_db import load_app
+
+USERS = 30
+OBJECTS = 12
+DAYS = 365
+TASKS_PER_DAY = 4
+CALLS = 500
+TARGET_MS = 5.0
+# Порог по времени — только по явному запросу, проверки корректности выполняются всегда
+STRICT_TIMING = os.getenv("BENCH_STRICT", "") == "1"
+
+
+def _seed(db_path: str) -> tuple[list[int], list[str]]:
+    rnd = random.Random(19)
+    con = sqlite3.connect(db_path)
+    start = date(2025, 1, 1)
+    days = [(start + timedelta(days=i)).isoformat() for i in range(DAYS)]
+    user_ids = []
+    for u in range(USERS):
+        cur = con.execute(
+            "INSERT INTO users(full_name, username, role, created_at) VALUES (?, ?, 'worker', datetime('now'))",
+            (f"Бенчмарк {u}", f"bench_daily_{u}"),
+        )
+        user_ids.append(cur.lastrowid)
+    object_ids = [
+        con.execute("INSERT INTO objects(name, created_at) VALUES (?, datetime('now'))", (f"Бенчмарк-объект {o}",)).lastrowid
+        for o in range(OBJECTS)
+    ]
+    tool_ids = [
+        con.execute("INSERT INTO tools(name, type, created_at) VALUES (?, 'hand', datetime('now'))", (f"Инструмент {t}",)).lastrowid
+        for t in range(USERS)
+    ]
+
+    tasks, cash, tracking, consumption, requests = [], [], [], [], []
+    for uid in user_ids:
+        for day in days:
+            for k in range(TASKS_PER_DAY):
+                tasks.append((f"Задача {k}", uid, rnd.choice(object_ids), rnd.choice(("completed", "in_progress", "new")),
+                              day, f"{day} 08:00:00", rnd.choice((None, 1500.0)), "hourly", 400.0, rnd.randint(30, 240)))
+            cash.append(("advance" if rnd.random() < 0.3 else "bonus", 500.0, "Аванс", day, uid, f"{day} 12:00:00"))
+            tracking.append((uid, day, "08:00", "17:00", 8.0, f"{day} 17:00:00"))
+            consumption.append((rnd.choice(object_ids), "Саморезы", 10, "шт", 2.5, 25.0, day, uid, f"{day} 10:00:00"))
+            if rnd.random() < 0.1:
+                requests.append(("Цемент", 5, "мешок", uid, f"{day} 09:00:00"))
+    con.executemany(
+        """INSERT INTO tasks(title, assignee_id, object_id, status, work_date, created_at, pay_amount, pay_type, pay_rate, actual_minutes)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        tasks,
+    )
+    con.executemany(
+        "INSERT INTO cash_transactions(type, amount, category, date, user_id, created_at) VALUES (?, ?, ?, ?, ?, ?)", cash
+    )
+    con.executemany(
+        "INSERT INTO time_tracking(user_id, date, check_in_time, check_out_time, total_hours, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        tracking,
+    )
+    con.executemany(
+        """INSERT INTO warehouse_consumption(object_id, item_name, quantity, unit, unit_price, total_amount, consumption_date, user_id, created_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        consumption,
+    )
+    con.executemany(
+        "INSERT INTO purchase_requests(item_name, quantity, unit, requested_by, created_at) VALUES (?, ?, ?, ?, ?)", requests
+    )
+    con.executemany(
+        "INSERT INTO other_expenses(category, amount, date, object_id, created_at) VALUES ('Топливо', 300, ?, ?, ?)",
+        [(day, oid, f"{day} 18:00:00") for day in days for oid in object_ids if rnd.random() < 0.4],
+    )
+    con.executemany(
+        "INSERT INTO salaries(user_id, amount, date, type) VALUES (?, 60000, ?, 'salary')",
+        [(uid, f"2025-{m:02d}-05") for uid in user_ids for m in range(1, 13)],
+    )
+    con.executemany(
+        "INSERT INTO tool_assignments(tool_id, user_id, assigned_date, created_at) VALUES (?, ?, '2025-01-01', datetime('now'))",
+        list(zip(tool_ids, user_ids)),
+    )
+    con.executemany(
+        """INSERT INTO purchases(item, status, amount, qty, unit, type, date, object_id, user_id, created_at)
+           VALUES (?, ?, ?, ?, 'шт', 'materials', ?, ?, ?, datetime('now'))""",
+        [("Бенчмарк-профиль", "stock_in", "1000", 100, day, None, None) for day in days]
+        + [("Бенчмарк-профиль", "issued", None, 20, day, rnd.choice(object_ids), rnd.choice(user_ids)) for day in days],
+    )
+    con.execute(
+        "UPDATE purchases SET item_key = 'бенчмарк-профиль', unit_norm = 'шт', type_norm = 'materials' WHERE item = 'Бенчмарк-профиль'"
+    )
+    con.commit()
+    con.close()
+    return user_ids, days
+
+
+def test_daily_stats() -> None:
+    print(f"🔍 Дневная статистика: {USERS} пользователей × {DAYS} дней...")
+
+    app = load_app()
+    from fastapi.testclient import TestClient
+
+    user_ids, days = _seed(app.DB_PATH)
+    with app._db() as con:
+        cur = con.cursor()
+        app._stock_rebuild(cur)
+        app._cost_rebuild(cur)
+        app._daily_facts_rebuild(cur)
+        cur.execute("ANALYZE")
+
+    rnd = random.Random(5)
+    pairs = [(rnd.choice(user_ids), rnd.choice(days)) for _ in range(CALLS)]
+    for uid, day in pairs[:20]:
+        app.get_daily_stats(uid, day)
+
+    timings = []
+    for uid, day in pairs:
+        started = time.perf_counter()
+        app.get_daily_stats(uid, day)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    median = statistics.median(timings)
+    p95 = timings[int(len(timings) * 0.95)]
+    print(f"📊 get_daily_stats: медиана {median:.2f} мс, p95 {p95:.2f} мс ({CALLS} вызовов)")
+
+    client = TestClient(app.app)
+    started = time.perf_counter()
+    for uid, day in pairs[:100]:
+        assert client.get(f"/api/users/{uid}/daily/{day}").status_code == 200
+    print(f"📊 GET /api/users/{{id}}/daily/{{date}}: {(time.perf_counter() - started) * 10:.2f} мс на запрос через HTTP")
+
+    sample = app.get_daily_stats(*pairs[0])
+    assert b'"tasks_total":4' in sample.body, "❌ В статистике нет задач дня"
+    if median >= TARGET_MS:
+        print(f"⚠️ Медиана больше цели {TARGET_MS} мс")
+    assert not STRICT_TIMING or median < TARGET_MS, f"❌ Медиана больше {TARGET_MS} мс"
+
+    # Весь год по всей бригаде одним запросом /api/users/daily против вызовов по дням
+    ids = ",".join(map(str, user_ids))
+    started = time.perf_counter()
+    lines = client.get(f"/api/users/daily?user_ids={ids}&from={days[0]}&to={days[-1]}").text.splitlines()
+    range_ms = (time.perf_counter() - started) * 1000
+    print(f"📊 GET /api/users/daily: {len(lines)} строк (пользователь × день) за {range_ms:.0f} мс, "
+          f"по дням вышло бы ~{median * USERS * DAYS:.0f} мс")
+    assert len(lines) == USERS * DAYS, f"❌ Ожидалось {USERS * DAYS} строк"
+    print("✅ Статистика дня и выгрузка периода полные")
+
+
+if __name__ == "__main__":
+    test_daily_stats()
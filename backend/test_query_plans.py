@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Проверка планов запросов: каждый SQL из app.py прогоняется через EXPLAIN QUERY PLAN.
+Горячие запросы (с WHERE) не должны делать полный SCAN таблицы.
+Запросы, которым полный проход нужен по смыслу, помечаются комментарием "-- full-scan: <причина>".
+
+Подстановки f-строк заменяются представительными фрагментами из FILLERS или
+значениями констант app.py. SQL, который собирается в переменной (списки,
+дельты ?since=, финансовые отчёты), снимается трассировкой соединений при
+выполнении запросов из GENERATED_REQUESTS. Запрос, который не удалось
+проверить, — ошибка теста, если он не помечен "-- plan-skip: <причина>".
+"""
+
+import ast
+import os
+import re
+import sqlite3
+
+from temp_db import HERE, load_app
+
+SCAN_RE = re.compile(r"^SCAN (\w+)")
+DERIVED_RE = re.compile(r"^(?:CO-ROUTINE|MATERIALIZE) (\w+)")
+
+# Условие по периоду и объекту в том виде, как его собирает _period_where
+_PERIOD_WHERE = (
+    " WHERE (date IS NULL OR date = '' OR date >= ?) AND (date IS NULL OR date = '' OR date <= ?) AND object_id = ?"
+)
+
+# Подстановка f-строки (исходный текст выражения) -> представительный фрагмент SQL
+FILLERS = {
+    "', '.join(fields)": "id = ?",
+    "', '.join(updates)": "id = ?",
+    "','.join(('?' for _ in ids))": "?, ?",
+    "marks": "?, ?",
+    "in_marks": "?, ?",
+    "out_marks": "?, ?",
+    "projection": "*",
+    "table": "tasks",
+    "order": "id",
+    "period": "NULL",
+    "' AND '.join(row_conds + conds)": (
+        "id IN (SELECT row_id FROM row_changes WHERE table_name = ? AND revision > ? AND revision <= ? AND deleted = 0)"
+    ),
+    "where": _PERIOD_WHERE,
+    "doc_where": _PERIOD_WHERE,
+    "cash_where": _PERIOD_WHERE,
+    # Оплаты по документам (payables): без объекта, только нужные типы источников
+    "pay_where": " WHERE (date IS NULL OR date = '' OR date <= ?) AND source_type IN ('purchase', 'other', 'salary')",
+}
+
+# Запросы, SQL которых собирается во время выполнения: снимаются трассировкой
+GENERATED_REQUESTS = (
+    "/api/tasks?status=new&assignee_id=1&date_from=2025-01-01&date_to=2025-12-31&limit=10",
+    "/api/tasks?limit=10&after_id=100",
+    "/api/tasks?since=0&object_id=1",
+    "/api/cash?type=income&limit=5&after_id=5",
+    "/api/purchases?item_key=x&object_id=1&date_from=2025-01-01",
+    "/api/users?fields=id,full_name&limit=5&after_id=3",
+    "/api/finance/journal?kind=expense&object_id=1&limit=5",
+    "/api/finance/pnl?frm=2025-01-01&to=2025-12-31&object_id=1&group_by=month",
+    "/api/finance/cashflow?frm=2025-01-01&to=2025-12-31&object_id=1&group_by=week",
+    "/api/finance/payables?as_of=2025-06-30&object_id=1",
+    "/api/finance/receivables",
+    "/api/materials?as_of=2025-06-30",
+    "/api/materials/costs?frm=2025-01-01&to=2025-12-31&object_id=1",
+    "/api/users/facts?user_ids=1,2&from=2025-01-01&to=2025-01-31&group_by=week",
+    "/api/users/daily?user_ids=1,2&from=2025-01-01&to=2025-01-07",
+    "/api/dashboard/bootstrap",
+)
+
+
+def _render(node: ast.AST, constants: dict) -> tuple[str | None, list[str]]:
+    """Строка SQL из литерала или f-строки и список подстановок, которые нечем заменить."""
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value, []
+    if isinstance(node, ast.JoinedStr):
+        parts, unknown = [], []
+        for v in node.values:
+            if isinstance(v, ast.Constant):
+                parts.append(str(v.value))
+                continue
+            expr = ast.unparse(v.value)
+            if expr in FILLERS:
+                parts.append(FILLERS[expr])
+            elif isinstance(constants.get(expr), (str, int)):
+                parts.append(str(constants[expr]))
+            else:
+                parts.append("?")
+                unknown.append(expr)
+        return "".join(parts), unknown
+    return None, []
+
+
+def collect_statements(path: str, constants: dict) -> list[tuple[int, str, list[str]]]:
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    res = []
+    for node in ast.walk(tree):
+        if (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Attribute)
+            and node.func.attr == "execute"
+            and node.args
+        ):
+            sql, unknown = _render(node.args[0], constants)
+            if sql and "-- full-scan" not in sql:
+                res.append((node.lineno, " ".join(sql.split()), unknown))
+        # Наборы запросов вида _DAILY_SQL = {"name": "SELECT ..."}
+        if (
+            isinstance(node, (ast.Assign, ast.AnnAssign))
+            and isinstance(node.value, ast.Dict)
+            and any(isinstance(t, ast.Name) and t.id.endswith("_SQL") for t in (node.targets if isinstance(node, ast.Assign) else [node.target]))
+        ):
+            for value in node.value.values:
+                sql, unknown = _render(value, constants)
+                if sql and "-- full-scan" not in sql:
+                    res.append((value.lineno, " ".join(sql.split()), unknown))
+    return sorted(res)
+
+
+QUERY_HEADS = ("SELECT", "UPDATE", "DELETE", "WITH")
+
+
+def _is_hot(sql: str) -> bool:
+    head = sql.lstrip("( ").upper()
+    return head.startswith(QUERY_HEADS) and " WHERE " in f" {sql.upper()} "
+
+
+def _capture_generated(app) -> tuple[list[tuple[str, str]], list[str]]:
+    """SQL, который обработчики выполнили на запросах GENERATED_REQUESTS (значения подставлены)."""
+    from fastapi.testclient import TestClient
+
+    captured: list[tuple[str, str]] = []
+    errors: list[str] = []
+    current = [""]
+    connect = app._connect
+
+    def traced_connect():
+        con = connect()
+        con.set_trace_callback(lambda sql: captured.append((current[0], sql)))
+        return con
+
+    # Соединения пула открываются заново уже с трассировкой
+    app._POOL.close_all()
+    app._connect = traced_connect
+    try:
+        client = TestClient(app.app)
+        for path in GENERATED_REQUESTS:
+            current[0] = path
+            r = client.get(path)
+            if r.status_code != 200:
+                errors.append(f"GET {path}: {r.status_code} {r.text[:200]}")
+    finally:
+        app._connect = connect
+        app._POOL.close_all()
+    return captured, errors
+
+
+def _planner_snapshot(db_path: str) -> sqlite3.Connection:
+    """Копия базы без статистики ANALYZE: app её не собирает, а тесты с сидингом могут оставить."""
+    src = sqlite3.connect(db_path)
+    tmp = sqlite3.connect(":memory:")
+    try:
+        src.backup(tmp)
+        stats = [row[0] for row in tmp.execute("SELECT name FROM sqlite_master WHERE name LIKE 'sqlite_stat%'")]
+        for name in stats:
+            tmp.execute(f"DROP TABLE {name}")
+        tmp.commit()
+        # Уже загруженную статистику соединение не сбрасывает — планы строим на свежем
+        con = sqlite3.connect(":memory:")
+        tmp.backup(con)
+    finally:
+        src.close()
+        tmp.close()
+    return con
+
+
+def test_query_plans() -> None:
+    print("🔍 Проверяем планы запросов app.py...")
+
+    app = load_app()
+    # Повторный import не создаёт схему, если app уже загружен другим тестом:
+    # строим её явно и проверяем ту базу, с которой работает app
+    app._init_schema()
+    app._apply_indexes()
+    con = _planner_snapshot(app.DB_PATH)
+    failures = []
+    unchecked = []
+    checked = skipped = 0
+    try:
+        tables = {row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        missing = sorted({"tasks", "purchases", "finance_ledger", "stock_balances", "daily_user_facts"} - tables)
+        assert not missing, f"❌ В базе {app.DB_PATH} нет схемы: {', '.join(missing)}"
+
+        statements = [
+            (f"app.py:{lineno}", sql, unknown)
+            for lineno, sql, unknown in collect_statements(os.path.join(HERE, "app.py"), vars(app))
+        ]
+        captured, errors = _capture_generated(app)
+        unchecked += [(error, "запрос не выполнился", "") for error in errors]
+        seen = set()
+        for path, sql in captured:
+            sql = " ".join(sql.split())
+            if sql not in seen:
+                seen.add(sql)
+                statements.append((f"GET {path}", sql, []))
+
+        for where, sql, unknown in statements:
+            if "-- plan-skip" in sql:
+                skipped += 1
+                continue
+            if unknown and sql.lstrip("( ").upper().startswith(QUERY_HEADS):
+                unchecked.append((where, f"нет заполнителя для {', '.join(unknown)}", sql[:120]))
+                continue
+            if not _is_hot(sql):
+                continue
+            try:
+                plan = con.execute(f"EXPLAIN QUERY PLAN {sql}", (None,) * sql.count("?")).fetchall()
+            except (sqlite3.OperationalError, sqlite3.ProgrammingError) as e:
+                unchecked.append((where, str(e), sql[:120]))
+                continue
+            checked += 1
+            # Проход по подзапросу (CO-ROUTINE/MATERIALIZE) — не полный скан таблицы
+            derived = {m.group(1) for row in plan for m in [DERIVED_RE.match(row[-1])] if m}
+            for row in plan:
+                m = SCAN_RE.match(row[-1])
+                # json_each(?) — виртуальная таблица по переданному списку, а не скан данных
+                if "VIRTUAL TABLE" in row[-1]:
+                    continue
+                if m and m.group(1) not in ("CONSTANT", "sqlite_master") and m.group(1) not in derived:
+                    failures.append((where, row[-1], sql[:120]))
+    finally:
+        con.close()
+
+    print(f"📊 Проверено запросов: {checked}, помечено plan-skip: {skipped}, не проверено: {len(unchecked)}")
+    for where, detail, sql in unchecked:
+        print(f"❌ {where}: не удалось проверить ({detail})\n    {sql}")
+    for where, detail, sql in failures:
+        print(f"❌ {where}: {detail}\n    {sql}")
+    assert not failures and not unchecked, f"❌ Полных сканов: {len(failures)}, не проверено: {len(unchecked)}"
+    print("✅ Все горячие запросы используют индексы")
+
+
+if __name__ == "__main__":
+    test_query_plans()
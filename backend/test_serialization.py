@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк сериализации списков: JSONResponse(_rows_to_dicts(...)) против RowsResponse.
+На временной копии базы создаётся 50 000 закупок (и столько же строк журнала),
+сравниваются время кодирования и полный ответ /api/purchases и /api/finance/journal.
+Для NDJSON-выгрузки меряются время до первой пачки и пик памяти.
+"""
+
+import asyncio
+import sqlite3
+import time
+import tracemalloc
+
+from temp_db import load_app
+
+ROWS = 50_000
+
+
+def _best(fn, repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+ROWS_IN: dict = {}
+
+
+def _peak(fn) -> int:
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _full_response(app, sql: str, params: tuple):
+    with app._db() as con:
+        cur = con.cursor()
+        cur.execute(sql, params)
+        return app.RowsResponse(cur)
+
+
+def _consume_stream(response) -> tuple[float, int, int]:
+    """Время до первой пачки, пик памяти и число строк NDJSON-ответа."""
+    async def consume() -> tuple[float, int]:
+        started = time.perf_counter()
+        first = None
+        lines = 0
+        async for chunk in response.body_iterator:
+            if first is None:
+                first = (time.perf_counter() - started) * 1000
+            lines += chunk.count(b"\n")
+        return first or 0.0, lines
+
+    tracemalloc.start()
+    try:
+        first_ms, lines = asyncio.run(consume())
+        return first_ms, tracemalloc.get_traced_memory()[1], lines
+    finally:
+        tracemalloc.stop()
+
+
+def _seed(db_path: str) -> None:
+    con = sqlite3.connect(db_path)
+    con.executemany(
+        """INSERT INTO purchases(item, status, amount, qty, unit, type, date, object_id, supplier_id, notes, created_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))""",
+        [
+            (f"Материал {i % 500}", "issued" if i % 3 else "in_stock", i * 1.5, 1 + i % 7, "шт", "material",
+             f"2025-{1 + i % 12:02d}-{1 + i % 28:02d}", i % 20, i % 40, "поставка" if i % 2 else None)
+            for i in range(ROWS)
+        ],
+    )
+    con.commit()
+    con.close()
+
+
+def test_serialization() -> None:
+    print(f"🔍 Сериализация {ROWS} строк...")
+
+    app = load_app()
+    from fastapi.responses import JSONResponse
+    from fastapi.testclient import TestClient
+
+    _seed(app.DB_PATH)
+    app._backfill_material_keys()
+    with app._db() as con:
+        app._ledger_rebuild(con.cursor())
+
+    failures = []
+    queries = {
+        "/api/purchases": ("SELECT * FROM purchases ORDER BY id DESC", ()),
+        "/api/finance/journal": (
+            """SELECT doc_date AS date, kind, category, amount, object_id, user_id, counterparty,
+                      description, source, source_id, status
+               FROM finance_ledger ORDER BY date DESC, id DESC""",
+            (),
+        ),
+    }
+    for path, (sql, params) in queries.items():
+        with app._db() as con:
+            cur = con.cursor()
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+            cur.execute(sql, params)
+            columns = [d[0] for d in cur.description]
+            cur.row_factory = None
+            tuples = cur.fetchall()
+
+        ROWS_IN[path] = len(rows)
+        old_body = JSONResponse(app._rows_to_dicts(rows)).body
+        new_body = app.RowsResponse(tuples, columns).body
+        if old_body != new_body:
+            failures.append(f"{path}: ответы различаются")
+
+        old_ms = _best(lambda: JSONResponse(app._rows_to_dicts(rows)))
+        new_ms = _best(lambda: app.RowsResponse(tuples, columns))
+        print(f"📊 {path}: {len(rows)} строк, кодирование {old_ms:.1f} мс → {new_ms:.1f} мс (x{old_ms / new_ms:.1f})")
+
+    client = TestClient(app.app)
+    for path in queries:
+        total = _best(lambda: client.get(path), repeat=3)
+        print(f"📊 GET {path}: {total:.1f} мс целиком")
+
+    for path, (sql, params) in queries.items():
+        full_peak = _peak(lambda: _full_response(app, sql, params))
+        first_ms, stream_peak, lines = _consume_stream(app._stream_rows(sql, params))
+        if lines != ROWS_IN[path]:
+            failures.append(f"{path}: в потоке {lines} строк")
+        print(f"📊 NDJSON {path}: первая пачка {first_ms:.1f} мс, "
+              f"пик памяти {stream_peak / 2**20:.1f} МБ против {full_peak / 2**20:.1f} МБ целиком")
+
+    assert not failures, "❌ Есть расхождения: " + "; ".join(failures)
+    print("✅ Ответы совпадают")
+
+
+if __name__ == "__main__":
+    test_serialization()
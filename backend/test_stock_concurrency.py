@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Стресс-тест резервирования остатков: параллельные списания одного материала
+не должны уводить остаток в минус, а многострочное списание — проходить частично.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from temp_db import load_app
+
+STOCK = 25
+WORKERS = 16
+ATTEMPTS = 80
+# Пауза между чтением остатка и списанием — расширяет окно гонки
+CHECK_DELAY = 0.005
+
+
+def test_stock_concurrency() -> None:
+    print(f"🔍 {ATTEMPTS} параллельных списаний по 1 при остатке {STOCK}...")
+
+    app = load_app()
+    from fastapi.testclient import TestClient
+
+    available_for = app._available_for
+
+    def slow_available_for(*args, **kwargs):
+        value = available_for(*args, **kwargs)
+        time.sleep(CHECK_DELAY)
+        return value
+
+    app._available_for = slow_available_for
+    try:
+        client = TestClient(app.app)
+        item = "Стресс-тест: саморез"
+        r = client.post("/api/purchases", json={"item": item, "qty": STOCK, "unit": "шт", "status": "stock_in"})
+        assert r.status_code == 200, r.text
+
+        def issue(_: int) -> int:
+            return client.post("/api/purchases", json={"item": item, "qty": 1, "unit": "шт.", "status": "issued"}).status_code
+
+        with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+            codes = list(pool.map(issue, range(ATTEMPTS)))
+
+        issued = codes.count(200)
+        rejected = codes.count(400)
+        with app._db() as con:
+            balance = available_for(con, item, "шт", None)
+        print(f"📊 Списано: {issued}, отказов: {rejected}, прочее: {ATTEMPTS - issued - rejected}, остаток: {balance}")
+        assert issued == STOCK and rejected == ATTEMPTS - STOCK and abs(balance) <= 1e-9, \
+            "❌ Остаток разошёлся с числом успешных списаний"
+
+        # Многострочное списание: вторая строка не проходит — не списывается ничего
+        client.post("/api/purchases", json={"item": item, "qty": 5, "unit": "шт", "status": "stock_in"})
+        r = client.post("/api/purchases/issue", json={"lines": [
+            {"item": item, "qty": 3, "unit": "шт"},
+            {"item": item, "qty": 3, "unit": "шт"},
+        ]})
+        with app._db() as con:
+            balance = available_for(con, item, "шт", None)
+        print(f"📊 Пакет сверх остатка: {r.status_code}, остаток: {balance}")
+        assert r.status_code == 400 and abs(balance - 5) <= 1e-9, "❌ Пакетное списание прошло частично"
+
+        r = client.post("/api/purchases/issue", json={"lines": [
+            {"item": item, "qty": 2, "unit": "шт"},
+            {"item": item, "qty": 3, "unit": "шт"},
+        ]})
+        with app._db() as con:
+            balance = available_for(con, item, "шт", None)
+        print(f"📊 Пакет в пределах остатка: {r.status_code}, строк: {len(r.json())}, остаток: {balance}")
+        assert r.status_code == 200 and abs(balance) <= 1e-9, "❌ Пакетное списание не прошло"
+    finally:
+        app._available_for = available_for
+
+    print("✅ Остатки согласованы")
+
+
+if __name__ == "__main__":
+    test_stock_concurrency()